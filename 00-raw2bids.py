@@ -3,75 +3,150 @@ import numpy as np
 from pathlib import Path
 import pandas as pd
 import os
-import shutil
 import subprocess
-import warnings
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import environment_variables as ev
 
 
-def edf2ascii(convert_exe, edf_file_name):
+def edf2ascii(convert_cmd, edf_file_name, out_file=None, log_file=None):
     """
-    This function converts an edf file to an ascii file
-    :param edf_file_name:
-    :param convert_exe:
-    :return:
+    This function converts an edf file to an ascii file. The conversion is done in a temporary directory and the
+    converted file is then moved to its final location, such that a crashed conversion never leaves a truncated file
+    behind.
+    :param convert_cmd: (string or list of strings) converter to use. Either the path to the edf2asc executable or a
+    command template in which "{edf}" and "{out_dir}" are replaced by the edf file and the directory in which the ascii
+    file must be written (e.g. ["edf2asc", "-p", "{out_dir}", "{edf}"]). The converter must write the file as
+    <edf stem>.asc in the output directory
+    :param edf_file_name: (Path) edf file to convert
+    :param out_file: (Path or None) path of the ascii file to write. If None, written next to the edf file
+    :param log_file: (Path or None) file in which to write the converter outputs. If None, printed to the console
+    :return: (Path) ascii file
     """
-    cmd = convert_exe
-    ascfile = Path(edf_file_name.parent, edf_file_name.stem + ".asc")
+    edf_file_name = Path(edf_file_name)
+    if out_file is None:
+        out_file = Path(edf_file_name.parent, edf_file_name.stem + ".asc")
+    if isinstance(convert_cmd, (str, Path)):
+        convert_cmd = [str(convert_cmd), "-p", "{out_dir}", "{edf}"]
+    with tempfile.TemporaryDirectory(dir=Path(out_file).parent) as tmp_dir:
+        cmd = [arg.format(edf=edf_file_name, out_dir=tmp_dir) for arg in convert_cmd]
+        if log_file is not None:
+            with open(log_file, "w") as log:
+                subprocess.run(cmd, stdout=log, stderr=subprocess.STDOUT)
+        else:
+            subprocess.run(cmd)
+        tmp_file = Path(tmp_dir, edf_file_name.stem + ".asc")
+        if not os.path.isfile(tmp_file):
+            raise Exception("The conversion of {} failed, no ascii file was created!".format(edf_file_name))
+        os.replace(tmp_file, out_file)
+    return out_file
+
 
-    # check if an asc file already exists
-    if not os.path.isfile(ascfile):
-        subprocess.run([cmd, "-p", edf_file_name.parent, edf_file_name])
+def bids_asc_name(edf_file_name, subject, task):
+    """
+    This function returns the name of the ascii file in the bids directory corresponding to an edf file. Leading 0 are
+    added to the run numbers below 10 to make sure that the files are loaded in the right order, and the misnamed
+    subject SX122 is renamed SX116.
+    :param edf_file_name: (string) name of the edf file
+    :param subject: (string) subject ID
+    :param task: (string) task
+    :return: (string) name of the ascii file
+    """
+    asci_stem = Path(edf_file_name).stem
+    if task not in ["auditory", "visual"]:
+        if float(asci_stem.split('run-')[1].split('_task')[0]) <= 9:
+            asci_stem = (asci_stem.split('run-')[0] + "run-0" + asci_stem.split('run-')[1].split('_task')[0] +
+                         '_task' + asci_stem.split('run-')[1].split('_task')[1])
     else:
-        warnings.warn("An Ascii file for " + edf_file_name.stem + " already exists!")
-    return ascfile
+        asci_stem = (asci_stem.split('run-')[0] + "run-00" +
+                     '_task' + asci_stem.split('run-')[1].split('_task')[1])
+    if subject == "SX122":
+        asci_stem = asci_stem.replace(subject, "SX116")
+    return asci_stem + ".asc"
 
 
-def ascii2mne_batch(raw_root, subjects, bids_root, task, session="1", convert_exe=""):
+def list_edf_jobs(raw_root, subjects, bids_root, task, session="1"):
     """
-
-    :param raw_root:
-    :param subjects:
-    :param bids_root:
-    :param task:
-    :param session:
-    :param convert_exe:
-    :return:
+    This function lists the edf files of a task and session to convert, along with the path of the corresponding ascii
+    file in the bids directory.
+    :param raw_root: (Path) root of the raw data
+    :param subjects: (list of strings) subjects IDs
+    :param bids_root: (Path) root of the bids directory
+    :param task: (string) task
+    :param session: (string) session
+    :return: (list of tuples) (edf file, ascii file) of each file to convert
     """
-    # Loop through each subject
+    jobs = []
     for subject in subjects:
         # Get the subject directory:
         subject_dir = Path(raw_root, "sub-" + subject, "ses-" + session)
-        # List the files in there:
-        subject_files = [fl for fl in os.listdir(subject_dir) if fl.endswith(".edf")]
         # Create the save dir:
         if subject == "SX122":
             save_dir = Path(bids_root, "sub-" + "SX116", "ses-" + session, "eyetrack")
         else:
             save_dir = Path(bids_root, "sub-" + subject, "ses-" + session, "eyetrack")
-        if not os.path.isdir(save_dir):
-            os.makedirs(save_dir)
-        task_files = [fl for fl in subject_files if fl.split("_task-")[1].split("_eyetrack.edf")[0] == task]
-        # Loop through every file:
-        for fl in task_files:
-            # Read in EyeLink file
-            print('Converting {} to asc'.format(fl))
-            asci_file = edf2ascii(convert_exe, Path(subject_dir, fl))
-            # Copy paste the file to the bids directory:
-            asci_stem = asci_file.stem
-            # Add leading 0 to files which are less than 10, to make sure that the files are loaded in the right
-            # order
-            if task not in ["auditory", "visual"]:
-                if float(asci_stem.split('run-')[1].split('_task')[0]) <= 9:
-                    asci_stem = (asci_stem.split('run-')[0] + "run-0" + asci_stem.split('run-')[1].split('_task')[0] +
-                                 '_task' + asci_stem.split('run-')[1].split('_task')[1])
-            else:
-                asci_stem = (asci_stem.split('run-')[0] + "run-00" +
-                             '_task' + asci_stem.split('run-')[1].split('_task')[1])
-            if subject == "SX122":
-                asci_stem = asci_stem.replace(subject, "SX116")
-            print('Copying {} to {}'.format(asci_file, save_dir))
-            shutil.copyfile(asci_file, Path(save_dir, asci_stem + asci_file.suffix))
+        # List the files of this task:
+        task_files = [fl for fl in os.listdir(subject_dir)
+                      if fl.endswith(".edf") and fl.split("_task-")[1].split("_eyetrack.edf")[0] == task]
+        jobs.extend([(Path(subject_dir, fl), Path(save_dir, bids_asc_name(fl, subject, task))) for fl in task_files])
+    return jobs
+
+
+def convert_edf_batch(jobs, convert_cmd, log_dir, n_jobs=4, overwrite=False):
+    """
+    This function converts edf files to ascii files directly in the bids directory, running several conversions in
+    parallel. Ascii files that are more recent than their edf file are considered up to date and skipped. The outputs
+    of the converter are saved in one log file per edf file.
+    :param jobs: (list of tuples) (edf file, ascii file) to convert, see list_edf_jobs
+    :param convert_cmd: (string or list of strings) converter, see edf2ascii
+    :param log_dir: (Path) directory of the log files
+    :param n_jobs: (int) number of conversions to run in parallel
+    :param overwrite: (bool) whether to convert the files even if they are up to date
+    :return: (list of tuples) (edf file, error) of the conversions that failed
+    """
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+    # Skip the files that are up to date:
+    pending = [(edf_file, asc_file) for edf_file, asc_file in jobs
+               if overwrite or not os.path.isfile(asc_file) or
+               os.path.getmtime(asc_file) < os.path.getmtime(edf_file)]
+    print("Converting {} edf files ({} up to date)".format(len(pending), len(jobs) - len(pending)))
+    for _, asc_file in pending:
+        if not os.path.isdir(asc_file.parent):
+            os.makedirs(asc_file.parent)
+    failed = []
+    # The work is done by the converter processes, threads are enough to schedule them:
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        futures = {executor.submit(edf2ascii, convert_cmd, edf_file, out_file=asc_file,
+                                   log_file=Path(log_dir, edf_file.stem + ".log")): edf_file
+                   for edf_file, asc_file in pending}
+        for future in as_completed(futures):
+            edf_file = futures[future]
+            try:
+                asc_file = future.result()
+                print('Converted {} to {}'.format(edf_file.name, asc_file))
+            except Exception as e:
+                print('Failed to convert {}: {}'.format(edf_file.name, e))
+                failed.append((edf_file, repr(e)))
+    return failed
+
+
+def ascii2mne_batch(raw_root, subjects, bids_root, task, session="1", convert_exe="", n_jobs=4, overwrite=False):
+    """
+    This function converts the edf files of the subjects of a task and session to ascii files in the bids directory.
+    :param raw_root: (Path) root of the raw data
+    :param subjects: (list of strings) subjects IDs
+    :param bids_root: (Path) root of the bids directory
+    :param task: (string) task
+    :param session: (string) session
+    :param convert_exe: (string or list of strings) converter, see edf2ascii
+    :param n_jobs: (int) number of conversions to run in parallel
+    :param overwrite: (bool) whether to convert the files even if they are up to date
+    :return: (list of tuples) (edf file, error) of the conversions that failed
+    """
+    jobs = list_edf_jobs(raw_root, subjects, bids_root, task, session=session)
+    return convert_edf_batch(jobs, convert_exe, Path(bids_root, "derivatives", "edf2asc_logs"), n_jobs=n_jobs,
+                             overwrite=overwrite)
 
 
 def beh2bids_batch(raw_root, subjects, bids_root, task, session="1",
@@ -145,22 +220,12 @@ if __name__ == "__main__":
 
     # ===============================================================================================
     # Convert the eye-tracking data:
-    # ===========================================
-    # PRP:
-    ascii2mne_batch(ev.raw_root, subjects_list_prp, ev.bids_root, "prp",
-                    convert_exe=r"C:\Users\alexander.lepauvre\Documents\GitHub\Reconstructed_time_analysis\edf2asc.exe")
-    # ===========================================
-    # Auditory only practice:
-    ascii2mne_batch(ev.raw_root, subjects_list_prp, ev.bids_root, "auditory",
-                    convert_exe=r"C:\Users\alexander.lepauvre\Documents\GitHub\Reconstructed_time_analysis\edf2asc.exe")
-    # ===========================================
-    # Visual only practice:
-    ascii2mne_batch(ev.raw_root, subjects_list_prp, ev.bids_root, "visual",
-                    convert_exe=r"C:\Users\alexander.lepauvre\Documents\GitHub\Reconstructed_time_analysis\edf2asc.exe")
-    # ===========================================
-    # Introspection:
-    ascii2mne_batch(ev.raw_root, subjects_list_introspection, ev.bids_root, "introspection", session="2",
-                    convert_exe=r"C:\Users\alexander.lepauvre\Documents\GitHub\Reconstructed_time_analysis\edf2asc.exe")
-    tasks_list = ["introspection"]
-    ascii2mne_batch(ev.raw_root, subjects_list_introspection, ev.bids_root, "introspection", session="3",
-                    convert_exe=r"C:\Users\alexander.lepauvre\Documents\GitHub\Reconstructed_time_analysis\edf2asc.exe")
+    # PRP, auditory only and visual only practice and introspection (sessions 2 and 3) are converted in one go:
+    edf_jobs = (list_edf_jobs(ev.raw_root, subjects_list_prp, ev.bids_root, "prp") +
+                list_edf_jobs(ev.raw_root, subjects_list_prp, ev.bids_root, "auditory") +
+                list_edf_jobs(ev.raw_root, subjects_list_prp, ev.bids_root, "visual") +
+                list_edf_jobs(ev.raw_root, subjects_list_introspection, ev.bids_root, "introspection", session="2") +
+                list_edf_jobs(ev.raw_root, subjects_list_introspection, ev.bids_root, "introspection", session="3"))
+    convert_edf_batch(edf_jobs,
+                      r"C:\Users\alexander.lepauvre\Documents\GitHub\Reconstructed_time_analysis\edf2asc.exe",
+                      Path(ev.bids_root, "derivatives", "edf2asc_logs"), n_jobs=4)
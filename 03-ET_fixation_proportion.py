@@ -1,9 +1,9 @@
-import mne
 import json
 from pathlib import Path
 import numpy as np
 import matplotlib.pyplot as plt
-from helper_function.helper_general import generate_gaze_map, deg_to_pix, equate_epochs_events
+from helper_function.helper_general import generate_gaze_map, deg_to_pix, EpochsView
+from helper_function.helper_pipeline import load_subjects_epochs
 import pandas as pd
 import os
 import environment_variables as ev
@@ -40,46 +40,29 @@ def check_plots(parameters_file, subjects, session="1", task="prp"):
     # Prepare a list to store the fixation heatmaps:
     fixation_heatmaps = []
     fixation_proportion = pd.DataFrame()
+    # Only the gaze and fixation channels are needed:
+    picks = ["{}_{}".format(ch, eye) for ch in ["xpos", "ypos", "fixation", "fixdist"] for eye in ["left", "right"]]
+    # Load all subjects data, from the analysis cache if they were already prepared with the same parameters:
+    subjects_epochs = load_subjects_epochs(ev.bids_root, subjects, session, task, param["data_type"],
+                                           decim_freq=param["decim_freq"], conditions=param["task_relevance"],
+                                           crop=param["crop"], picks=picks)
     # Loop through each subject:
     for sub in subjects:
-        print("Loading sub-{}".format(sub))
-        if isinstance(session, list):
-            epochs = []
-            for ses in session:
-                root = Path(ev.bids_root, "derivatives", "preprocessing", "sub-" + sub, "ses-" + ses,
-                            param["data_type"])
-                file_name = "sub-{}_ses-{}_task-{}_{}_desc-epo.fif".format(sub, ses, task,
-                                                                           param["data_type"])
-                epochs.append(mne.read_epochs(Path(root, file_name)))
-            # Equate the epochs events.
-            epochs = equate_epochs_events(epochs)
-            epochs = mne.concatenate_epochs(epochs, add_offset=True)
-        else:
-            root = Path(ev.bids_root, "derivatives", "preprocessing", "sub-" + sub, "ses-" + session,
-                        param["data_type"])
-            file_name = "sub-{}_ses-{}_task-{}_{}_desc-epo.fif".format(sub, session, task,
-                                                                       param["data_type"])
-            epochs = mne.read_epochs(Path(root, file_name))
-        # Decimate
-        if param["decim_freq"] is not None:
-            epochs.decimate(int(epochs.info["sfreq"] / param["decim_freq"]))
-
-        # Extract the relevant conditions:
-        epochs = epochs[param["task_relevance"]]
-        # Crop if needed:
-        epochs.crop(param["crop"][0], param["crop"][1])
+        epochs = subjects_epochs[sub]
 
         # Compute the gaze map for this subject:
         fixation_heatmaps.append(generate_gaze_map(epochs, 1080, 1920, sigma=20))
 
+        # Extract the fixation channels once, the crops and conditions below are views of these data:
+        view = EpochsView(epochs, picks=["fixation_left", "fixation_right", "fixdist_left", "fixdist_right"])
         # Loop through each of the duration conditions:
         for dur in param["durations"]:
-            # Crop the data:
-            epo = epochs.copy()[dur].crop(0, float(dur))
             # Extract the fixation mask:
-            fixation_mask = np.any(epo.copy().pick(["fixation_left", "fixation_right"]).get_data(copy=False), axis=1)
+            fixation_mask = np.any(view.get_data(picks=["fixation_left", "fixation_right"],
+                                                 tmin=0, tmax=float(dur), item=dur), axis=1)
             # Average fixation distance across both eyes:
-            fixation_data = np.mean(epo.pick(["fixdist_left", "fixdist_right"]).get_data(copy=False), axis=1)
+            fixation_data = np.mean(view.get_data(picks=["fixdist_left", "fixdist_right"],
+                                                  tmin=0, tmax=float(dur), item=dur), axis=1)
             # Extract the samples that are less than the defined threshold:
             less_than_thresh = np.array(fixation_data < param["fixdist_thresh_deg"]).astype(float)
             # Keep only the fixations:
@@ -94,11 +77,10 @@ def check_plots(parameters_file, subjects, session="1", task="prp"):
             }, index=[0])])
 
         # Compute the fixation proportion across durations betweenn 0 and 2 secs:
-        epo = epochs.copy().crop(0, 1.5)
         # Extract the fixation mask:
-        fixation_mask = np.any(epo.copy().pick(["fixation_left", "fixation_right"]).get_data(copy=False), axis=1)
+        fixation_mask = np.any(view.get_data(picks=["fixation_left", "fixation_right"], tmin=0, tmax=1.5), axis=1)
         # Average fixation distance across both eyes:
-        fixation_data = np.mean(epo.pick(["fixdist_left", "fixdist_right"]).get_data(copy=False), axis=1)
+        fixation_data = np.mean(view.get_data(picks=["fixdist_left", "fixdist_right"], tmin=0, tmax=1.5), axis=1)
         # Extract the samples that are less than the defined threshold:
         less_than_thresh = np.array(fixation_data < param["fixdist_thresh_deg"]).astype(float)
         # Keep only the fixations:
@@ -1,11 +1,10 @@
-import mne
 import os
 import json
 import numpy as np
 from pathlib import Path
 import matplotlib.pyplot as plt
-from helper_function.helper_general import (baseline_scaling, cluster_1samp_across_sub, equate_epochs_events,
-                                            reject_bad_epochs, format_drop_logs)
+from helper_function.helper_general import compute_evoked_difference, cluster_1samp_multi_contrast, format_drop_logs
+from helper_function.helper_pipeline import load_subjects_epochs
 from helper_function.helper_plotter import plot_ts_ci
 import environment_variables as ev
 
@@ -29,49 +28,19 @@ def pupil_amplitude(parameters_file, subjects, bids_root, session="1", task="prp
     # First, load the parameters:
     with open(parameters_file) as json_file:
         param = json.load(json_file)
-    # Load all subjects data:
-    subjects_epochs = {}
-    subjects_targets = {}
     # Create the directory to save the results in:
     save_dir = Path(bids_root, "derivatives", analysis_name, task)
     if not os.path.isdir(save_dir):
         os.makedirs(save_dir)
 
-    # Loop through each subject:
-    for sub in subjects:
-        print("Loading sub-{}".format(sub))
-        if isinstance(session, list):
-            epochs = []
-            for ses in session:
-                root = Path(bids_root, "derivatives", "preprocessing", "sub-" + sub, "ses-" + ses,
-                            param["data_type"])
-                file_name = "sub-{}_ses-{}_task-{}_{}_desc-epo.fif".format(sub, ses, task,
-                                                                           param["data_type"])
-                epochs.append(mne.read_epochs(Path(root, file_name)))
-            # Equate the epochs events.
-            epochs = equate_epochs_events(epochs)
-            epochs = mne.concatenate_epochs(epochs, add_offset=True)
-        else:
-            root = Path(bids_root, "derivatives", "preprocessing", "sub-" + sub, "ses-" + session,
-                        param["data_type"])
-            file_name = "sub-{}_ses-{}_task-{}_{}_desc-epo.fif".format(sub, session, task,
-                                                                       param["data_type"])
-            epochs = mne.read_epochs(Path(root, file_name))
-        # Crop the epochs:
-        epochs.crop(param["crop"][0], param["crop"][1])
-
-        # Extract the eyes:
-        eyes = [ch.split("_")[-1] for ch in epochs.ch_names if "pupil" in ch]
-
-        # Extract the relevant channels:
-        epochs.pick([f"pupil_{eye}" for eye in eyes])
-        print(epochs.info["sfreq"])
-        # Downsample:
-        epochs.resample(250)
-        # Baseline correction:
-        baseline_scaling(epochs, correction_method=param["baseline"], baseline=param["baseline_window"])
-        subjects_epochs[sub] = epochs.copy()[param["task_relevance"]]
-        subjects_targets[sub] = epochs.copy()["target"]
+    # Load all subjects data, from the analysis cache if they were already prepared with the same parameters:
+    subjects_epochs = load_subjects_epochs(bids_root, subjects, session, task, param["data_type"],
+                                           crop=param["crop"], picks="pupil", resample=250,
+                                           baseline=param["baseline"], baseline_window=param["baseline_window"])
+    subjects_targets = {sub: subjects_epochs[sub]["target"] for sub in subjects}
+    subjects_epochs = {sub: subjects_epochs[sub][param["task_relevance"]] for sub in subjects}
+    # Extract the times of the first subject (assuming that it is the same for all subjects, which it should be):
+    times = subjects_epochs[subjects[0]].times
 
     # Plot the drop logs:
     drop_log_df = format_drop_logs({sub: subjects_epochs[sub].drop_log for sub in subjects_epochs.keys()})
@@ -97,30 +66,39 @@ def pupil_amplitude(parameters_file, subjects, bids_root, session="1", task="prp
     # ==================================================================================================================
     # Task relevance comparisons:
     ylim = [0.95, 1.22]
+    # Compute the evoked difference of each contrast (across durations and per duration):
+    contrasts_evks, contrasts_diff = {}, {}
+    for dur in [None] + param["duration"]:
+        conditions = param["task_relevance"] if dur is None else ["/".join([task, dur])
+                                                                  for task in param["task_relevance"]]
+        contrasts_evks[dur], contrasts_diff[dur] = compute_evoked_difference(subjects_epochs, conditions,
+                                                                             downsample=dur is not None)
+    # Run the cluster based permutation tests of all contrasts at once with shared sign flips:
+    _, contrasts_clusters, contrasts_pvals, _ = cluster_1samp_multi_contrast(contrasts_diff,
+                                                                             n_permutations=param["n_permutations"],
+                                                                             threshold=param["threshold"],
+                                                                             tail=1)
     # =====================================================================================
     # Onset locked task relevance analysis:
     # ===========================================================
     # Create the condition string:
     conditions = param["task_relevance"]
-    # Compute cluster based permutation test across subject between task relevant and irrelevant:
-    evks, evks_diff, _, clusters, cluster_p_values, _ = (
-        cluster_1samp_across_sub(subjects_epochs, conditions,
-                                 n_permutations=param["n_permutations"],
-                                 threshold=param["threshold"],
-                                 tail=1, downsample=False))
+    # Get the results of the cluster based permutation test across subject between task relevant and irrelevant:
+    evks, evks_diff = contrasts_evks[None], contrasts_diff[None]
+    clusters, cluster_p_values = contrasts_clusters[None], contrasts_pvals[None]
     # Plot the results:
     fig, ax = plt.subplots(figsize=[8.3, 11.7 / 3])
     # Task relevant:
-    plot_ts_ci(evks[conditions[0]], epochs.times, ev.colors["task_relevance"][param["task_relevance"][0]],
+    plot_ts_ci(evks[conditions[0]], times, ev.colors["task_relevance"][param["task_relevance"][0]],
                ax=ax, label=param["task_relevance"][0], sig_thresh=0.05, plot_nonsig_clusters=True)
     # Task irrelevant (plot the cluster only on one to avoid incremental plotting):
-    plot_ts_ci(evks[conditions[1]], epochs.times, ev.colors["task_relevance"][param["task_relevance"][1]],
+    plot_ts_ci(evks[conditions[1]], times, ev.colors["task_relevance"][param["task_relevance"][1]],
                ax=ax, label=param["task_relevance"][1], clusters=clusters,
                clusters_pval=cluster_p_values, clusters_alpha=0.1, sig_thresh=0.05, plot_nonsig_clusters=True)
     # Compute the targets evoked:
     targets_evoked = np.array([np.mean(subjects_targets[sub]["target"].average().get_data(), axis=0)
                                for sub in subjects_targets.keys()])
-    plot_ts_ci(targets_evoked, epochs.times, [0.4, 0.4, 0.4],
+    plot_ts_ci(targets_evoked, times, [0.4, 0.4, 0.4],
                ax=ax, label="target")
     # Decorate the axes:
     ax.set_xlabel("Time (sec.)")
@@ -141,20 +119,17 @@ def pupil_amplitude(parameters_file, subjects, bids_root, session="1", task="prp
     for dur_i, dur in enumerate(param["duration"]):
         # Prepare the condition strings:
         conditions = ["/".join([task, dur]) for task in param["task_relevance"]]
-        # Run cluster based permutation test:
-        evks_dur, evks_diff_dur, _, clusters, cluster_p_values, _ = (
-            cluster_1samp_across_sub(subjects_epochs, conditions,
-                                     n_permutations=param["n_permutations"],
-                                     threshold=param["threshold"],
-                                     tail=1, downsample=True))
+        # Get the results of the cluster based permutation test:
+        evks_dur, evks_diff_dur = contrasts_evks[dur], contrasts_diff[dur]
+        clusters, cluster_p_values = contrasts_clusters[dur], contrasts_pvals[dur]
         # Plot the results:
         # Task relevant:
-        plot_ts_ci(evks_dur[conditions[0]], epochs.times,
+        plot_ts_ci(evks_dur[conditions[0]], times,
                    ev.colors["task_relevance"][param["task_relevance"][0]], ax=ax[dur_i],
                    label=param["task_relevance"][0], sig_thresh=0.05 / len(param["duration"]),
                    plot_single_subjects=False, plot_nonsig_clusters=True)
         # Task irrelevant:
-        plot_ts_ci(evks_dur[conditions[1]], epochs.times,
+        plot_ts_ci(evks_dur[conditions[1]], times,
                    ev.colors["task_relevance"][param["task_relevance"][1]], ax=ax[dur_i], clusters=clusters,
                    clusters_pval=cluster_p_values, clusters_alpha=0.1,
                    label=param["task_relevance"][1], sig_thresh=0.05 / len(param["duration"]),
@@ -162,7 +137,7 @@ def pupil_amplitude(parameters_file, subjects, bids_root, session="1", task="prp
         # Compute the targets evoked:
         targets_evoked = np.array([np.mean(subjects_targets[sub]["/".join([dur])].average().get_data(), axis=0)
                                    for sub in subjects_targets.keys()])
-        plot_ts_ci(targets_evoked, epochs.times, [0.4, 0.4, 0.4],
+        plot_ts_ci(targets_evoked, times, [0.4, 0.4, 0.4],
                    ax=ax[dur_i], label="target")
 
     # Decorate the axes:
@@ -1,12 +1,14 @@
-import mne
 import os
 import json
+import itertools
 import numpy as np
 from pathlib import Path
 import matplotlib.pyplot as plt
 from matplotlib.patches import Rectangle
-from helper_function.helper_general import (baseline_scaling, max_percentage_index, equate_epochs_events,
-                                            reject_bad_epochs, format_drop_logs)
+from helper_function.helper_general import (max_percentage_indices, format_drop_logs, condition_codes, grouped_sum,
+                                            EpochsView, time_mask)
+from helper_function.helper_pipeline import load_subjects_epochs
+from helper_function.helper_resampling import jackknife_latencies, jackknife_ci, bootstrap_latencies, bootstrap_ci
 from helper_function.helper_plotter import plot_pupil_latency, soa_boxplot
 import environment_variables as ev
 import pandas as pd
@@ -31,58 +33,33 @@ def pupil_latency(parameters_file, subjects, session="1", experiment="prp", anal
     # First, load the parameters:
     with open(parameters_file) as json_file:
         param = json.load(json_file)
-    # Load all subjects data:
-    subjects_epochs = {sub: None for sub in subjects}
     # Create the directory to save the results in:
     save_dir = Path(ev.bids_root, "derivatives", analysis_name, experiment)
     if not os.path.isdir(save_dir):
         os.makedirs(save_dir)
-    # The soas differ between the experiments, therefore, extracting them directly from the epochs objects:
-    soas = []
-    # Loop through each subject:
-    for sub in subjects:
-        print("Loading sub-{}".format(sub))
-        if isinstance(session, list):
-            epochs = []
-            for ses in session:
-                root = Path(ev.bids_root, "derivatives", "preprocessing", "sub-" + sub, "ses-" + ses,
-                            param["data_type"])
-                file_name = "sub-{}_ses-{}_task-{}_{}_desc-epo.fif".format(sub, ses, experiment,
-                                                                           param["data_type"])
-                epochs.append(mne.read_epochs(Path(root, file_name)))
-            # Equate the epochs events.
-            epochs = equate_epochs_events(epochs)
-            epochs = mne.concatenate_epochs(epochs, add_offset=True)
-        else:
-            root = Path(ev.bids_root, "derivatives", "preprocessing", "sub-" + sub, "ses-" + session,
-                        param["data_type"])
-            file_name = "sub-{}_ses-{}_task-{}_{}_desc-epo.fif".format(sub, session, experiment,
-                                                                       param["data_type"])
-            epochs = mne.read_epochs(Path(root, file_name))
-        # Extract the soas:
-        soas = list(epochs.metadata["SOA"].unique())
-        # Extract the relevant conditions:
-        epochs = epochs[param["task_relevance"]]
-        # Crop if needed:
-        epochs.crop(param["crop"][0], param["crop"][1])
-        # Reject bad epochs according to predefined criterion:
-        if reject_bad_trials:
-            reject_bad_epochs(epochs,
-                              baseline_window=param["baseline_window"],
-                              z_thresh=param["baseline_zthresh"],
-                              eyes=param["eyes"],
-                              exlude_beh=param["exlude_beh"],
-                              remove_blinks=param["remove_blinks"],
-                              blinks_window=param["blinks_window"],
-                              events_bound_blinks=param["events_bound_blinks"],
-                              remove_fixdist=param["remove_fixdist"],
-                              fixdist_thresh_deg=param["fixdist_thresh_deg"],
-                              fixdist_prop_trhesh=param["fixdist_prop_trhesh"])
-        # Extract the relevant channels:
-        epochs.pick(param["picks"])
-        # Baseline correction:
-        baseline_scaling(epochs, correction_method=param["baseline"], baseline=param["baseline_window"])
-        subjects_epochs[sub] = epochs
+    # Reject bad epochs according to predefined criterion:
+    reject = None
+    if reject_bad_trials:
+        reject = {
+            "baseline_window": param["baseline_window"],
+            "z_thresh": param["baseline_zthresh"],
+            "eyes": param["eyes"],
+            "exlude_beh": param["exlude_beh"],
+            "remove_blinks": param["remove_blinks"],
+            "blinks_window": param["blinks_window"],
+            "events_bound_blinks": param["events_bound_blinks"],
+            "remove_fixdist": param["remove_fixdist"],
+            "fixdist_thresh_deg": param["fixdist_thresh_deg"],
+            "fixdist_prop_trhesh": param["fixdist_prop_trhesh"]
+        }
+    # Load all subjects data, from the analysis cache if they were already prepared with the same parameters:
+    subjects_epochs = load_subjects_epochs(ev.bids_root, subjects, session, experiment, param["data_type"],
+                                           conditions=param["task_relevance"], crop=param["crop"], reject=reject,
+                                           picks=param["picks"], baseline=param["baseline"],
+                                           baseline_window=param["baseline_window"])
+    # The soas differ between the experiments, therefore, extracting them directly from the epochs objects. All
+    # subjects are pooled, as a SOA can be missing in some subjects after the trials rejection:
+    soas = sorted(set().union(*[epochs.metadata["SOA"].unique() for epochs in subjects_epochs.values()]), key=float)
 
     # Extract the times of the first subject (assuming that it is the same for all subjects, which it should be):
     times = subjects_epochs[subjects[0]].times
@@ -108,64 +85,80 @@ def pupil_latency(parameters_file, subjects, session="1", experiment="prp", anal
         del subjects_epochs[sub]
 
     # ==================================================================================================================
-    # Create LMM tables:
+    # Compute the evoked responses of each condition:
     # ===========================================================
-    latencies_lmm = []
-    for soa in soas:
-        for task in param["task_relevance"]:
-            for duration in param["duration"]:
-                for lock in param["lock"]:
-                    for sub in subjects_epochs.keys():
-                        if lock == "offset":
-                            onset_soa = float(soa) + float(duration)
-                        else:
-                            onset_soa = float(soa)
-                        # Average the data across both eyes:
-                        if lock == "offset":
-                            # Extract the data of the particular condition and crop the data:
-                            sub_epochs = subjects_epochs[sub].copy().crop(float(duration) + float(soa),
-                                                                          subjects_epochs[sub].times[-1])[
-                                "/".join([soa, task, duration, lock])]
-                        else:
-                            # Extract the data of the particular condition:
-                            sub_epochs = subjects_epochs[sub].copy().crop(float(soa),
-                                                                          subjects_epochs[sub].times[-1])[
-                                "/".join([soa, task, duration, lock])]
-                        try:
-                            data = np.nanmean(sub_epochs, axis=1)
-                        except np.exceptions.AxisError:
-                            latencies_lmm.append(pd.DataFrame({
-                                "sub_id": sub,
-                                "SOA": float(soa),
-                                "task": task,
-                                "duration": float(duration),
-                                "SOA_lock": lock,
-                                "onset_SOA": onset_soa,
-                                "latency": np.nan,
-                                "latency_aud": np.nan,
-                                "amplitude": np.nan
-                            }, index=[0]))
-                            continue
-
-                        # Average across trials
-                        evk = np.mean(data, axis=0)
-                        ind, val = max_percentage_index(evk, 90)
-                        latency = sub_epochs.times[ind]
-                        latency_aud = sub_epochs.times[ind] - onset_soa
+    # The cells are all the combinations of soa x task x duration x lock. The data of each subject are extracted once
+    # and the trials of all cells are averaged in a single grouped pass:
+    factors = [soas, param["task_relevance"], param["duration"], param["lock"]]
+    cube_shape = [len(levels) for levels in factors]
+    n_cells = int(np.prod(cube_shape))
+    cells = np.array(list(itertools.product(*factors)))
+    subjects_list = list(subjects_epochs.keys())
+    # Evoked responses averaged across eyes and then across trials, for the latencies:
+    cells_evk = np.zeros([len(subjects_list), n_cells, len(times)])
+    cells_ntrials = np.zeros([len(subjects_list), n_cells], dtype=int)
+    # Sums and counts of the non-NaN values of each eye, for the plots:
+    eyes_sums, eyes_counts = [], []
+    # The latency is searched from the onset of the sound, as an offset in the time indices:
+    onset_soa = cells[:, 0].astype(float) + np.where(cells[:, 3] == "offset", cells[:, 2].astype(float), 0)
+    sfreq = subjects_epochs[subjects_list[0]].info["sfreq"]
+    onset_ind = np.array([np.flatnonzero(time_mask(times, tmin, None, sfreq=sfreq))[0]
+                          for tmin in onset_soa])
+    # Confidence intervals of the latencies, from the jackknife and bootstrap distributions of each cell:
+    jk_se, jk_low, jk_high, boot_low, boot_high = np.full([5, len(subjects_list), n_cells], np.nan)
+    rng = np.random.default_rng(param["seed"])
+    for sub_i, sub in enumerate(subjects_list):
+        view = EpochsView(subjects_epochs[sub])
+        codes = condition_codes(view, factors)
+        # Average the data across both eyes:
+        trials_data = np.nanmean(view.data, axis=1)
+        sums, cells_ntrials[sub_i] = grouped_sum(trials_data, codes, n_cells)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            cells_evk[sub_i] = sums / cells_ntrials[sub_i][:, None]
+        # Resample the trials of each cell:
+        _, estimate, _ = max_percentage_indices(cells_evk[sub_i], 90, start=onset_ind, times=times)
+        jk_latencies = jackknife_latencies(trials_data, codes, n_cells, 90, start=onset_ind, times=times)
+        jk_se[sub_i], jk_low[sub_i], jk_high[sub_i] = jackknife_ci(estimate, jk_latencies, codes, n_cells,
+                                                                   ci=param["ci"])
+        boot_latencies = bootstrap_latencies(trials_data, codes, n_cells, 90, n_boot=param["n_bootstrap"],
+                                             start=onset_ind, times=times, seed=rng)
+        boot_low[sub_i], boot_high[sub_i] = bootstrap_ci(boot_latencies, ci=param["ci"])
+        sums, counts = grouped_sum(view.data, codes, n_cells, ignore_nan=True)
+        eyes_sums.append(sums)
+        eyes_counts.append(counts)
+    eyes_sums = np.array(eyes_sums).reshape([len(subjects_list)] + cube_shape + list(eyes_sums[0].shape[1:]))
+    eyes_counts = np.array(eyes_counts).reshape(eyes_sums.shape)
 
-                        latencies_lmm.append(pd.DataFrame({
-                            "sub_id": sub,
-                            "SOA": float(soa),
-                            "task": task,
-                            "duration": float(duration),
-                            "SOA_lock": lock,
-                            "onset_SOA": onset_soa,
-                            "latency": latency,
-                            "latency_aud": latency_aud,
-                            "amplitude": val
-                        }, index=[0]))
-    # Convert to data frame:
-    latencies_lmm = pd.concat(latencies_lmm).reset_index(drop=True)
+    # ==================================================================================================================
+    # Create LMM tables:
+    # ===========================================================
+    # Find the latencies of all cells and subjects at once (the cells without trials are all NaN). The latency is the
+    # first sample above the threshold, the confidence intervals are computed around the interpolated latency:
+    n_subs = len(subjects_list)
+    ind, latency_interp, amplitude = max_percentage_indices(
+        cells_evk.transpose(1, 0, 2).reshape(n_cells * n_subs, len(times)), 90, start=np.repeat(onset_ind, n_subs),
+        times=times)
+    latency = np.where(ind >= 0, times[ind], np.nan).reshape(n_cells, n_subs)
+    latency_interp = latency_interp.reshape(n_cells, n_subs)
+    amplitude = amplitude.reshape(n_cells, n_subs)
+    # Convert to data frame, one row per cell and subject:
+    latencies_lmm = pd.DataFrame({
+        "sub_id": np.tile(subjects_list, n_cells),
+        "SOA": np.repeat(cells[:, 0].astype(float), n_subs),
+        "task": np.repeat(cells[:, 1], n_subs),
+        "duration": np.repeat(cells[:, 2].astype(float), n_subs),
+        "SOA_lock": np.repeat(cells[:, 3], n_subs),
+        "onset_SOA": np.repeat(onset_soa, n_subs),
+        "latency": latency.flatten(),
+        "latency_aud": (latency - onset_soa[:, None]).flatten(),
+        "amplitude": amplitude.flatten(),
+        "latency_interp": latency_interp.flatten(),
+        "latency_jk_se": jk_se.T.flatten(),
+        "latency_jk_ci_low": jk_low.T.flatten(),
+        "latency_jk_ci_high": jk_high.T.flatten(),
+        "latency_boot_ci_low": boot_low.T.flatten(),
+        "latency_boot_ci_high": boot_high.T.flatten()
+    })
     # Save the peak latencies:
     latencies_lmm.to_csv(Path(save_dir, "pupil_peak_latencies.csv"))
 
@@ -236,19 +229,14 @@ def pupil_latency(parameters_file, subjects, session="1", experiment="prp", anal
         fig, ax = plt.subplots(4, 1, figsize=[8.3 / 3, 11.7 / 3], sharex=True, sharey=True)
         # Plot onset locked:
         soa_evks = {soa: [] for soa in soas}
-        for soa in soas:
-            # Loop through each subject:
-            evks = []
-            for sub in subjects_epochs.keys():
-                # Average the data across both eyes:
-                data = np.nanmean(subjects_epochs[sub].copy()["/".join([soa, task, "onset"])], axis=0)
-                # Average across both eyes:
-                try:
-                    evk = np.mean(data, axis=0)
-                    evks.append(evk)
-                except np.exceptions.AxisError:
-                    continue
-            soa_evks[soa] = np.mean(np.array(evks), axis=0)
+        task_i, lock_i = param["task_relevance"].index(task), param["lock"].index("onset")
+        for soa_i, soa in enumerate(soas):
+            # Average across the trials of all durations, then across both eyes:
+            with np.errstate(invalid="ignore", divide="ignore"):
+                evks = np.mean(np.sum(eyes_sums[:, soa_i, task_i, :, lock_i], axis=1) /
+                               np.sum(eyes_counts[:, soa_i, task_i, :, lock_i], axis=1), axis=1)
+            # Average across the subjects that have trials in this condition:
+            soa_evks[soa] = np.nanmean(evks, axis=0)
         # Plot each soa:
         for soa in np.sort(list(soa_evks.keys())):
             ax[0].plot(times, soa_evks[soa], color=ev.colors["soa_onset_locked"][soa], label=soa)
@@ -271,20 +259,14 @@ def pupil_latency(parameters_file, subjects, session="1", experiment="prp", anal
                                       (latencies_lmm["duration"] == float(duration))]
             # Plot onset locked:
             soa_evks = {soa: [] for soa in soas}
-            for soa in soas:
-                # Loop through each subject:
-                evks = []
-                for sub in subjects_epochs.keys():
-                    # Average the data across both eyes:
-                    data = np.nanmean(subjects_epochs[sub].copy()["/".join([soa, task, "offset",
-                                                                            duration])], axis=0)
-                    # Average across both eyes:
-                    try:
-                        evk = np.mean(data, axis=0)
-                        evks.append(evk)
-                    except np.exceptions.AxisError:
-                        continue
-                soa_evks[soa] = np.mean(np.array(evks), axis=0)
+            lock_i = param["lock"].index("offset")
+            for soa_i, soa in enumerate(soas):
+                # Average across trials, then across both eyes:
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    evks = np.mean(eyes_sums[:, soa_i, task_i, dur_i, lock_i] /
+                                   eyes_counts[:, soa_i, task_i, dur_i, lock_i], axis=1)
+                # Average across the subjects that have trials in this condition:
+                soa_evks[soa] = np.nanmean(evks, axis=0)
             # Plot each soa:
             for soa in np.sort(list(soa_evks.keys())):
                 ax[dur_i + 1].plot(times, soa_evks[soa], color=ev.colors["soa_offset_locked"][soa], label=soa)
@@ -7,7 +7,7 @@ import matplotlib as mpl
 import environment_variables as ev
 import pickle
 import matplotlib.colors as mcolors
-from helper_function.helper_general import cluster_test
+from helper_function.helper_general import cluster_test_stream
 from helper_function.helper_plotter import plot_decoding_results, plot_rois, get_color_mapping
 import pandas as pd
 
@@ -68,9 +68,11 @@ for fl in subfolders:
         diff_null = res["scores_shuffle_tr"] - res["scores_shuffle_ti"]
 
         # Compute pvalues of the difference:
-        x_zscored, h0_zscore, clusters, cluster_pv, p_values, h0 = cluster_test(decoding_diff, diff_null,
-                                                                                z_threshold=1.5,
-                                                                                do_zscore=True)
+        x_zscored, null_acc, clusters, cluster_pv, p_values, h0 = cluster_test_stream(decoding_diff, diff_null,
+                                                                                      z_threshold=1.5,
+                                                                                      do_zscore=True,
+                                                                                      hist_bins=200,
+                                                                                      hist_range=[-1, 1])
         if any(p_values < alpha):
             msk = np.array(p_values < alpha, dtype=int)
             onset = res["times"][np.where(np.diff(msk) == 1)[0] + 1]
@@ -126,12 +128,8 @@ for fl in subfolders:
         plt.close()
 
         # Plot the null distribution for reference:
-        # Prepare a grid for the heatmap
-        num_bins = 200
-        hist, xedges, yedges = np.histogram2d(diff_null.flatten(),
-                                              np.repeat(np.arange(diff_null.shape[1]), diff_null.shape[0]),
-                                              bins=[num_bins, len(res['times'])],
-                                              range=[[-1, 1], [0, len(res['times'])]])  #
+        # Get the histogram of the null distribution at each time point accumulated during the test:
+        hist, xedges, yedges = null_acc.hist, null_acc.hist_edges, np.arange(len(res['times']) + 1)
         # Create the meshgrid for the surface plot
         xpos, ypos = np.meshgrid(xedges[:-1] + (xedges[1] - xedges[0]) / 2,
                                  yedges[:-1] + (yedges[1] - yedges[0]) / 2, indexing="ij")
@@ -153,10 +151,11 @@ for fl in subfolders:
 
         # ======================================================================================
         # Task relevant
-        x_zscored, h0_zscore, clusters, cluster_pv, p_values, h0 = cluster_test(np.mean(res["scores_tr"], axis=0),
-                                                                                res["scores_shuffle_tr"],
-                                                                                z_threshold=1.5,
-                                                                                do_zscore=True)
+        x_zscored, null_acc, clusters, cluster_pv, p_values, h0 = cluster_test_stream(
+            np.mean(res["scores_tr"], axis=0),
+            res["scores_shuffle_tr"],
+            z_threshold=1.5,
+            do_zscore=True)
         if any(p_values < alpha):
             msk = np.array(p_values < alpha, dtype=int)
             onset_tr = res["times"][np.where(np.diff(msk) == 1)[0] + 1]
@@ -201,10 +200,11 @@ for fl in subfolders:
         # ======================================================================================
         # Task irrelevant
         # Compute pvalues:
-        x_zscored, h0_zscore, clusters, cluster_pv, p_values, h0 = cluster_test(np.mean(res["scores_ti"], axis=0),
-                                                                                res["scores_shuffle_ti"],
-                                                                                z_threshold=1.5,
-                                                                                do_zscore=True)
+        x_zscored, null_acc, clusters, cluster_pv, p_values, h0 = cluster_test_stream(
+            np.mean(res["scores_ti"], axis=0),
+            res["scores_shuffle_ti"],
+            z_threshold=1.5,
+            do_zscore=True)
         if any(p_values < alpha):
             msk = np.array(p_values < alpha, dtype=int)
             onset_ti = res["times"][np.where(np.diff(msk) == 1)[0] + 1]
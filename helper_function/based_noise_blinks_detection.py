@@ -127,36 +127,32 @@ def based_noise_blinks_detection(pupil_size, sampling_freq):
     monotonically_dec = smooth_pupil_size_diff <= 0
     monotonically_inc = smooth_pupil_size_diff >= 0
 
-    # Finding correct blink onsets and offsets using monotonically increasing and decreasing arrays
-    for i in range(len(blink_onset)):
-        # Edge Case 2: If data starts with blink we do not update it and let starting blink index be 0
-        if blink_onset[i] != 0:
-            j = blink_onset[i] - 1
-            while j > 0 and monotonically_dec[j] == True:
-                j -= 1
-            blink_onset[i] = j + 1
-
-        # Edge Case 3: If data ends with blink we do not update it and let ending blink index be the last index of the data
-        if blink_offset[i] != len(pupil_size) - 1:
-            j = blink_offset[i]
-            while j < len(monotonically_inc) and monotonically_inc[j] == True:
-                j += 1
-            blink_offset[i] = j
-
-    # Removing duplications (in case of consecutive sets): [a, b, b, c] => [a, c] or if inter blink interval is less than concat_gap_interval
-    c = np.empty((len(blink_onset) + len(blink_offset),), dtype=blink_onset.dtype)
-    c[0::2] = blink_onset
-    c[1::2] = blink_offset
-    c = list(c)
-
-    i = 1
-    while i < len(c) - 1:
-        if c[i + 1] - c[i] <= concat_gap_interval:
-            c[i:i + 2] = []
-        else:
-            i += 2
-
-    temp = np.reshape(c, (-1, 2), order='C')
+    # Finding correct blink onsets and offsets using monotonically increasing and decreasing arrays:
+    # Moving left from each onset while monotonically_dec is True amounts to finding the last False before the onset
+    # (index 0 excluded), and moving right from each offset while monotonically_inc is True to finding the first False
+    # from the offset onward. These are found for all blinks at once by searching the False positions.
+    blink_onset = np.array(blink_onset)
+    blink_offset = np.array(blink_offset)
+    # Edge Case 2: If data starts with blink we do not update it and let starting blink index be 0
+    update_onset = blink_onset != 0
+    dec_breaks = np.where(~monotonically_dec)[0]
+    # The walk stops at index 0 in any case, hence the onset is 1 if there is no break before it:
+    dec_breaks = np.hstack((0, dec_breaks[dec_breaks > 0]))
+    last_break = np.searchsorted(dec_breaks, blink_onset - 1, side="right") - 1
+    new_onset = dec_breaks[np.maximum(last_break, 0)] + 1
+    blink_onset[update_onset] = new_onset[update_onset]
+    # Edge Case 3: If data ends with blink we do not update it and let ending blink index be the last index of the data
+    update_offset = blink_offset != len(pupil_size) - 1
+    inc_breaks = np.where(~monotonically_inc)[0]
+    next_break = np.searchsorted(inc_breaks, blink_offset, side="left")
+    new_offset = np.append(inc_breaks, len(monotonically_inc))[next_break]
+    blink_offset[update_offset] = new_offset[update_offset]
+
+    # Removing duplications (in case of consecutive sets): [a, b, b, c] => [a, c] or if inter blink interval is less
+    # than concat_gap_interval. Each gap is compared to the interval independently of the previous merges, such that
+    # all the merges are found in a single pass:
+    merge = blink_onset[1:] - blink_offset[:-1] <= concat_gap_interval
+    temp = np.column_stack((blink_onset[np.hstack((True, ~merge))], blink_offset[np.hstack((~merge, True))]))
 
     """
 	Multplied by sampling interval in order to give onset and offset in real time (milliseconds) by factoring in sampling rate of device used
@@ -1,4 +1,5 @@
 import math
+import copy
 import matplotlib
 from mne.baseline import rescale
 from pathlib import Path
@@ -6,6 +7,7 @@ import numpy as np
 import pandas as pd
 from scipy.ndimage import gaussian_filter
 from scipy.stats import norm
+from scipy.stats import t as t_dist
 from mne.stats import permutation_cluster_1samp_test
 from scipy.stats import zscore
 from math import atan2, degrees
@@ -590,10 +592,15 @@ def beh_exclusion(data_df):
 
 def reject_bad_epochs(epochs, baseline_window=None, z_thresh=2, eyes=None, remove_blinks=True, blinks_window=None,
                       remove_nan=False, exlude_beh=True, events_bound_blinks=True, remove_fixdist=True,
-                      fixdist_thresh_deg=6, fixdist_prop_trhesh=0.7):
+                      fixdist_thresh_deg=6, fixdist_prop_trhesh=0.7, blinks_window_shift=None):
     """
     This function rejects epochs based on the zscore of the baseline. For some trials, there may be artifacts
-    in the baseline, in which case baseline correction will spread the artifact. Such epochs are discarded.
+    in the baseline, in which case baseline correction will spread the artifact. Such epochs are discarded. Epochs can
+    additionally be rejected based on behavior, fixation distance, blinks and NaN. The channels needed for all the
+    criteria are extracted once (see EpochsView) and each criterion is computed as a boolean mask over trials. Each
+    rejected trial is dropped once, with the first criterion it failed as reason in the drop log, in the order:
+    bad_beh, baseline_artifact, fixation_distance, blinks, NaN. The baseline z score is computed across the trials
+    that passed the behavioral exclusion.
     :param epochs:
     :param baseline_window:
     :param z_thresh:
@@ -602,7 +609,11 @@ def reject_bad_epochs(epochs, baseline_window=None, z_thresh=2, eyes=None, remov
     :param blinks_window:
     :param remove_nan:
     :param exlude_beh:
-    :param events_bound_blinks:
+    :param events_bound_blinks: (bool) whether to only look for blinks in the onset and offset locked trials
+    :param blinks_window_shift: (None, string or array) shift of the blinks window of each trial in seconds, either as
+    an array (n_trials) or as the name of a metadata column (for example to look for blinks after a stimulus offset
+    that depends on the trial duration). No shift if None. The shifts must be finite: a trial without shift should
+    have a shift of 0
     return:
         - epochs:
         - inds
@@ -617,149 +628,219 @@ def reject_bad_epochs(epochs, baseline_window=None, z_thresh=2, eyes=None, remov
         blinks_window = [0, 0.5]
     # Get the initial number of trials:
     ntrials_orig = len(epochs)
+    # Extract the data of the channels used for the rejection once:
+    pupil_picks = ["_".join(["pupil", eye]) for eye in eyes]
+    fixdist_picks = ["_".join(["fixdist", eye]) for eye in eyes]
+    blink_picks = ["_".join(["blink", eye]) for eye in eyes]
+    picks = ((pupil_picks if z_thresh is not None else []) + (fixdist_picks if remove_fixdist is not None else []) +
+             (blink_picks if remove_blinks else []))
+    if remove_nan:
+        view = EpochsView(epochs)
+    else:
+        view = EpochsView(epochs, picks=picks) if len(picks) > 0 else None
+    metadata = epochs.metadata.copy().reset_index(drop=True) if epochs.metadata is not None else None
+    # Mask of the rejected trials for each criterion, in the order in which they are applied:
+    rejected = {}
+    keep = np.ones(ntrials_orig, dtype=bool)
+
+    def report(reason, mask, msg):
+        # Only count the trials that weren't rejected by the previous criteria:
+        rejected[reason] = mask & keep
+        print(msg.format(np.sum(rejected[reason]), np.sum(keep), (np.sum(rejected[reason]) / np.sum(keep)) * 100))
+        keep[rejected[reason]] = False
 
     if exlude_beh:
-        inds = beh_exclusion(epochs.metadata.copy().reset_index(drop=True))
-        if len(inds) > 0:
-            # Drop these epochs:
-            epochs.drop(inds, reason="baseline_artifact", verbose="ERROR")
-        print("{} out of {} ({:.2f}%) trials were rejected based on behavior.".format(len(inds), ntrials_orig,
-                                                                                      (len(inds) / ntrials_orig) * 100))
-    # Extract the data:
+        mask = np.zeros(ntrials_orig, dtype=bool)
+        mask[beh_exclusion(metadata.copy())] = True
+        report("bad_beh", mask, "{} out of {} ({:.2f}%) trials were rejected based on behavior.")
     if z_thresh is not None:
-        baseline_data = epochs.copy().crop(tmin=baseline_window[0],
-                                           tmax=baseline_window[1]).get_data(picks=["_".join(["pupil", eye])
-                                                                                    for eye in eyes])
+        baseline_data = view.get_data(picks=pupil_picks, tmin=baseline_window[0], tmax=baseline_window[1])
         # Compute the average across eyes and time:
         baseline_avg = np.mean(np.mean(baseline_data, axis=1), axis=1)
-        # Z score:
-        baseline_zscore = zscore(baseline_avg, nan_policy='omit')
-        # Find the epochs indices that exceed the threshold:
-        inds = np.where(np.abs(baseline_zscore) > z_thresh)[0]
-        if len(inds) > 0:
-            # Drop these epochs:
-            epochs.drop(inds, reason="baseline_artifact", verbose="ERROR")
-        # Print the proportion of dropped epochs:
-        print("{} out of {} ({:.2f}%) trials had artifact in baseline.".format(len(inds), len(baseline_zscore),
-                                                                               (len(inds) / len(
-                                                                                   baseline_zscore)) * 100))
+        # Z score across the remaining trials:
+        mask = np.zeros(ntrials_orig, dtype=bool)
+        mask[keep] = np.abs(zscore(baseline_avg[keep], nan_policy='omit')) > z_thresh
+        report("baseline_artifact", mask, "{} out of {} ({:.2f}%) trials had artifact in baseline.")
     # Remove trials based on fixation distance from center:
     if remove_fixdist is not None:
-        # Extract the fixation distance data:
-        fix_dist_data = epochs.copy().crop(tmin=0,
-                                           tmax=epochs.times[-1]).get_data(picks=["_".join(["fixdist", eye])
-                                                                                  for eye in eyes])
-        # Average across both eyes:
-        fix_dist_data = np.mean(fix_dist_data, axis=1)
+        # Average the fixation distance across both eyes:
+        fix_dist_data = np.mean(view.get_data(picks=fixdist_picks, tmin=0, tmax=epochs.times[-1]), axis=1)
         # Compute the proportion of fixation within each trial:
         fix_prop = np.mean(fix_dist_data < fixdist_thresh_deg, axis=1)
-        # Find the trials that exceed threshold:
-        inds = np.where(fix_prop < fixdist_prop_trhesh)[0]
-        if len(inds) > 0:
-            # Drop these epochs:
-            epochs.drop(inds, reason="fixation_distance", verbose="ERROR")
-        # Print the proportion of dropped epochs:
-        print("In {} out of {} ({:.2f}%), pariticipant did not fixate.".format(len(inds), len(fix_prop),
-                                                                               (len(inds) / len(fix_prop)) * 100))
+        report("fixation_distance", fix_prop < fixdist_prop_trhesh,
+               "In {} out of {} ({:.2f}%), pariticipant did not fixate.")
     if remove_blinks:
+        # Combine both eyes data, counting as blink the samples in which both eyes blinked:
+        blink_data = np.all(view.get_data(picks=blink_picks) != 0, axis=1)
+        if blinks_window_shift is None:
+            mask = np.any(blink_data[:, view.time_index(blinks_window[0], blinks_window[1])], axis=1)
+        else:
+            if isinstance(blinks_window_shift, str):
+                blinks_window_shift = metadata[blinks_window_shift].to_numpy(dtype=float)
+            blinks_window_shift = np.broadcast_to(np.asarray(blinks_window_shift, dtype=float), [ntrials_orig])
+            # A NaN shift would look for blinks in the whole epoch:
+            if not np.all(np.isfinite(blinks_window_shift)):
+                raise ValueError("The blinks window shift is not finite in trials {}!".format(
+                    np.flatnonzero(~np.isfinite(blinks_window_shift))))
+            # Find the window of each trial (once per unique shift) and count the blinks samples within it from the
+            # cumulative sum:
+            shifts, shift_inds = np.unique(blinks_window_shift, return_inverse=True)
+            windows = np.array([[win.start, win.stop] for win in
+                                [view.time_index(blinks_window[0] + shift, blinks_window[1] + shift)
+                                 for shift in shifts]])
+            blink_cumsum = np.concatenate([np.zeros((blink_data.shape[0], 1), dtype=int),
+                                           np.cumsum(blink_data, axis=1)], axis=1)
+            trials = np.arange(blink_data.shape[0])
+            mask = (blink_cumsum[trials, windows[shift_inds, 1]] - blink_cumsum[trials, windows[shift_inds, 0]]) > 0
         # Events bound blinks detects blinks that occur within a specified time window around the events of interest.
         # In our experiment, the critical visual events are the onset and offset of visual stimuli, depending on the
-        # tone locking.
+        # tone locking:
         if events_bound_blinks:
-            metadata = epochs.metadata.copy().reset_index(drop=True)
-            blink_inds = []
-            # Find blinks around the onset of the visual events:
-            onset_epochs = epochs["onset"]
-            trial_inds = list(metadata[metadata["SOA_lock"] == "onset"].index)
-            # Extract the data:
-            blink_data = np.squeeze(onset_epochs.copy().crop(tmin=blinks_window[0],
-                                                             tmax=blinks_window[1]).get_data(
-                picks=["_".join(["blink", eye])
-                       for eye in eyes]))
-            if blink_data.shape[1] == 2:
-                # Combine both eyes data:
-                blink_data = np.logical_and(blink_data[:, 0, :], blink_data[:, 1, :]).astype(float)
-            # Find the trials in which we have blinks:
-            blink_inds.extend([trial_inds[i] for i in np.where(np.any(blink_data, axis=1))[0]])
-
-            # For the offset locked trials, this needs to be done separately for each stimulus duration:
-            for dur in epochs.metadata["duration"].unique():
-                epo = epochs["/".join(["offset", dur])]
-                trial_inds = list(metadata[(metadata["SOA_lock"] == "offset") & (metadata["duration"] == dur)].index)
-                # Extract the data:
-                blink_data = np.squeeze(epo.copy().crop(tmin=blinks_window[0],
-                                                        tmax=blinks_window[1]).get_data(
-                    picks=["_".join(["blink", eye])
-                           for eye in eyes]))
-                if blink_data.shape[1] == 2:
-                    # Combine both eyes data:
-                    blink_data = np.logical_and(blink_data[:, 0, :], blink_data[:, 1, :]).astype(float)
-                # Find the trials in which we have blinks:
-                blink_inds.extend([trial_inds[i] for i in np.where(np.any(blink_data, axis=1))[0]])
-
-        else:
-            # Extract the blinks channels:
-            blink_data = np.squeeze(epochs.copy().crop(tmin=blinks_window[0],
-                                                       tmax=blinks_window[1]).get_data(picks=["_".join(["blink", eye])
-                                                                                              for eye in eyes]))
-            if blink_data.shape[1] == 2:
-                # Combine both eyes data:
-                blink_data = np.logical_and(blink_data[:, 0, :], blink_data[:, 1, :]).astype(float)
-            # Find the trials in which we have blinks:
-            blink_inds = np.where(np.any(blink_data, axis=1))[0]
-        if len(blink_inds) > 0:
-            # Drop these epochs:
-            epochs.drop(blink_inds, reason="blinks", verbose="ERROR")
-        # Print the proportion of dropped epochs:
-        print("{} out of {} ({:.2f}%) trials had blinks within.".format(len(blink_inds), blink_data.shape[0],
-                                                                        (len(blink_inds) /
-                                                                         blink_data.shape[0]) * 100,
-                                                                        blinks_window))
+            mask &= metadata["SOA_lock"].isin(["onset", "offset"]).to_numpy()
+        report("blinks", mask, "{} out of {} ({:.2f}%) trials had blinks within.")
     if remove_nan:
-        data = epochs.get_data(copy=True)
-        nan_inds = np.unique(np.where(np.isnan(data))[0])
-        if len(nan_inds) > 0:
-            # Drop these epochs:
-            epochs.drop(nan_inds, reason="NaN", verbose="ERROR")
-        # Print the proportion of dropped epochs:
-        print("{} out of {} ({:.2f}%) trials had NaN.".format(len(nan_inds), data.shape[0],
-                                                              (len(nan_inds) /
-                                                               data.shape[0]) * 100,
-                                                              blinks_window))
+        report("NaN", np.any(np.isnan(view.data), axis=(1, 2)), "{} out of {} ({:.2f}%) trials had NaN.")
+
+    # Drop the rejected trials, criterion by criterion to keep the reason of each in the drop log:
+    remaining = np.arange(ntrials_orig)
+    for reason, mask in rejected.items():
+        if np.any(mask[remaining]):
+            epochs.drop(np.flatnonzero(mask[remaining]), reason=reason, verbose="ERROR")
+            remaining = remaining[~mask[remaining]]
     ntrials_final = len(epochs)
 
     return epochs, 1 - ntrials_final / ntrials_orig
 
 
+def condition_codes(epochs, factors):
+    """
+    This function assigns each trial to a cell of the condition cube defined by the levels of several factors (i.e.
+    soa x task x duration x lock). The trials are matched to the levels with the same tag logic as epochs[condition]
+    in MNE, see get_condition_mask.
+    :param epochs: (mne epochs object or EpochsView) epochs whose trials to assign
+    :param factors: (list of lists of strings) levels of each factor
+    :return: (1D array of int) flat index of the cell of each trial (C order, i.e. the last factor varies fastest),
+    -1 for the trials that don't match a level of every factor
+    """
+    shape = [len(levels) for levels in factors]
+    levels_idx = np.full([len(factors), len(epochs.events)], -1)
+    for fac_i, levels in enumerate(factors):
+        for lvl_i, level in enumerate(levels):
+            try:
+                levels_idx[fac_i, get_condition_mask(epochs, level)] = lvl_i
+            except KeyError:
+                # No trial of this level:
+                continue
+    codes = np.full(len(epochs.events), -1)
+    valid = np.all(levels_idx >= 0, axis=0)
+    codes[valid] = np.ravel_multi_index(levels_idx[:, valid], shape)
+    return codes
+
+
+def grouped_sum(data, codes, n_groups, ignore_nan=False):
+    """
+    This function sums the trials of each group in one pass: the trials are sorted by group and the sums are computed
+    over the contiguous blocks of each group.
+    :param data: (np.array) data of each trial, the first dimension being the trials
+    :param codes: (1D array of int) group of each trial, trials with negative codes are ignored (see condition_codes)
+    :param n_groups: (int) number of groups
+    :param ignore_nan: (bool) whether to ignore the NaNs. If False, the sum of a group is NaN wherever one of its
+    trials is NaN
+    :return:
+    sums: (np.array) sum of the trials of each group, n_groups x data.shape[1:]
+    counts: (np.array) number of trials of each group (n_groups). If ignore_nan, number of non NaN values, same shape
+    as sums
+    """
+    order = np.argsort(codes, kind="stable")
+    order = order[codes[order] >= 0]
+    n_trials = np.bincount(codes[order], minlength=n_groups)
+    # Start of the block of each group that has trials:
+    groups = np.flatnonzero(n_trials)
+    starts = (np.cumsum(n_trials) - n_trials)[groups]
+    data = data[order]
+    sums = np.zeros([n_groups] + list(data.shape[1:]))
+    if ignore_nan:
+        valid = ~np.isnan(data)
+        counts = np.zeros(sums.shape, dtype=int)
+        if len(groups) > 0:
+            sums[groups] = np.add.reduceat(np.where(valid, data, 0), starts, axis=0)
+            counts[groups] = np.add.reduceat(valid.astype(int), starts, axis=0)
+    else:
+        counts = n_trials
+        if len(groups) > 0:
+            sums[groups] = np.add.reduceat(data, starts, axis=0)
+    return sums, counts
+
+
 def max_percentage_index(data, thresh_percent):
     """
-    Find the index at which a time series reaches a certain percentage of its peak value.
+    Find the index at which a time series reaches a certain percentage of its peak value. See max_percentage_indices
+    for the batched version.
     :param data: (numpy array) containing the time series
     :param thresh_percent: (float or int) percentage of peak value
     :return ind: index of the first time the percentage of peak value is reached
     """
-    if not (0 <= thresh_percent <= 100):
-        raise ValueError("Percentage threshold must be between 0 and 100.")
-
-    # If all the data are negative, correct by adding the minimum:
-    if np.max(data) < 0:
-        data = data + np.abs(np.min(data))
-        threshold_value = np.max(data) * (thresh_percent / 100)
-    else:
-        threshold_value = np.min(data) + (np.ptp(data) * (thresh_percent / 100))
-
-    # Find the first index where the value is greater than or equal to the threshold
-    ind = np.argmax(data >= threshold_value)
-
+    ind, _, threshold_value = max_percentage_indices(np.asarray(data)[np.newaxis], thresh_percent)
     # If the threshold is not reached, return None or raise an exception, depending on your preference.
-    if data[ind] < threshold_value:
+    if ind[0] < 0:
         return None
 
-    return ind, threshold_value
+    return ind[0], threshold_value[0]
+
+
+def max_percentage_indices(data, thresh_percent, start=None, times=None):
+    """
+    Find the index at which each of several time series reaches a certain percentage of its peak value, all at once.
+    If all the data of a time series are negative, it is corrected by adding its minimum before computing the
+    threshold (as in max_percentage_index). The NaNs are ignored.
+    :param data: (2D numpy array) time series, n_cells x n_times
+    :param thresh_percent: (float or int) percentage of peak value
+    :param start: (None, int or 1D array of int) index from which to search in each time series. The samples before
+    are ignored, as if the time series were cropped
+    :param times: (1D array) time of each sample. If None, the latencies are returned in samples
+    :return:
+    ind: (1D array of int) index of the first sample reaching the threshold in each time series, -1 if it is never
+    reached (i.e. all NaN)
+    latency: (1D array) latency at which the threshold is reached, interpolated linearly between the sample before and
+    the first sample reaching it. NaN if it is never reached
+    threshold_value: (1D array) threshold of each time series
+    """
+    if not (0 <= thresh_percent <= 100):
+        raise ValueError("Percentage threshold must be between 0 and 100.")
+    data = np.array(data, dtype=float, ndmin=2)
+    n_cells, n_times = data.shape
+    start = np.broadcast_to(0 if start is None else start, [n_cells])
+    # Ignore the samples before the start of each time series:
+    data[np.arange(n_times)[np.newaxis, :] < start[:, np.newaxis]] = np.nan
+
+    # fmax and fmin ignore the NaNs:
+    data_max, data_min = np.fmax.reduce(data, axis=1), np.fmin.reduce(data, axis=1)
+    # If all the data are negative, correct by adding the minimum:
+    negative = data_max < 0
+    data[negative] = data[negative] + np.abs(data_min[negative])[:, np.newaxis]
+    threshold_value = np.where(negative, (data_max + np.abs(data_min)) * (thresh_percent / 100),
+                               data_min + (data_max - data_min) * (thresh_percent / 100))
+
+    # Find the first index where the value is greater than or equal to the threshold:
+    reached = data >= threshold_value[:, np.newaxis]
+    ind = np.argmax(reached, axis=1)
+    found = reached[np.arange(n_cells), ind]
+    ind[~found] = -1
+
+    # Interpolate between the previous sample and the first one reaching the threshold:
+    latency = np.where(found, ind, np.nan).astype(float)
+    prev = np.where(found & (ind > start), ind - 1, 0)
+    prev_val, ind_val = data[np.arange(n_cells), prev], data[np.arange(n_cells), ind]
+    interp = found & (ind > start) & ~np.isnan(prev_val)
+    latency[interp] = prev[interp] + ((threshold_value[interp] - prev_val[interp]) /
+                                      (ind_val[interp] - prev_val[interp]))
+    if times is not None:
+        latency = np.interp(latency, np.arange(n_times), times)
+    return ind, latency, threshold_value
 
 
 def cluster_1samp_across_sub(subjects_epochs, conditions, n_permutations=1024, threshold=None, tail=0,
-                             downsample=False):
+                             downsample=False, exact_limit=2 ** 16):
     """
     This function applies the permutation_cluster_1samp_test from MNE, taking in a dictionary containing the epochs
     of each subject. It will then average across trials within the condition of interest (i.e. create evoked) and
@@ -771,38 +852,18 @@ def cluster_1samp_across_sub(subjects_epochs, conditions, n_permutations=1024, t
     :param threshold:
     :param tail:
     :param downsample:
+    :param exact_limit: (int) if the number of possible sign flips (2^n_subjects) is below this limit, all sign flips
+    are enumerated instead of sampling n_permutations random ones (see cluster_1samp_multi_contrast)
     :return:
     """
-
-    evks = {cond: [] for cond in conditions}
-    # Loop through each subject:
-    for sub in subjects_epochs.keys():
-        # Loop through each relevant condition:
-        cond_data = {cond: [] for cond in conditions}
-        conditions_counts = []
-        for cond in conditions:
-            # Average the data across both eyes:
-            data = np.nanmean(subjects_epochs[sub].copy()[cond], axis=1)
-            # Remove any trials containing Nan:
-            data = np.array([data[i, :] for i in range(data.shape[0]) if not any(np.isnan(data[i, :]))])
-            # Remove any trials containing Nan:
-            cond_data[cond] = np.array([data[i, :] for i in range(data.shape[0]) if not any(np.isinf(data[i, :]))])
-            conditions_counts.append(cond_data[cond].shape[0])
-        # Check the counts of each condition:
-        if conditions_counts[0] != conditions_counts[1] and downsample:
-            min_counts = min(conditions_counts)
-            for cond in conditions:
-                evks[cond].append(np.mean(cond_data[cond][np.random.choice(cond_data[cond].shape[0], min_counts), :],
-                                          axis=0))
-        else:
-            for cond in conditions:
-                evks[cond].append(np.mean(cond_data[cond], axis=0))
-
-    # Convert each condition data to a numpy array:
-    evks = {cond: np.array(evks[cond]) for cond in conditions}
-    # Compute the evoked difference between task relevance within each subject:
-    evks_diff = np.array([evks[conditions[0]][i, :] - evks[conditions[1]][i, :]
-                          for i in range(evks[conditions[0]].shape[0])])
+    # Compute the evoked responses and their difference within each subject:
+    evks, evks_diff = compute_evoked_difference(subjects_epochs, conditions, downsample=downsample)
+    if 2 ** (evks_diff.shape[0] - (tail == 0)) <= exact_limit:
+        # Few enough subjects to enumerate all sign flips:
+        T_obs, clusters, cluster_p_values, H0 = cluster_1samp_multi_contrast(evks_diff[np.newaxis],
+                                                                             threshold=threshold, tail=tail,
+                                                                             exact_limit=exact_limit)
+        return evks, evks_diff, T_obs[0], clusters[0], cluster_p_values[0], H0[0]
     # Perform a cluster based permutation ttest:
     T_obs, clusters, cluster_p_values, H0 = permutation_cluster_1samp_test(
         evks_diff,
@@ -816,6 +877,456 @@ def cluster_1samp_across_sub(subjects_epochs, conditions, n_permutations=1024, t
     return evks, evks_diff, T_obs, clusters, cluster_p_values, H0
 
 
+def compute_evoked_difference(subjects_epochs, conditions, downsample=False):
+    """
+    This function averages across trials within each condition of interest for each subject (i.e. create evoked) and
+    computes the within subject difference between the two conditions. Trials containing NaN or Inf are discarded.
+    :param subjects_epochs: (dict) epochs of each subject {sub: mne epochs object}
+    :param conditions: (list of strings) the two conditions to compare, the difference is conditions[0] -
+    conditions[1]
+    :param downsample: (boolean) whether to equate the number of trials between the two conditions by randomly
+    selecting trials in the condition with the most trials
+    :return:
+        - evks: (dict) subject x time evoked responses for each condition
+        - evks_diff: (np.array) subject x time difference between the evoked responses of each condition
+    """
+    evks = {cond: [] for cond in conditions}
+    # Loop through each subject:
+    for sub in subjects_epochs.keys():
+        epochs = subjects_epochs[sub]
+        # Extract the data once and average across both eyes:
+        data = np.nanmean(epochs.get_data(), axis=1)
+        # Flag the trials containing NaN or Inf:
+        good_trials = np.isfinite(data).all(axis=-1)
+        data[~good_trials, :] = 0
+        # Get the trials of each condition:
+        cond_masks = [get_condition_mask(epochs, cond) & good_trials for cond in conditions]
+        conditions_counts = [np.sum(mask) for mask in cond_masks]
+        # Prepare the averaging weights of each trial in each condition:
+        weights = np.zeros((len(conditions), data.shape[0]))
+        for cond_i, mask in enumerate(cond_masks):
+            if conditions_counts[cond_i] == 0:
+                weights[cond_i, :] = np.nan
+            elif conditions_counts[0] != conditions_counts[1] and downsample:
+                # Randomly select as many trials as in the condition with the fewest trials:
+                min_counts = min(conditions_counts)
+                picks = np.where(mask)[0][np.random.choice(conditions_counts[cond_i], min_counts)]
+                weights[cond_i, :] = np.bincount(picks, minlength=data.shape[0]) / min_counts
+            else:
+                weights[cond_i, mask] = 1 / conditions_counts[cond_i]
+        # Compute the evoked responses of all conditions at once:
+        sub_evks = weights @ data
+        for cond_i, cond in enumerate(conditions):
+            evks[cond].append(sub_evks[cond_i, :])
+
+    # Convert each condition data to a numpy array:
+    evks = {cond: np.array(evks[cond]) for cond in conditions}
+    # Compute the evoked difference between task relevance within each subject:
+    evks_diff = np.array([evks[conditions[0]][i, :] - evks[conditions[1]][i, :]
+                          for i in range(evks[conditions[0]].shape[0])])
+    return evks, evks_diff
+
+
+def get_condition_mask(epochs, condition):
+    """
+    This function returns a boolean mask of the epochs matching a condition string, following the same tag logic as
+    epochs[condition] in MNE (i.e. all the "/" separated tags of the condition must be found in the event name) but
+    without copying the epochs.
+    :param epochs: (mne epochs object or EpochsView) epochs from which to select the trials
+    :param condition: (string or list of strings) condition(s) to select. If a list is passed, the trials matching any
+    of the conditions are selected
+    :return: (np.array of booleans) mask of the selected epochs
+    """
+    if isinstance(condition, str):
+        condition = [condition]
+    event_codes = []
+    for cond in condition:
+        tags = set(cond.split("/"))
+        codes = [code for name, code in epochs.event_id.items() if name == cond or tags.issubset(name.split("/"))]
+        if len(codes) == 0:
+            raise KeyError("Event '{}' is not in the epochs event_id!".format(cond))
+        event_codes.extend(codes)
+    return np.isin(epochs.events[:, 2], event_codes)
+
+
+def time_mask(times, tmin=None, tmax=None, sfreq=None):
+    """
+    This function returns a boolean mask of the samples between tmin and tmax, included, selecting the same samples as
+    epochs.crop: tmin and tmax are first rounded to the nearest sample and then extended by half a sample, so that
+    floating point errors on the times don't drop the edge samples.
+    :param times: (1D array) time of each sample
+    :param tmin: (float or None) start of the window. Beginning of the data if None
+    :param tmax: (float or None) end of the window. End of the data if None
+    :param sfreq: (float or None) sampling frequency. If None, tmin and tmax are used as is
+    :return: (1D array of booleans) mask of the samples in the window
+    """
+    tmin = times[0] if tmin is None or not np.isfinite(tmin) else tmin
+    tmax = times[-1] if tmax is None or not np.isfinite(tmax) else tmax
+    if sfreq is not None:
+        tmin = int(round(tmin * sfreq)) / sfreq - 0.5 / sfreq
+        tmax = int(round(tmax * sfreq)) / sfreq + 0.5 / sfreq
+    if tmin > tmax:
+        raise ValueError("tmin ({}) must be less than or equal to tmax ({})!".format(tmin, tmax))
+    mask = (times >= tmin) & (times <= tmax)
+    if not mask.any():
+        raise ValueError("No samples remain between tmin={} and tmax={}!".format(tmin, tmax))
+    return mask
+
+
+def _as_view_index(indices, n):
+    """
+    This function converts indices into a slice whenever they are evenly spaced and increasing, such that indexing an
+    array with them returns a view instead of a copy.
+    :param indices: (1D array of int or booleans) indices or mask
+    :param n: (int) length of the indexed dimension
+    :return: (slice or 1D array) slice if possible, the indices otherwise
+    """
+    indices = np.asarray(indices)
+    if indices.dtype == bool:
+        indices = np.flatnonzero(indices)
+    indices = np.where(indices < 0, indices + n, indices)
+    if len(indices) == 0:
+        return slice(0, 0)
+    if len(indices) == 1:
+        return slice(int(indices[0]), int(indices[0]) + 1)
+    step = indices[1] - indices[0]
+    if step > 0 and np.all(np.diff(indices) == step):
+        return slice(int(indices[0]), int(indices[-1]) + 1, int(step))
+    return indices
+
+
+class EpochsView:
+    """
+    This class extracts the data of an mne epochs object once and gives access to crops, channel picks and trial
+    selections of these data without copying them: epochs.copy().crop(tmin, tmax)[condition].get_data(picks=picks)
+    copies the whole data array twice, while view.get_data(picks=picks, tmin=tmin, tmax=tmax, item=condition)
+    returns numpy views. Crops are always views, channel picks and trial selections are views when the selected
+    channels and trials are evenly spaced (for example a single condition in epochs ordered by condition) and copies
+    of the selected data only otherwise. The crops select the same samples as epochs.crop and the conditions select the
+    same trials as epochs[condition].
+    The data are read only, to avoid modifying them through a view by mistake.
+    :param epochs: (mne epochs object) epochs from which to extract the data
+    :param picks: (list of strings or None) channels to extract. All channels if None
+    :param dtype: (numpy dtype or None) data type of the extracted data (e.g. np.float32 to halve the memory). Same as
+    the epochs if None
+    :param memmap_file: (string or path object or None) if passed, the data are written to this .npy file and memory
+    mapped instead of being held in memory
+    :param block_size: (int) number of trials extracted at once, to limit the memory overhead of the extraction
+    """
+
+    def __init__(self, epochs, picks=None, dtype=None, memmap_file=None, block_size=256):
+        if picks is None:
+            picks = epochs.ch_names
+        elif isinstance(picks, str):
+            picks = [picks]
+        missing = [ch for ch in picks if ch not in epochs.ch_names]
+        if len(missing) > 0:
+            raise ValueError("Channels {} are not in the epochs!".format(missing))
+        ch_inds = [epochs.ch_names.index(ch) for ch in picks]
+        self.ch_names = list(picks)
+        self.times = epochs.times.copy()
+        self.sfreq = epochs.info["sfreq"]
+        self.events = epochs.events.copy()
+        self.event_id = dict(epochs.event_id)
+        self.metadata = None if epochs.metadata is None else epochs.metadata.reset_index(drop=True)
+        self.selection = epochs.selection.copy()
+        self._ch_index = {ch: ind for ind, ch in enumerate(self.ch_names)}
+        shape = (len(epochs), len(self.ch_names), len(self.times))
+        if dtype is None:
+            dtype = epochs.get_data(picks=ch_inds[:1], item=[0]).dtype if len(epochs) > 0 else np.float64
+        if memmap_file is not None:
+            data = np.lib.format.open_memmap(memmap_file, mode="w+", dtype=dtype, shape=shape)
+        else:
+            data = np.empty(shape, dtype=dtype)
+        # Extract the data by blocks of trials:
+        for start in range(0, shape[0], block_size):
+            stop = min(start + block_size, shape[0])
+            data[start:stop] = epochs.get_data(picks=ch_inds, item=np.arange(start, stop))
+        if memmap_file is not None:
+            data.flush()
+            del data
+            data = np.load(memmap_file, mmap_mode="r")
+        else:
+            data.flags.writeable = False
+        self.data = data
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def __getitem__(self, item):
+        """
+        Selects trials, returning a new EpochsView sharing the data whenever possible (see trial_index).
+        """
+        trial_ind = self.trial_index(item)
+        view = copy.copy(self)
+        view.data = self.data[trial_ind]
+        view.events = self.events[trial_ind]
+        view.selection = self.selection[trial_ind]
+        if self.metadata is not None:
+            view.metadata = self.metadata.iloc[trial_ind].reset_index(drop=True)
+        return view
+
+    def time_index(self, tmin=None, tmax=None):
+        """
+        This function returns the slice of samples between tmin and tmax, included, as mne epochs.crop would.
+        :param tmin: (float or None) start of the window. Beginning of the epochs if None
+        :param tmax: (float or None) end of the window. End of the epochs if None
+        :return: (slice) samples in the window
+        """
+        if tmin is None and tmax is None:
+            return slice(None)
+        inds = np.flatnonzero(time_mask(self.times, tmin, tmax, sfreq=self.sfreq))
+        return slice(int(inds[0]), int(inds[-1]) + 1)
+
+    def ch_index(self, picks=None):
+        """
+        This function returns the index of channels.
+        :param picks: (string or list of strings or None) channel names. All channels if None
+        :return: (slice or 1D array) index of the channels
+        """
+        if picks is None:
+            return slice(None)
+        if isinstance(picks, str):
+            picks = [picks]
+        try:
+            return _as_view_index([self._ch_index[ch] for ch in picks], len(self.ch_names))
+        except KeyError as e:
+            raise ValueError("Channel {} is not in the epochs view!".format(e))
+
+    def trial_index(self, item=None):
+        """
+        This function returns the index of trials.
+        :param item: (string, list of strings, boolean mask, indices or None) trials to select. Strings select the
+        trials the same way as epochs[item] (see get_condition_mask). All trials if None
+        :return: (slice or 1D array) index of the trials
+        """
+        if item is None:
+            return slice(None)
+        if isinstance(item, slice):
+            return item
+        if isinstance(item, str) or (isinstance(item, list) and len(item) > 0 and isinstance(item[0], str)):
+            item = get_condition_mask(self, item)
+        return _as_view_index(item, len(self))
+
+    def get_data(self, picks=None, tmin=None, tmax=None, item=None):
+        """
+        This function returns the data of the selected channels, time window and trials. Slices are applied first so
+        that at most the selected data are copied.
+        :param picks: (string or list of strings or None) channel names, see ch_index
+        :param tmin: (float or None) start of the window, see time_index
+        :param tmax: (float or None) end of the window, see time_index
+        :param item: (string, list of strings, boolean mask, indices or None) trials, see trial_index
+        :return: (np.array) data (n_trials, n_channels, n_times)
+        """
+        trial_ind, ch_ind = self.trial_index(item), self.ch_index(picks)
+        data = self.data[trial_ind if isinstance(trial_ind, slice) else slice(None),
+                         ch_ind if isinstance(ch_ind, slice) else slice(None),
+                         self.time_index(tmin, tmax)]
+        if not isinstance(trial_ind, slice):
+            data = data[trial_ind]
+        if not isinstance(ch_ind, slice):
+            data = data[:, ch_ind]
+        return data
+
+    def align(self, epochs):
+        """
+        This function returns the view restricted to the trials that remain in epochs (for example after some trials
+        were dropped from the epochs after the view was created).
+        :param epochs: (mne epochs object) epochs from which the view was created
+        :return: (EpochsView) view with the same trials as the epochs
+        """
+        if len(epochs) == len(self) and np.array_equal(epochs.selection, self.selection):
+            return self
+        keep = np.isin(self.selection, epochs.selection)
+        if np.sum(keep) != len(epochs):
+            raise ValueError("The epochs contain trials that are not in the view!")
+        return self[keep]
+
+
+def cluster_1samp_multi_contrast(diff_waves, n_permutations=1024, threshold=None, tail=0, t_power=1,
+                                 block_size=1000, seed=None, exact_limit=2 ** 16):
+    """
+    This function performs one sample cluster based permutation tests (sign flip) on several contrasts at once. Instead
+    of drawing a new set of sign flips for each contrast as permutation_cluster_1samp_test would, one sign flip matrix
+    is shared across all contrasts and applied to the stacked subject x time difference waves of all contrasts through
+    a single matrix product per block of permutations. The t statistic is recomputed from the sign flipped sums (the
+    sum of squares doesn't change under sign flip) and the clusters are found in a vectorized fashion across all
+    permutations and contrasts. The whole family of tests therefore costs about as much as a single one. The t
+    statistic, threshold, cluster sums and p-values follow the conventions of MNE permutation_cluster_1samp_test
+    (time series, no adjacency).
+    :param diff_waves: (dict or np.array) difference waves of each contrast, either as a dictionary
+    {contrast: subject x time array} or as an array of shape contrast x subject x time. All contrasts must contain the
+    same subjects in the same order, as each sign flip is applied to the same subject across contrasts
+    :param n_permutations: (int) number of permutations, including the observed data
+    :param threshold: (float or None) t threshold for a sample to be included in a cluster. If None, the threshold
+    corresponding to p < 0.05 is used, as in MNE
+    :param tail: (int) 1 for upper tail, -1 lower tail, 0 two tailed
+    :param t_power: (float) power by which to raise the t values in the cluster sums
+    :param block_size: (int) number of permutations to evaluate at once
+    :param seed: (None or int) seed of the random number generator for the sign flips
+    :param exact_limit: (int) if the number of possible sign flips (2^n_subjects, or 2^(n_subjects - 1) for two
+    tailed tests, as flipping all signs yields the same absolute statistics) is below this limit, all sign flips are
+    enumerated and n_permutations is ignored. The H0 then contains every sign flip, the observed data included, and
+    the p-values are exact. Set to 0 to always sample random sign flips
+    :return:
+        - T_obs: (dict or np.array) observed t values of each contrast
+        - clusters: (dict or list) list of clusters of each contrast, in the format of permutation_cluster_1samp_test
+        - cluster_p_values: (dict or list) p-value of each cluster of each contrast
+        - H0: (dict or np.array) max cluster sums under permutation of each contrast
+    """
+    print("=" * 40)
+    print("Welcome to cluster_1samp_multi_contrast")
+    if isinstance(diff_waves, dict):
+        contrasts = list(diff_waves.keys())
+        data = np.stack([np.asarray(diff_waves[contrast], dtype=float) for contrast in contrasts])
+    else:
+        contrasts = None
+        data = np.asarray(diff_waves, dtype=float)
+    n_contrasts, n_subjects, n_times = data.shape
+    if threshold is None:
+        p_thresh = 0.05 / (1 + (tail == 0))
+        threshold = -t_dist.ppf(p_thresh, n_subjects - 1)
+        if np.sign(tail) < 0:
+            threshold = -threshold
+    # Check whether all the sign flips can be enumerated:
+    n_flips = 2 ** (n_subjects - (tail == 0))
+    exact = n_flips <= exact_limit
+    if exact:
+        flip_bits = enumerate_sign_flips(n_subjects, fix_last=tail == 0)
+        n_permutations = n_flips
+    print("Testing {} contrasts with {} subjects and {} {}permutations, threshold={:.3f}".format(
+        n_contrasts, n_subjects, n_permutations, "exact " if exact else "", threshold))
+
+    # Compute the observed t values:
+    T_obs = np.mean(data, axis=1) / np.sqrt(np.var(data, axis=1, ddof=1) / n_subjects)
+    # The sum of squares is invariant to sign flips, only the sums need to be recomputed for each permutation:
+    sum_sq = np.sum(data ** 2, axis=1).reshape(-1)
+    # Stack the contrasts along the columns, such that all contrasts are flipped with a single matrix product:
+    data_stacked = data.transpose(1, 0, 2).reshape(n_subjects, n_contrasts * n_times)
+
+    # Compute the max cluster sums under permutation:
+    rng = np.random.default_rng(seed)
+    H0 = np.zeros((n_contrasts, n_permutations))
+    # The first entry is for the observed data, which is part of the enumerated flips in exact mode:
+    n_perm_done = 0 if exact else 1
+    while n_perm_done < n_permutations:
+        n_block = min(block_size, n_permutations - n_perm_done)
+        if exact:
+            # Unpack the next block of sign flips:
+            signs = 1.0 - 2.0 * np.unpackbits(flip_bits[n_perm_done:n_perm_done + n_block], axis=1,
+                                              count=n_subjects, bitorder="little")
+        else:
+            # Draw the sign flips:
+            signs = rng.choice([-1.0, 1.0], size=(n_block, n_subjects))
+        # Recompute the t values for all permutations and all contrasts at once:
+        perm_t = _ttest_1samp_from_sums(signs @ data_stacked, sum_sq, n_subjects)
+        # Find the max cluster sum of each permutation and contrast:
+        max_sums = _max_cluster_sums_1d(perm_t.reshape(n_block * n_contrasts, n_times), threshold, tail,
+                                        t_power=t_power)
+        H0[:, n_perm_done:n_perm_done + n_block] = max_sums.reshape(n_block, n_contrasts).T
+        n_perm_done += n_block
+
+    # Find the observed clusters and compute their p-values:
+    clusters, cluster_p_values = [], []
+    for ci in range(n_contrasts):
+        contrast_clusters, cluster_stats = _find_clusters(T_obs[ci], threshold, tail, None, t_power=t_power)
+        if len(contrast_clusters) > 0:
+            # include original (true) ordering
+            if tail == -1:  # up tail
+                H0[ci, 0] = cluster_stats.min()
+            elif tail == 1:
+                H0[ci, 0] = cluster_stats.max()
+            else:
+                H0[ci, 0] = abs(cluster_stats).max()
+            cluster_p_values.append(_pval_from_histogram(cluster_stats, H0[ci], tail))
+        else:
+            cluster_p_values.append(np.array([]))
+        clusters.append(contrast_clusters)
+
+    if contrasts is not None:
+        return (dict(zip(contrasts, T_obs)), dict(zip(contrasts, clusters)), dict(zip(contrasts, cluster_p_values)),
+                dict(zip(contrasts, H0)))
+    return T_obs, clusters, cluster_p_values, H0
+
+
+def enumerate_sign_flips(n_subjects, fix_last=False):
+    """
+    This function enumerates all the possible sign flips of n subjects and stores them as a compact bit array (one bit
+    per subject, 1 meaning that the sign of the subject is flipped). Row k contains the binary representation of k,
+    such that the first row is the observed data (no flip).
+    :param n_subjects: (int) number of subjects
+    :param fix_last: (boolean) whether to never flip the last subject, which halves the number of flips. This is
+    sufficient for two tailed tests, where flipping all signs yields the same absolute statistics
+    :return: (np.array of uint8) n_flips x ceil(n_subjects / 8) packed bits, to unpack with
+    np.unpackbits(..., axis=1, count=n_subjects, bitorder="little")
+    """
+    n_flips = 2 ** (n_subjects - fix_last)
+    flips = (np.arange(n_flips)[:, np.newaxis] >> np.arange(n_subjects)) & 1
+    return np.packbits(flips.astype(bool), axis=1, bitorder="little")
+
+
+def _ttest_1samp_from_sums(sums, sum_sq, n):
+    """
+    This function computes one sample t values from the sums and sum of squares of the observations, which is what
+    changes (or not) under sign flip permutations. Same as mne.stats.ttest_1samp_no_p without the sigma correction.
+    :param sums: (np.array) sum of the observations, permutations x variables
+    :param sum_sq: (np.array) sum of squares of the observations, variables
+    :param n: (int) number of observations
+    :return: (np.array) t values, permutations x variables
+    """
+    mean = sums / n
+    var = np.maximum(sum_sq - n * mean ** 2, 0) / (n - 1)
+    return mean / np.sqrt(var / n)
+
+
+def _max_cluster_sums_1d(stats, threshold, tail, t_power=1):
+    """
+    This function finds the clusters of supra threshold samples in many time series at once and returns the largest
+    (in absolute value) cluster sum of each time series, as MNE does for each permutation. Each row is padded with a
+    sub threshold sample so that the rows can be flattened without clusters spanning two rows. Clusters are then
+    labelled with a cumulative sum of their onsets and summed with a single bincount.
+    :param stats: (np.array) statistics, n_series x n_times
+    :param threshold: (float) cluster forming threshold
+    :param tail: (int) 1 for upper tail, -1 lower tail, 0 two tailed
+    :param t_power: (float) power by which to raise the statistics in the cluster sums
+    :return: (np.array) max cluster sum (with sign) of each series, 0 if there are no clusters
+    """
+    n_series, n_times = stats.shape
+    if t_power == 1:
+        weights = stats
+    else:
+        weights = np.sign(stats) * np.abs(stats) ** t_power
+    pad = np.zeros((n_series, 1))
+    weights = np.concatenate([weights, pad], axis=1).ravel()
+    if tail == 1:
+        masks = [stats > threshold]
+    elif tail == -1:
+        masks = [stats < threshold]
+    else:
+        masks = [stats > threshold, stats < -threshold]
+    max_sums = np.zeros(n_series)
+    for mask in masks:
+        mask = np.concatenate([mask, pad.astype(bool)], axis=1).ravel()
+        # Find the onset of each cluster:
+        cluster_onsets = mask.copy()
+        cluster_onsets[1:] &= ~mask[:-1]
+        onsets_ind = np.flatnonzero(cluster_onsets)
+        if onsets_ind.size == 0:
+            continue
+        # Label each sample with its cluster (0 outside of clusters) and sum within each cluster:
+        labels = np.cumsum(cluster_onsets) * mask
+        cluster_sums = np.bincount(labels, weights=weights, minlength=onsets_ind.size + 1)[1:]
+        cluster_series = onsets_ind // (n_times + 1)
+        # Keep the cluster with the largest absolute sum in each series:
+        order = np.lexsort((np.abs(cluster_sums), cluster_series))
+        last = np.append(cluster_series[order][1:] != cluster_series[order][:-1], True)
+        best_series = cluster_series[order][last]
+        best_sums = cluster_sums[order][last]
+        replace = np.abs(best_sums) > np.abs(max_sums[best_series])
+        max_sums[best_series[replace]] = best_sums[replace]
+    return max_sums
+
+
 def generate_gaze_map(epochs, height, width, sigma=5, eyes=None):
     """
     This function takes in the eyetracker data in the mne epochs object and generates gaze maps. This is highly inspired
@@ -982,8 +1493,6 @@ def cluster_test(x_obs, null_dist, z_threshold=None, adjacency=None, tail=1, max
     if x_obs.shape != null_dist.shape[1:]:
         raise Exception("The dimension of the observed matrix and null distribution are inconsistent!")
 
-    # Get the original shape:
-    sample_shape = x_obs.shape
     # Get the number of tests:
     n_tests = np.prod(x_obs.shape)
 
@@ -1004,6 +1513,46 @@ def cluster_test(x_obs, null_dist, z_threshold=None, adjacency=None, tail=1, max
     else:
         include = None
 
+    def null_max_stats(this_include):
+        # Find the clusters in the null distribution:
+        _, surr_clust_sum = zip(*[_find_clusters(mat, z_threshold, tail, adjacency,
+                                                 max_step=max_step, include=this_include,
+                                                 partitions=None, t_power=t_power,
+                                                 show_info=True) for mat in h0_zscore])
+        # Compute the max of each surrogate clusters:
+        return [np.max(arr) if len(arr) > 0 else 0 for arr in surr_clust_sum]
+
+    clusters, cluster_pv, p_values, h0 = _cluster_step_down(x_zscored, null_max_stats, z_threshold=z_threshold,
+                                                            adjacency=adjacency, tail=tail, max_step=max_step,
+                                                            include=include, t_power=t_power,
+                                                            step_down_p=step_down_p)
+    return x_zscored, h0_zscore, clusters, cluster_pv, p_values, h0
+
+
+def _cluster_step_down(x_zscored, null_max_stats, z_threshold=None, adjacency=None, tail=1, max_step=None,
+                       include=None, t_power=1, step_down_p=0.05):
+    """
+    This function clusters the observed data and computes the p-value of each cluster with respect to the max cluster
+    sums of the null distribution, with the step-down-in-jumps procedure. It is shared by cluster_test and
+    cluster_test_stream, which only differ in how the null distribution is clustered.
+    :param x_zscored: (1 or 2D array) observed values z scored
+    :param null_max_stats: (callable) called as null_max_stats(include) and returning the max cluster sum of each
+    (z scored) null map, computed only on the samples where include is True (all samples if include is None)
+    :param z_threshold: see cluster_test
+    :param adjacency: see cluster_test
+    :param tail: see cluster_test
+    :param max_step: see cluster_test
+    :param include: (bool array or None) samples to include in the analysis
+    :param t_power: see cluster_test
+    :param step_down_p: see cluster_test
+    :return:
+    clusters: (list) List type defined by out_type above.
+    cluster_pv: (array) P-value for each cluster.
+    p_values: (x.shape np.array) p value for each observed value
+    H0: (array) Max cluster level stats observed under permutation.
+    """
+    sample_shape = x_zscored.shape
+    n_tests = np.prod(sample_shape)
     # Step 2: Cluster the observed data:
     # -------------------------------------------------------------
     print("Finding the cluster in the observed data:")
@@ -1021,7 +1570,7 @@ def cluster_test(x_obs, null_dist, z_threshold=None, adjacency=None, tail=1, max
     # Compute the clusters for the null distribution:
     if len(clusters) == 0:
         print('No clusters found, returning empty H0, clusters, and cluster_pv')
-        return x_zscored, h0_zscore, np.array([]), np.array([]), np.array([]), np.array([])
+        return np.array([]), np.array([]), np.array([]), np.array([])
 
     # Step 3: repeat permutations for step-down-in-jumps procedure
     # -------------------------------------------------------------
@@ -1039,13 +1588,8 @@ def cluster_test(x_obs, null_dist, z_threshold=None, adjacency=None, tail=1, max
                 this_include = include
         else:
             this_include = step_down_include
-        # Find the clusters in the null distribution:
-        _, surr_clust_sum = zip(*[_find_clusters(mat, z_threshold, tail, adjacency,
-                                                 max_step=max_step, include=this_include,
-                                                 partitions=None, t_power=t_power,
-                                                 show_info=True) for mat in h0_zscore])
-        # Compute the max of each surrogate clusters:
-        h0 = [np.max(arr) if len(arr) > 0 else 0 for arr in surr_clust_sum]
+        # Compute the max cluster sum of each null map:
+        h0 = list(null_max_stats(this_include))
         # Get the original value:
         if tail == -1:  # up tail
             orig = cluster_stats.min()
@@ -1073,14 +1617,244 @@ def cluster_test(x_obs, null_dist, z_threshold=None, adjacency=None, tail=1, max
     # The clusters should have the same shape as the samples
     clusters = _reshape_clusters(clusters, sample_shape)
     # format p_values to get same dimensionality as X
-    p_values_ = np.ones_like(x_obs).T
+    p_values_ = np.ones_like(x_zscored).T
     for cluster, pval in zip(clusters, cluster_pv):
         if isinstance(cluster, np.ndarray):
             p_values_[cluster.T] = pval
         elif isinstance(cluster, tuple):
             p_values_[cluster] = pval
 
-    return x_zscored, h0_zscore, clusters, cluster_pv, p_values_.T, h0
+    return clusters, cluster_pv, p_values_.T, h0
+
+
+def iter_null_chunks(null_dist, sample_ndim, chunk_size=100):
+    """
+    This function iterates over a null distribution in chunks of permutations, such that the whole null distribution
+    never has to be loaded in memory at once. The null distribution can be:
+        - a numpy array or memory mapped numpy array of shape [n, p, (q)]
+        - a path to a .npy file, which gets memory mapped
+        - an HDF5 (h5py) or zarr dataset of shape [n, p, (q)]. Any object supporting .shape and slicing along the first
+        dimension works
+        - a callable (generator function) returning an iterator over single null maps [p, (q)] or chunks of null maps
+        [k, p, (q)]. A callable is needed rather than a generator because the null distribution must be read several
+        times
+    :param null_dist: (see above) null distribution
+    :param sample_ndim: (int) number of dimensions of a single null map
+    :param chunk_size: (int) number of permutations to read at once from array-like null distributions
+    :return: (generator) yields float arrays of shape [k, p, (q)]
+    """
+    if isinstance(null_dist, (str, Path)):
+        null_dist = np.load(null_dist, mmap_mode="r")
+    if callable(null_dist):
+        for null_chunk in null_dist():
+            null_chunk = np.asarray(null_chunk, dtype=float)
+            if null_chunk.ndim == sample_ndim:
+                null_chunk = null_chunk[None]
+            yield null_chunk
+    elif hasattr(null_dist, "shape"):
+        for start in range(0, null_dist.shape[0], chunk_size):
+            yield np.asarray(null_dist[start:start + chunk_size], dtype=float)
+    else:
+        raise TypeError("The null distribution must be an array like object, a path to a .npy file or a callable "
+                        "returning an iterator over the null maps! Generators can only be read once, pass the "
+                        "generator function instead.")
+
+
+def merge_moments(n, mean, m2, chunk):
+    """
+    This function updates running moments (count, mean and M2) with a new chunk of observations along the first
+    dimension.
+    :param n: (int) number of observations so far
+    :param mean: (np.array) running mean
+    :param m2: (np.array) running sum of squared deviations from the mean
+    :param chunk: (np.array) new observations, first dimension being the observations
+    :return: n, mean, m2 updated
+    """
+    k = chunk.shape[0]
+    if k == 0:
+        return n, mean, m2
+    chunk_mean = np.mean(chunk, axis=0)
+    chunk_m2 = np.sum((chunk - chunk_mean) ** 2, axis=0)
+    n_tot = n + k
+    delta = chunk_mean - mean
+    mean = mean + delta * k / n_tot
+    m2 = m2 + chunk_m2 + delta ** 2 * n * k / n_tot
+    return n_tot, mean, m2
+
+
+class NullAccumulator:
+    """
+    This class accumulates fixed size summaries of a null distribution streamed permutation by permutation (or chunk
+    by chunk), such that the raw permutations x samples array never needs to be kept in memory:
+        - the running mean and variance of each sample across permutations (used for z scoring)
+        - the distribution of the max statistic (i.e. max cluster sum) of each permutation (used for the p-values)
+        - optionally, a histogram of the null values of each sample with fixed bins (used for plotting the null
+        distribution), identical to np.histogram2d(values, sample index) with the same bins and range
+    :param sample_shape: (tuple) shape of a single null map, e.g. (n_times,)
+    :param hist_bins: (int or None) number of bins of the per sample histogram. If None, no histogram is computed
+    :param hist_range: (list of 2 floats) range of the histogram bins, values outside of the range are ignored
+    """
+
+    def __init__(self, sample_shape, hist_bins=None, hist_range=(-1, 1)):
+        self.sample_shape = tuple(sample_shape)
+        self.n = 0
+        self.mean = np.zeros(self.sample_shape)
+        self.m2 = np.zeros(self.sample_shape)
+        self.max_stats = []
+        if hist_bins is not None:
+            self.hist_edges = np.linspace(hist_range[0], hist_range[1], hist_bins + 1)
+            self.hist = np.zeros((hist_bins,) + self.sample_shape)
+        else:
+            self.hist_edges = None
+            self.hist = None
+
+    @property
+    def var(self):
+        """Variance of each sample across the permutations accumulated so far."""
+        return self.m2 / self.n
+
+    @property
+    def std(self):
+        """Standard deviation of each sample across the permutations accumulated so far."""
+        return np.sqrt(self.var)
+
+    @property
+    def h0(self):
+        """Max statistics of each permutation accumulated so far."""
+        return np.array(self.max_stats)
+
+    def update(self, null_chunk):
+        """
+        This function adds a chunk of null maps to the running moments and histogram.
+        :param null_chunk: (np.array) null maps, the first dimension being the permutations
+        :return:
+        """
+        null_chunk = np.asarray(null_chunk)
+        if null_chunk.shape[1:] != self.sample_shape:
+            raise Exception("The dimension of the observed matrix and null distribution are inconsistent!")
+        self.n, self.mean, self.m2 = merge_moments(self.n, self.mean, self.m2, null_chunk)
+        if self.hist is not None:
+            n_bins = self.hist.shape[0]
+            # Find the bin of each value (same convention as np.histogram: the last bin includes the right edge):
+            bins = np.searchsorted(self.hist_edges, null_chunk, side="right") - 1
+            bins[null_chunk == self.hist_edges[-1]] = n_bins - 1
+            in_range = (bins >= 0) & (bins < n_bins)
+            # Count the values of each bin of each sample at once:
+            sample_ind = np.broadcast_to(np.arange(np.prod(self.sample_shape)).reshape(self.sample_shape),
+                                         null_chunk.shape)
+            flat_ind = bins[in_range] * int(np.prod(self.sample_shape)) + sample_ind[in_range]
+            self.hist += np.bincount(flat_ind, minlength=self.hist.size).reshape(self.hist.shape)
+
+    def add_max_stat(self, value):
+        """
+        This function appends the max statistic of a permutation to the max statistic distribution.
+        :param value: (float) max statistic of one permutation
+        :return:
+        """
+        self.max_stats.append(value)
+
+    def reset_max_stats(self):
+        """
+        This function clears the max statistic distribution (e.g. before a new step down iteration).
+        :return:
+        """
+        self.max_stats = []
+
+    def pvalues(self, stats, tail=1, orig=None):
+        """
+        This function computes the p-values of observed statistics with respect to the max statistic distribution.
+        :param stats: (np.array) observed statistics (e.g. cluster sums)
+        :param tail: (int) 1 for upper tail, -1 lower tail, 0 two tailed
+        :param orig: (float or None) max statistic of the observed data, added to the null distribution if passed
+        :return: (np.array) p-value of each statistic
+        """
+        h0 = self.h0
+        if orig is not None:
+            h0 = np.insert(h0, 0, orig)
+        return _pval_from_histogram(stats, h0, tail)
+
+
+def cluster_test_stream(x_obs, null_dist, z_threshold=None, adjacency=None, tail=1, max_step=None, exclude=None,
+                        t_power=1, step_down_p=0.05, do_zscore=True, chunk_size=100, hist_bins=None,
+                        hist_range=(-1, 1)):
+    """
+    Streaming version of cluster_test for null distributions that do not fit in memory (gaze maps, temporal
+    generalization matrices...). The null distribution is never loaded as a whole: in a first pass, the moments
+    required for the z scoring are accumulated chunk by chunk. In a second pass, each null map is z scored and
+    clustered on the fly and only its max cluster sum is kept. Memory usage is therefore O(p * q) instead of
+    O(n * p * q). The results are the same as cluster_test, except that the z scored null distribution is replaced by
+    a NullAccumulator holding fixed size summaries of the null distribution (moments, max cluster sums and optionally
+    a histogram of the null values of each sample for plotting).
+    :param x_obs: (1 or 2D array) contains the observed data for which to compute the cluster based permutation test
+    :param null_dist: null distribution of shape [n, p, (q)]. Can be a numpy array, a memory mapped array, a path to
+    a .npy file, an HDF5 or zarr dataset or a callable returning an iterator over the null maps (see iter_null_chunks)
+    :param z_threshold: (float) z score threshold for something to be considered eligible for a cluster
+    :param adjacency: (scipy.sparse.spmatrix | None | False) see cluster_test
+    :param tail: (int) 1 for upper tail, -1 lower tail, 0 two tailed
+    :param max_step: (int) see cluster_test
+    :param exclude: (bool array or None) array of same dim as x for excluding specific parts of the matrix from analysis
+    :param t_power: (float) power by which to raise the z score by
+    :param step_down_p: (float) To perform a step-down-in-jumps test, pass a p-value for clusters to exclude from each
+    successive iteration. Each step down iteration requires an additional pass over the null distribution
+    :param do_zscore: (boolean) if the data are zscores already, don't redo the z transform
+    :param chunk_size: (int) number of permutations to read at once from array-like null distributions
+    :param hist_bins: (int or None) number of bins of the per sample histogram of the (raw) null distribution
+    :param hist_range: (list of 2 floats) range of the histogram
+    :return:
+    x_zscored: (x.shape np.array) observed values z scored
+    null_acc: (NullAccumulator) summaries of the null distribution, the z scored null distribution is not retained
+    clusters: (list) List type defined by out_type above.
+    cluster_pv: (array) P-value for each cluster.
+    p_values: (x.shape np.array) p value for each observed value
+    H0: (array) Max cluster level stats observed under permutation.
+    """
+    print("=" * 40)
+    print("Welcome to cluster_test_stream")
+    # Get the original shape:
+    sample_shape = x_obs.shape
+    # Get the number of tests:
+    n_tests = np.prod(x_obs.shape)
+
+    if (exclude is not None) and not exclude.size == n_tests:
+        raise ValueError('exclude must be the same shape as X[0]')
+    # Step 1: Streaming pass to compute the z scoring moments (and histogram)
+    # -------------------------------------------------------------
+    print("Computing the null distribution moments:")
+    null_acc = NullAccumulator(sample_shape, hist_bins=hist_bins, hist_range=hist_range)
+    for null_chunk in iter_null_chunks(null_dist, len(sample_shape), chunk_size=chunk_size):
+        null_acc.update(null_chunk)
+    if do_zscore:
+        # The observed data are z scored with respect to the null distribution only:
+        x_zscored = (x_obs - null_acc.mean) / null_acc.std
+        # The null distribution is z scored with respect to the null and the observed data together:
+        n_all, all_mean, all_m2 = merge_moments(null_acc.n, null_acc.mean, null_acc.m2, x_obs[None])
+        all_std = np.sqrt(all_m2 / n_all)
+    else:
+        x_zscored = x_obs
+        all_mean, all_std = 0, 1
+
+    if exclude is not None:
+        include = np.logical_not(exclude)
+    else:
+        include = None
+
+    def null_max_stats(this_include):
+        # Z score and cluster each null map on the fly, keeping only the max cluster sum:
+        null_acc.reset_max_stats()
+        for null_chunk in iter_null_chunks(null_dist, len(sample_shape), chunk_size=chunk_size):
+            for mat in (null_chunk - all_mean) / all_std:
+                _, surr_clust_sum = _find_clusters(mat, z_threshold, tail, adjacency,
+                                                   max_step=max_step, include=this_include,
+                                                   partitions=None, t_power=t_power,
+                                                   show_info=True)
+                null_acc.add_max_stat(np.max(surr_clust_sum) if len(surr_clust_sum) > 0 else 0)
+        return null_acc.h0
+
+    clusters, cluster_pv, p_values, h0 = _cluster_step_down(x_zscored, null_max_stats, z_threshold=z_threshold,
+                                                            adjacency=adjacency, tail=tail, max_step=max_step,
+                                                            include=include, t_power=t_power,
+                                                            step_down_p=step_down_p)
+    return x_zscored, null_acc, clusters, cluster_pv, p_values, h0
 
 
 def zscore_mat(x, h0, axis=0):
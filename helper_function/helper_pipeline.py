@@ -0,0 +1,465 @@
+import os
+import glob
+import json
+import time
+import pickle
+import hashlib
+import inspect
+import mne
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from helper_function.helper_general import equate_epochs_events, reject_bad_epochs, baseline_scaling
+
+# Version of the analysis cache, part of the key of the cache entries together with the source code of the functions
+# of the preparation chain (see load_analysis_epochs). Increase it when a function they call changes the results:
+ANALYSIS_CACHE_VERSION = 1
+
+
+def param_hash(obj):
+    """
+    This function computes a short hash of any json serializable object (parameters dictionaries, lists...). The keys
+    are sorted so that the hash doesn't depend on the order in which the parameters were written.
+    :param obj: (any json serializable object) object to hash. numpy arrays and scalars are converted to lists and
+    python scalars
+    :return: (string) 16 characters hexadecimal hash
+    """
+    def to_json(val):
+        if isinstance(val, np.ndarray):
+            return val.tolist()
+        if isinstance(val, np.generic):
+            return val.item()
+        return str(val)
+    return hashlib.sha1(json.dumps(obj, sort_keys=True, default=to_json).encode()).hexdigest()[:16]
+
+
+def get_param(param, key):
+    """
+    This function gets an entry of a nested parameters dictionary.
+    :param param: (dict) parameters
+    :param key: (string) key of the entry, nested keys being separated by dots (e.g. "epochs.metadata_column")
+    :return: the value of the entry, None if it doesn't exist
+    """
+    val = param
+    for sub_key in key.split("."):
+        if not isinstance(val, dict) or sub_key not in val:
+            return None
+        val = val[sub_key]
+    return val
+
+
+class PipelineStep:
+    """
+    This class describes a step of a pipeline: the function to run, the entries of the state the step reads and
+    writes and the entries of the parameters it depends on.
+    :param name: (string) name of the step, as found in the list of steps to run
+    :param func: (callable) function of the step, called as func(state, param) and returning the updated state (dict)
+    :param inputs: (list of strings) entries of the state required by the step
+    :param outputs: (list of strings) entries of the state created or modified by the step
+    :param params: (list of strings) entries of the parameters the step depends on. Nested entries are separated by
+    dots (e.g. "epochs.metadata_column"). Default to [name]
+    :param checkpoint: (bool) whether to save the state after this step. Steps that are fast compared to saving and
+    loading the data are better left without checkpoint
+    :param version: (int) version of the step function, part of the hash of the step. Increase it whenever the code of
+    the step changes, so that the checkpoints computed with the previous code are not reused
+    :param fmt: (string) precision in which the MNE objects of the checkpoint are saved, "double" or "single". Single
+    precision halves the size of the checkpoint, but resuming from it gives float32-rounded data that a fresh run
+    doesn't: only use it for steps whose outputs are not used in further computations
+    """
+
+    def __init__(self, name, func, inputs=None, outputs=None, params=None, checkpoint=True, version=1, fmt="double"):
+        self.name = name
+        self.func = func
+        self.inputs = [] if inputs is None else list(inputs)
+        self.outputs = [] if outputs is None else list(outputs)
+        self.params = [name] if params is None else list(params)
+        self.checkpoint = checkpoint
+        self.version = version
+        self.fmt = fmt
+
+
+class StepRegistry:
+    """
+    This class registers the steps of a pipeline and runs a sequence of them, saving the state after each step in a
+    checkpoint identified by a hash of the parameters and code version of this step and of all the steps before it.
+    When the pipeline is run again, it resumes from the deepest checkpoint whose hash is still valid: changing the
+    parameters (or the version) of a step only re-runs this step and the ones after it.
+    The state is a dictionary. MNE raw and epochs objects are saved as fif files (in the precision of the step),
+    everything else is pickled.
+    """
+
+    def __init__(self):
+        self.steps = {}
+
+    def __contains__(self, name):
+        return name in self.steps
+
+    def __getitem__(self, name):
+        return self.steps[name]
+
+    def add(self, name, func, inputs=None, outputs=None, params=None, checkpoint=True, version=1, fmt="double"):
+        """
+        This function registers a step, see PipelineStep.
+        :return:
+        """
+        if name in self.steps:
+            raise ValueError("The step {} is already registered!".format(name))
+        self.steps[name] = PipelineStep(name, func, inputs=inputs, outputs=outputs, params=params,
+                                        checkpoint=checkpoint, version=version, fmt=fmt)
+
+    def step_hashes(self, steps, param, root_key=None):
+        """
+        This function computes the hash of each step, chaining the hash of the previous step with the version, the
+        checkpoint precision and the parameters of the current one.
+        :param steps: (list of strings) name of the steps to run, in order
+        :param param: (dict) parameters of the pipeline
+        :param root_key: (any json serializable object) identifies the input of the pipeline (subject, session...)
+        :return: (list of strings) hash of each step
+        """
+        hashes = []
+        prev_hash = param_hash(root_key)
+        for name in steps:
+            step = self.steps[name]
+            prev_hash = param_hash([prev_hash, name, step.version, step.fmt,
+                                    {key: get_param(param, key) for key in step.params}])
+            hashes.append(prev_hash)
+        return hashes
+
+    def run(self, steps, state, param, checkpoint_dir=None, root_key=None, callback=None, verbose=True):
+        """
+        This function runs the steps in order, resuming from the deepest valid checkpoint if any.
+        :param steps: (list of strings) name of the steps to run, in order
+        :param state: (dict) initial state of the pipeline, passed to the first step
+        :param param: (dict) parameters of the pipeline
+        :param checkpoint_dir: (string or Path) directory in which the checkpoints are saved. If None, nothing is saved
+        and all the steps are run
+        :param root_key: (any json serializable object) identifies the input of the pipeline (subject, session...)
+        :param callback: (callable) function called as callback(state, name) after each step that was run
+        :param verbose: (bool) whether to print the timing report
+        :return:
+        state: (dict) state after the last step
+        timing: (pandas data frame) for each step, its hash, whether it was run or loaded from a checkpoint and the
+        time it took
+        """
+        unknown = [name for name in steps if name not in self.steps]
+        if len(unknown) > 0:
+            raise ValueError("The steps {} are not registered!".format(unknown))
+        hashes = self.step_hashes(steps, param, root_key=root_key)
+        if checkpoint_dir is not None and not os.path.isdir(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+
+        # Find the deepest valid checkpoint:
+        start = 0
+        if checkpoint_dir is not None:
+            for step_i in range(len(steps) - 1, -1, -1):
+                if self.steps[steps[step_i]].checkpoint and \
+                        os.path.isfile(checkpoint_path(checkpoint_dir, steps[step_i], hashes[step_i]) + ".pkl"):
+                    t0 = time.perf_counter()
+                    state = load_checkpoint(checkpoint_path(checkpoint_dir, steps[step_i], hashes[step_i]))
+                    if verbose:
+                        print("Resuming from the checkpoint of step {} ({:.2f}sec)".format(
+                            steps[step_i], time.perf_counter() - t0))
+                    start = step_i + 1
+                    break
+
+        # Run the remaining steps:
+        timing = []
+        for step_i, name in enumerate(steps):
+            if step_i < start:
+                timing.append({"step": name, "hash": hashes[step_i], "status": "checkpoint", "duration": 0.0,
+                               "checkpoint_duration": 0.0})
+                continue
+            step = self.steps[name]
+            missing = [key for key in step.inputs if key not in state]
+            if len(missing) > 0:
+                raise KeyError("The step {} requires {}, which were not computed by the previous steps!".format(
+                    name, missing))
+            t0 = time.perf_counter()
+            state = step.func(state, param)
+            missing = [key for key in step.outputs if key not in state]
+            if len(missing) > 0:
+                raise KeyError("The step {} did not return {}!".format(name, missing))
+            if callback is not None:
+                callback(state, name)
+            duration = time.perf_counter() - t0
+            if checkpoint_dir is not None and step.checkpoint:
+                t0 = time.perf_counter()
+                save_checkpoint(state, checkpoint_path(checkpoint_dir, name, hashes[step_i]), fmt=step.fmt)
+                # Only keep the checkpoint of the current parameters for each step:
+                remove_checkpoints(checkpoint_dir, name, keep=hashes[step_i])
+                duration_save = time.perf_counter() - t0
+            else:
+                duration_save = 0.0
+            timing.append({"step": name, "hash": hashes[step_i], "status": "run", "duration": duration,
+                           "checkpoint_duration": duration_save})
+        timing = pd.DataFrame(timing)
+        if verbose:
+            print("=" * 40)
+            print("Pipeline timing:")
+            print(timing.to_string(index=False))
+        return state, timing
+
+
+def checkpoint_path(checkpoint_dir, name, step_hash):
+    """
+    This function returns the root of the file names of the checkpoint of a step.
+    :param checkpoint_dir: (string or Path) directory of the checkpoints
+    :param name: (string) name of the step
+    :param step_hash: (string) hash of the step
+    :return: (string) root of the checkpoint file names
+    """
+    return str(Path(checkpoint_dir, "{}_{}".format(name, step_hash)))
+
+
+def save_checkpoint(state, fname_root, fmt="double"):
+    """
+    This function saves the state of a pipeline. MNE raw and epochs objects are saved as fif files, by default in
+    double precision so that resuming gives the same results as running everything, and the remaining entries are
+    pickled. The pickle file is written last (through a temporary file) so that a checkpoint interrupted while saving is
+    never loaded.
+    :param state: (dict) state of the pipeline
+    :param fname_root: (string) root of the checkpoint file names, see checkpoint_path
+    :param fmt: (string) precision of the fif files, "double" or "single"
+    :return:
+    """
+    entries = {}
+    for key, val in state.items():
+        if isinstance(val, mne.io.BaseRaw):
+            fname = "{}_{}_raw.fif".format(fname_root, key)
+            val.save(fname, fmt=fmt, overwrite=True, verbose="ERROR")
+            entries[key] = ("raw", os.path.basename(fname))
+        elif isinstance(val, mne.BaseEpochs):
+            fname = "{}_{}-epo.fif".format(fname_root, key)
+            val.save(fname, fmt=fmt, overwrite=True, verbose="ERROR")
+            entries[key] = ("epochs", os.path.basename(fname))
+        else:
+            entries[key] = ("pickle", val)
+    with open(fname_root + ".pkl.tmp", "wb") as f:
+        pickle.dump(entries, f)
+    os.replace(fname_root + ".pkl.tmp", fname_root + ".pkl")
+
+
+def load_checkpoint(fname_root):
+    """
+    This function loads the state of a pipeline saved with save_checkpoint.
+    :param fname_root: (string) root of the checkpoint file names, see checkpoint_path
+    :return: (dict) state of the pipeline
+    """
+    with open(fname_root + ".pkl", "rb") as f:
+        entries = pickle.load(f)
+    state = {}
+    for key, (kind, val) in entries.items():
+        if kind == "raw":
+            state[key] = mne.io.read_raw_fif(Path(os.path.dirname(fname_root), val), preload=True, verbose="ERROR")
+        elif kind == "epochs":
+            state[key] = mne.read_epochs(Path(os.path.dirname(fname_root), val), preload=True, verbose="ERROR")
+        else:
+            state[key] = val
+    return state
+
+
+def remove_checkpoints(checkpoint_dir, name, keep=None):
+    """
+    This function deletes the checkpoints of a step, except the one with the hash to keep.
+    :param checkpoint_dir: (string or Path) directory of the checkpoints
+    :param name: (string) name of the step
+    :param keep: (string) hash of the checkpoint to keep
+    :return:
+    """
+    for fname in glob.glob(str(Path(checkpoint_dir, "{}_*".format(glob.escape(name))))):
+        # The file names are {name}_{hash}[_...], make sure the step name isn't the prefix of another step:
+        step_hash = os.path.basename(fname)[len(name) + 1:].split("_")[0].split(".")[0]
+        if len(step_hash) == 16 and step_hash != keep:
+            os.remove(fname)
+
+
+def epochs_source_files(bids_root, subject, session, task, data_type):
+    """
+    This function lists the preprocessed epochs files of a subject.
+    :param bids_root: (string or Path) root of the bids directory
+    :param subject: (string) subject ID
+    :param session: (string or list of strings) session(s) to load. The epochs of several sessions are concatenated
+    :param task: (string) task
+    :param data_type: (string) data type (i.e. eyetrack)
+    :return: (list of Path) epochs files, one per session
+    """
+    sessions = session if isinstance(session, list) else [session]
+    return [Path(bids_root, "derivatives", "preprocessing", "sub-" + subject, "ses-" + ses, data_type,
+                 "sub-{}_ses-{}_task-{}_{}_desc-epo.fif".format(subject, ses, task, data_type))
+            for ses in sessions]
+
+
+def prepare_analysis_epochs(bids_root, subject, session, task, data_type, decim_freq=None, conditions=None,
+                            crop=None, reject=None, picks=None, resample=None, baseline=None, baseline_window=None):
+    """
+    This function loads the preprocessed epochs of a subject and prepares them for the analyses. The steps are applied
+    in this order, each being skipped if the corresponding parameter is None:
+    read (concatenating sessions) > decimate > select conditions > crop > reject bad epochs > pick channels >
+    resample > baseline correction
+    :param bids_root: (string or Path) root of the bids directory
+    :param subject: (string) subject ID
+    :param session: (string or list of strings) session(s) to load. The epochs of several sessions are concatenated
+    after equating their events
+    :param task: (string) task
+    :param data_type: (string) data type (i.e. eyetrack)
+    :param decim_freq: (float) frequency to decimate the epochs to
+    :param conditions: (string or list of strings) conditions to select
+    :param crop: (list of 2 floats) tmin and tmax to crop the epochs to
+    :param reject: (dict) keyword arguments of reject_bad_epochs
+    :param picks: (list of strings or "pupil") channels to keep. "pupil" keeps the pupil channels of all the recorded
+    eyes
+    :param resample: (float) frequency to resample the epochs to
+    :param baseline: (string) correction method of baseline_scaling
+    :param baseline_window: (list of 2 floats) baseline window of baseline_scaling
+    :return: (mne epochs object) prepared epochs
+    """
+    # Read the epochs:
+    epochs = [mne.read_epochs(fname, verbose="ERROR")
+              for fname in epochs_source_files(bids_root, subject, session, task, data_type)]
+    if isinstance(session, list):
+        # Equate the epochs events.
+        epochs = equate_epochs_events(epochs)
+        epochs = mne.concatenate_epochs(epochs, add_offset=True, verbose="ERROR")
+    else:
+        epochs = epochs[0]
+    # Decimate:
+    if decim_freq is not None:
+        epochs.decimate(int(epochs.info["sfreq"] / decim_freq))
+    # Extract the relevant conditions:
+    if conditions is not None:
+        epochs = epochs[conditions]
+    # Crop the epochs:
+    if crop is not None:
+        epochs.crop(crop[0], crop[1])
+    # Reject bad epochs according to predefined criterion:
+    if reject is not None:
+        reject_bad_epochs(epochs, **reject)
+    # Extract the relevant channels:
+    if picks is not None:
+        if picks == "pupil":
+            eyes = [ch.split("_")[-1] for ch in epochs.ch_names if "pupil" in ch]
+            picks = [f"pupil_{eye}" for eye in eyes]
+        epochs.pick(picks)
+    # Downsample:
+    if resample is not None:
+        epochs.resample(resample)
+    # Baseline correction:
+    if baseline is not None:
+        baseline_scaling(epochs, correction_method=baseline, baseline=baseline_window)
+    return epochs
+
+
+def save_epochs_cache(epochs, fname_root):
+    """
+    This function saves epochs in the analysis cache: the data as a numpy array and everything needed to recreate the
+    epochs (info, events, metadata, drop log...) pickled next to it. The pickle file is written last (through a
+    temporary file) so that an entry interrupted while saving is never loaded.
+    :param epochs: (mne epochs object) epochs to save
+    :param fname_root: (string) root of the cache file names
+    :return:
+    """
+    with open(fname_root + "-epo.npy.tmp", "wb") as f:
+        np.save(f, epochs.get_data(picks="all", copy=False))
+    os.replace(fname_root + "-epo.npy.tmp", fname_root + "-epo.npy")
+    entries = {
+        "info": epochs.info,
+        "events": epochs.events,
+        "event_id": epochs.event_id,
+        "tmin": epochs.tmin,
+        "metadata": epochs.metadata,
+        "selection": epochs.selection,
+        "drop_log": epochs.drop_log,
+        "baseline": epochs.baseline,
+        "raw_sfreq": epochs._raw_sfreq
+    }
+    with open(fname_root + "-epo.pkl.tmp", "wb") as f:
+        pickle.dump(entries, f)
+    os.replace(fname_root + "-epo.pkl.tmp", fname_root + "-epo.pkl")
+
+
+def load_epochs_cache(fname_root):
+    """
+    This function loads epochs saved with save_epochs_cache.
+    :param fname_root: (string) root of the cache file names
+    :return: (mne epochs object) epochs
+    """
+    with open(fname_root + "-epo.pkl", "rb") as f:
+        entries = pickle.load(f)
+    # The data are already processed, the baseline and projectors must not be applied again:
+    epochs = mne.EpochsArray(np.load(fname_root + "-epo.npy"), entries["info"], events=entries["events"],
+                             tmin=entries["tmin"], event_id=entries["event_id"], baseline=None, proj=False,
+                             on_missing="ignore", metadata=entries["metadata"], selection=entries["selection"],
+                             drop_log=entries["drop_log"], raw_sfreq=entries["raw_sfreq"], verbose="ERROR")
+    epochs.baseline = entries["baseline"]
+    return epochs
+
+
+def load_analysis_epochs(bids_root, subject, session, task, data_type, cache_dir=None, verbose=True, **kwargs):
+    """
+    This function returns the epochs of a subject prepared with prepare_analysis_epochs, from the analysis cache when
+    they were already prepared with the same parameters. The cache entries are identified by a hash of the parameters,
+    of the size and modification time of the preprocessed epochs files, so that rerunning the preprocessing
+    invalidates them, and of the code of the preparation chain (ANALYSIS_CACHE_VERSION and the source code of
+    prepare_analysis_epochs, equate_epochs_events, reject_bad_epochs and baseline_scaling), so that changing it
+    invalidates them as well.
+    :param bids_root: (string or Path) root of the bids directory
+    :param subject: (string) subject ID
+    :param session: (string or list of strings) session(s) to load
+    :param task: (string) task
+    :param data_type: (string) data type (i.e. eyetrack)
+    :param cache_dir: (string or Path) directory of the cache. Default to derivatives/analysis_cache. If False, the
+    cache isn't used
+    :param verbose: (bool) whether to print where the epochs were loaded from
+    :param kwargs: parameters of prepare_analysis_epochs
+    :return: (mne epochs object) prepared epochs
+    """
+    if cache_dir is False:
+        return prepare_analysis_epochs(bids_root, subject, session, task, data_type, **kwargs)
+    if cache_dir is None:
+        cache_dir = Path(bids_root, "derivatives", "analysis_cache")
+    # Hash the parameters and the state of the source files:
+    sources = []
+    for fname in epochs_source_files(bids_root, subject, session, task, data_type):
+        stat = os.stat(fname)
+        sources.append([fname.name, stat.st_size, stat.st_mtime_ns])
+    chain = [prepare_analysis_epochs, equate_epochs_events, reject_bad_epochs, baseline_scaling]
+    code = [ANALYSIS_CACHE_VERSION] + [inspect.getsource(func) for func in chain]
+    key = param_hash([subject, session, task, data_type, kwargs, sources, code, mne.__version__])
+    cache_root = str(Path(cache_dir, "sub-" + subject, "sub-{}_task-{}_{}_{}".format(subject, task, data_type, key)))
+    if os.path.isfile(cache_root + "-epo.pkl"):
+        t0 = time.perf_counter()
+        epochs = load_epochs_cache(cache_root)
+        if verbose:
+            print("Loaded sub-{} from the analysis cache ({:.2f}sec)".format(subject, time.perf_counter() - t0))
+        return epochs
+    t0 = time.perf_counter()
+    epochs = prepare_analysis_epochs(bids_root, subject, session, task, data_type, **kwargs)
+    if not os.path.isdir(os.path.dirname(cache_root)):
+        os.makedirs(os.path.dirname(cache_root), exist_ok=True)
+    save_epochs_cache(epochs, cache_root)
+    if verbose:
+        print("Prepared sub-{} and saved it to the analysis cache ({:.2f}sec)".format(subject,
+                                                                                  time.perf_counter() - t0))
+    return epochs
+
+
+def load_subjects_epochs(bids_root, subjects, session, task, data_type, n_jobs=4, **kwargs):
+    """
+    This function loads the prepared epochs of several subjects in parallel, see load_analysis_epochs.
+    :param bids_root: (string or Path) root of the bids directory
+    :param subjects: (list of strings) subjects IDs
+    :param session: (string or list of strings) session(s) to load
+    :param task: (string) task
+    :param data_type: (string) data type (i.e. eyetrack)
+    :param n_jobs: (int) number of subjects loaded in parallel
+    :param kwargs: parameters of load_analysis_epochs and prepare_analysis_epochs
+    :return: (dict) prepared epochs of each subject, in the order of the subjects list
+    """
+    if n_jobs > 1:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            epochs = list(executor.map(lambda sub: load_analysis_epochs(bids_root, sub, session, task, data_type,
+                                                                        **kwargs), subjects))
+    else:
+        epochs = [load_analysis_epochs(bids_root, sub, session, task, data_type, **kwargs) for sub in subjects]
+    return dict(zip(subjects, epochs))
@@ -1,14 +1,19 @@
+import os
 import matplotlib
 import matplotlib.pyplot as plt
 from matplotlib.gridspec import GridSpec
 import matplotlib.patches as patches
 import numpy as np
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from helper_function.helper_general import get_event_ts
 from helper_function.helper_general import cousineau_morey_correction
 import environment_variables as ev
 from mne.stats import bootstrap_confidence_interval
+from mne.preprocessing.eyetracking import Calibration
 from scipy.ndimage import uniform_filter1d
 from helper_function.helper_general import get_cmap_rgb_values
+from helper_function.helper_qc_io import load_qc_summary
 
 font = {'size': 12}
 matplotlib.rc('font', **font)
@@ -498,3 +503,164 @@ def get_color_mapping(val_dict, color_map='Reds', max_prctile=None, min_prctile=
     cmap = plt.get_cmap(color_map)
     # Get the color of each ROI:
     return {key: mcolors.to_rgb(cmap(norm(val_dict[key]))) for key in val_dict.keys()}
+
+
+def plot_qc_summary(summary, save_root):
+    """
+    This function plots the quality checks of the preprocessing of one subject from the summary computed by
+    helper_preprocessing.compute_qc_summary: eyelink events rasters, blink counts and pupil responses per factor level,
+    gaze heatmap, baseline distribution, single trials pupil size and calibrations. The figures are saved to file.
+    :param summary: (dict) quality checks summary
+    :param save_root: (string or path object) directory in which to save the figures
+    :return: (list of path objects) saved figures
+    """
+    prefix = "sub-{}_ses-{}_task-{}_{}".format(summary["subject"], summary["session"], summary["task"],
+                                               summary["data_type"])
+    times, times_ds, eyes = summary["times"], summary["times_ds"], summary["eyes"]
+    extent = [times[0], times[-1], 0, summary["n_trials"]]
+    figures = []
+
+    def save_fig(desc):
+        figures.append(Path(save_root, "{}_desc-{}.png".format(prefix, desc)))
+        plt.savefig(figures[-1])
+        plt.close()
+
+    # Eyelink events rasters, one subplot per eye:
+    for evt, rasters in summary["rasters"].items():
+        fig, ax = plt.subplots(len(eyes))
+        ax = np.atleast_1d(ax)
+        for eye_i, eye in enumerate(eyes):
+            ax[eye_i].imshow(rasters[eye], aspect="auto", origin="lower", extent=extent)
+            if len(eyes) > 1:
+                ax[eye_i].set_title("{} eye".format(eye.capitalize()))
+        ax[-1].set_xlabel("Time (s)")
+        ax[-1].set_ylabel("Trials")
+        save_fig({"blink": "blinks", "saccade": "saccades"}.get(evt, evt))
+
+    # Blink counts per level of each factor:
+    if "blink_counts" in summary:
+        for factor, factor_info in summary["factors"].items():
+            fig, ax = plt.subplots()
+            for i, (lvl, mask) in enumerate(zip(factor_info["levels"], factor_info["masks"])):
+                if np.sum(mask) > 1:
+                    # Plot the blinks counts as a histogram, adding jitters to each condition to see them distinctively
+                    ax.hist(summary["blink_counts"][mask] + 0.2 * i, color=cwheel[i], alpha=0.3, label=lvl,
+                            rwidth=0.2)
+            ax.set_xlabel("Blinks counts")
+            ax.set_ylabel("Counts")
+            ax.legend()
+            ax.set_title(factor)
+            save_fig("blinks-{}".format(factor))
+
+    # Gaze heatmap:
+    width, height = summary["gaze"]["width"], summary["gaze"]["height"]
+    fig, ax = plt.subplots(constrained_layout=True)
+    im = ax.imshow(summary["gaze"]["heatmap"], aspect="equal", extent=[0, width, height, 0], origin="upper",
+                   vmin=np.nanmin(summary["gaze"]["heatmap"]), vmax=np.nanmax(summary["gaze"]["heatmap"]))
+    fig.colorbar(im, ax=ax, shrink=0.6, label="Dwell time (seconds)")
+    ax.set_title("Gaze heatmap")
+    ax.set_xlabel("X position")
+    ax.set_ylabel("Y position")
+    save_fig("gaze")
+
+    # Baseline distributions:
+    fig, ax = plt.subplots()
+    ax.hist(summary["baseline_zscore"], bins=50)
+    ax.vlines(x=-2, ymin=ax.get_ylim()[0], ymax=ax.get_ylim()[1], linestyle="-", color="r", linewidth=2, zorder=10)
+    ax.vlines(x=2, ymin=ax.get_ylim()[0], ymax=ax.get_ylim()[1], linestyle="-", color="r", linewidth=2, zorder=10)
+    ax.set_title("Baseline distributions")
+    ax.set_xlabel("z-score")
+    ax.set_ylabel("Trials counts")
+    save_fig("baseline_distribution")
+
+    # Pupil size per trial, before and after baseline correction:
+    for key, ylabel, desc in [("pupil", "Pupil size (a.u)", "pupil_lines"),
+                              ("pupil_bascorr", "Pupil size (%change)", "pupil_lines_bascorr")]:
+        fig, ax = plt.subplots()
+        ax.plot(times_ds, summary[key].T, alpha=0.5)
+        ax.set_title("Pupil size per trial")
+        ax.set_xlabel("Time (sec.)")
+        ax.set_ylabel(ylabel)
+        save_fig(desc)
+
+    # Pupil responses per level of each factor:
+    for factor, factor_info in summary["factors"].items():
+        fig, ax = plt.subplots()
+        for i, (lvl, mask) in enumerate(zip(factor_info["levels"], factor_info["masks"])):
+            # Plot Single trials:
+            ax.plot(times_ds, summary["pupil_bascorr"][mask].T, color=cwheel[i], alpha=0.3, linewidth=0.2)
+            # Plot evoked:
+            ax.plot(times, factor_info["evoked"][i], color=cwheel[i], label=lvl, linewidth=2, zorder=10000)
+        if len(factor_info["levels"]) == 2:
+            ax.plot(times, factor_info["evoked"][0] - factor_info["evoked"][1], color="r", label="diff",
+                    linewidth=2)
+        ax.set_xlabel("Times (sec.)")
+        ax.set_ylabel("Pupil size")
+        ax.legend()
+        ax.set_title(factor)
+        save_fig("pupil_{}".format(factor))
+
+    # Heatmap of the baseline corrected pupil size:
+    fig, ax = plt.subplots()
+    ax.imshow(summary["pupil_bascorr"], aspect="auto", origin="lower", extent=extent,
+              vmin=np.nanpercentile(summary["pupil_bascorr"], 5), vmax=np.nanpercentile(summary["pupil_bascorr"], 95))
+    ax.set_title("Pupil size")
+    ax.set_xlabel("Time (s)")
+    ax.set_ylabel("Trials")
+    save_fig("pupil_raster")
+
+    # Calibrations:
+    for calib_i, calib in summary["calibrations"].items():
+        try:
+            Calibration(**calib).plot(show=False)
+            figures.append(Path(save_root, "calibration-{}_task-{}_eye-{}.png".format(calib_i, summary["task"],
+                                                                                     calib['eye'])))
+            plt.savefig(figures[-1])
+            plt.close()
+        except ValueError:
+            print("WARNING: Could not plot the calibration!")
+    return figures
+
+
+def render_qc_summary(fname):
+    """
+    This function renders the quality checks figures of one summary file (see plot_qc_summary), in the same directory.
+    It is meant to be executed in a worker process of render_qc_reports.
+    :param fname: (string or path object) quality checks summary file (see helper_qc_io.save_qc_summary)
+    :return: (list of path objects) saved figures
+    """
+    # Figures are only saved to file, no need for an interactive backend in the workers:
+    plt.switch_backend("agg")
+    return plot_qc_summary(load_qc_summary(fname), Path(fname).parent)
+
+
+def render_qc_reports(summary_files, index_file, n_jobs=4):
+    """
+    This function renders the quality checks figures of several subjects in parallel in a pool of processes and
+    writes an html index of all the figures. Rendering the figures is decoupled from the preprocessing, which only saves
+    the quality checks summary of each subject.
+    :param summary_files: (list of strings or path objects) quality checks summary files
+    :param index_file: (string or path object) html file listing all the figures
+    :param n_jobs: (int) number of worker processes
+    :return: (dict) saved figures of each summary file
+    """
+    figures = {}
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        futures = {executor.submit(render_qc_summary, fname): fname for fname in summary_files}
+        for future in as_completed(futures):
+            try:
+                figures[futures[future]] = future.result()
+            except Exception as e:
+                print("Rendering {} FAILED: {}".format(futures[future], repr(e)))
+    # Write the index, one section per summary file:
+    index_dir = Path(index_file).parent
+    html = ["<html><head><title>Preprocessing quality checks</title></head><body>"]
+    for fname in sorted(figures, key=str):
+        html.append("<h2>{}</h2>".format(Path(fname).name.replace("_desc-qc.npz", "")))
+        for fig_file in figures[fname]:
+            html.append('<img src="{}" width="480" title="{}">'.format(
+                Path(os.path.relpath(fig_file, index_dir)).as_posix(), fig_file.name))
+    html.append("</body></html>")
+    with open(index_file, "w") as f:
+        f.write("\n".join(html))
+    return figures
@@ -1,13 +1,19 @@
 import os
 import re
+import json
+import hashlib
 import mne
 import numpy as np
 import pandas as pd
 from pathlib import Path
+from typing import NamedTuple
+from concurrent.futures import ThreadPoolExecutor
 from math import atan2, degrees
 from scipy.stats import zscore
+from scipy.ndimage import gaussian_filter
+from mne.baseline import rescale
 from helper_function.based_noise_blinks_detection import based_noise_blinks_detection
-from helper_function.helper_general import beh_exclusion
+from helper_function.helper_general import beh_exclusion, get_condition_mask, EpochsView
 
 show_checks = False
 
@@ -15,6 +21,9 @@ DFT_SCREEN_DIST_MM = 800
 
 DFT_SCREEN_SIZE_MM = [345,  195]
 
+# Preprocessing steps that add or modify annotations (interpolate_blinks renames the BAD_blink annotations):
+ANNOTATION_STEPS = ["annotate_nan", "hershman_blinks", "remove_long_blinks", "interpolate_blinks"]
+
 COG_TRIGGERS = {
     "1": "face_01",
     "2": "face_02",
@@ -129,39 +138,32 @@ def convert_cog_trig(raw):
     # Extract the event descriptions from the raw data annotations
     evt_dsc = np.array(raw.annotations.description.copy(), dtype="object")
 
-    # Find all the stimulus onset events
-    idxs = []
-    for val in [str(i + 1) for i in range(80)]:
-        idx = np.where(evt_dsc == val)[0]
-        if len(idx) > 0:
-            idxs.append(idx)
-
-    # Flatten and sort the array of indices
-    idxs = np.sort(np.concatenate(idxs, axis=0))
-
-    # Loop through each index to process trial events
-    for i, idx in enumerate(idxs):
-        # Determine the range of triggers for the current trial
-        if i == len(idxs) - 1:
-            trial_trig = evt_dsc[idx:]
-        else:
-            trial_trig = evt_dsc[idx:idxs[i + 1]]
-
-        # Filter for valid triggers based on predefined mapping
-        correct_triggers = [trig for trig in trial_trig if trig in COG_TRIGGERS.keys()]
-
-        # Ensure the trial contains exactly four triggers
-        if len(correct_triggers) != 4:
-            raise Exception("Something went wrong with the triggers!!!")
-
-        # Construct the stimulus identifier list
-        stim_id = ["vis_onset",
-                   COG_TRIGGERS[correct_triggers[0]].split("_")[0],
-                   COG_TRIGGERS[correct_triggers[0]]]
-        stim_id.extend([COG_TRIGGERS[trig] for trig in correct_triggers[1:]])
-        stim_id = "/".join(stim_id)
-        # Update the description of the event with the constructed identifier
-        evt_dsc[idx] = stim_id
+    # Map all the descriptions to the index of the trigger in COG_TRIGGERS (-1 for other events) in one pass:
+    trig_codes = list(COG_TRIGGERS.keys())
+    trig_names = np.array(list(COG_TRIGGERS.values()), dtype="object")
+    codes = pd.Series(evt_dsc).map({code: i for i, code in enumerate(trig_codes)}).fillna(-1).to_numpy(dtype=int)
+    # Keep only the valid triggers:
+    trig_ind = np.where(codes >= 0)[0]
+    codes = codes[trig_ind]
+    # Find all the stimulus onset events (triggers 1 to 80):
+    is_onset = np.isin(codes, [trig_codes.index(str(i + 1)) for i in range(80)])
+    if not np.any(is_onset):
+        raise ValueError("No stimulus onset triggers found!")
+    # Assign each trigger to the trial of the last stimulus onset (the triggers before the first onset are ignored):
+    trial = np.cumsum(is_onset) - 1
+    trig_ind, codes = trig_ind[trial >= 0], codes[trial >= 0]
+    # Ensure each trial contains exactly four triggers:
+    if np.any(np.bincount(trial[trial >= 0]) != 4):
+        raise Exception("Something went wrong with the triggers!!!")
+    # The triggers of each trial are now consecutive, one row per trial:
+    trial_names = trig_names[codes.reshape(-1, 4)]
+    # Construct the stimulus identifiers:
+    categories = np.array([name.split("_")[0] for name in trial_names[:, 0]], dtype="object")
+    stim_id = "vis_onset/" + categories
+    for col in range(4):
+        stim_id = stim_id + "/" + trial_names[:, col]
+    # Update the description of the onset events with the constructed identifiers:
+    evt_dsc[trig_ind[0::4]] = stim_id
     raw.annotations.description = evt_dsc
 
     return raw
@@ -199,7 +201,7 @@ def format_summary_table(summary_dict):
     return pd.concat(preprocessing_summary_df).reset_index(drop=True)
 
 
-def reject_bad_epochs(epochs, baseline_window=None, z_thresh=2, eyes=None, exlude_beh=True):
+def reject_bad_epochs(epochs, baseline_window=None, z_thresh=2, eyes=None, exlude_beh=True, view=None):
     """
     This function rejects epochs based on the zscore of the baseline. For some trials, there may be artifacts
     in the baseline, in which case baseline correction will spread the artifact. Such epochs are discarded.
@@ -208,6 +210,8 @@ def reject_bad_epochs(epochs, baseline_window=None, z_thresh=2, eyes=None, exlud
     :param z_thresh:
     :param eyes:
     :param exlude_beh:
+    :param view: (EpochsView or None) view of the epochs data containing the pupil channels, to avoid extracting the
+    data again. Extracted from the epochs if None
     return:
         - epochs:
         - n rejected trials:
@@ -232,9 +236,11 @@ def reject_bad_epochs(epochs, baseline_window=None, z_thresh=2, eyes=None, exlud
     # Extract the data:
     if z_thresh is not None:
         print("     Rejecting trials with artifactual baseline: ")
-        baseline_data = epochs.copy().crop(tmin=baseline_window[0],
-                                           tmax=baseline_window[1]).get_data(picks=["_".join(["pupil", eye])
-                                                                                    for eye in eyes])
+        pupil_picks = ["_".join(["pupil", eye]) for eye in eyes]
+        if view is None:
+            view = EpochsView(epochs, picks=pupil_picks)
+        baseline_data = view.align(epochs).get_data(picks=pupil_picks, tmin=baseline_window[0],
+                                                    tmax=baseline_window[1])
         # Compute the average across eyes and time:
         baseline_avg = np.mean(np.mean(baseline_data, axis=1), axis=1)
         # Z score:
@@ -259,42 +265,36 @@ def annotate_nan(raw, nan_annotation="BAD_nan", eyes=None):
     """
     if eyes is None:
         eyes = ["left", "right"]
+    # Extract the data of all eyes at once:
+    data = np.atleast_2d(raw.get_data(picks=["pupil_{}".format(eye) for eye in eyes]))
+    onsets, durations, ch_names = [], [], []
     # Loop through each eye:
-    for eye in eyes:
-        # Extract the data:
-        data = np.squeeze(raw.copy().pick("pupil_{}".format(eye)).get_data())
-        # Get the nan:
-        nan_mask = np.isnan(data).astype(float)
-        # Compute the diff to get the onset and offsets:
-        nan_diff = np.diff(nan_mask)
-        # Extract the onsets and offsets:
-        onsets = raw.times[np.where(nan_diff == 1)[0]]
-        offsets = raw.times[np.where(nan_diff == -1)[0]]
-        # Compute duration:
-        if onsets.shape[0] > 0:
-            if onsets.shape[0] != offsets.shape[0]:
-                if onsets.shape[0] == offsets.shape[0] + 1:
-                    offsets = raw.times[-1]
-
-                else:
-                    raise Exception("Different numbers of onsets and offsets!")
-            duration = offsets - onsets
-            # Create annotations accordingly:
-            nan_annotations = mne.Annotations(
-                onset=onsets,
-                duration=duration,
-                description=[nan_annotation] * len(onsets),
-                ch_names=[('xpos_' + eye, 'ypos_' + eye, 'pupil_' + eye)] * len(onsets),
-                orig_time=raw.annotations.orig_time
-            )
-            # Combine the annotations with the raw:
-            raw.set_annotations(raw.annotations + nan_annotations)
+    for eye_i, eye in enumerate(eyes):
+        # Get the start and stop of each stretch of nan:
+        starts, stops = mask_to_intervals(np.isnan(data[eye_i]))
+        # The onsets are marked on the last sample before the nan (or the first sample if the data start with nan)
+        # and the offsets on the last nan sample:
+        eye_onsets = raw.times[np.maximum(starts - 1, 0)]
+        onsets.append(eye_onsets)
+        durations.append(raw.times[stops - 1] - eye_onsets)
+        ch_names.extend([('xpos_' + eye, 'ypos_' + eye, 'pupil_' + eye)] * len(starts))
+    if len(ch_names) > 0:
+        # Create annotations accordingly:
+        nan_annotations = mne.Annotations(
+            onset=np.concatenate(onsets),
+            duration=np.concatenate(durations),
+            description=[nan_annotation] * len(ch_names),
+            ch_names=ch_names,
+            orig_time=raw.annotations.orig_time
+        )
+        # Combine the annotations with the raw:
+        raw.set_annotations(raw.annotations + nan_annotations)
 
     # Return the raw:
     return raw
 
 
-def load_cog_eyetracker(bids_root, subject, session, task, verbose=False, debug=False):
+def load_cog_eyetracker(bids_root, subject, session, task, verbose=False, debug=False, use_cache=True):
     """
     This functions loads the eyetracking data using mne python function. In addition, it loads the log files from the
     raw root to extract additional information. For a few subjects, some triggers weren't received by the eyetracker
@@ -309,6 +309,7 @@ def load_cog_eyetracker(bids_root, subject, session, task, verbose=False, debug=
     :param event_of_interest: (string) identifier of the events of interest
     :param verbose: (bool) verbose
     :para debug: (bool) debug mode loads only 2 files
+    :param use_cache: (bool) whether to load the parsed ascii files from the cache (see read_eyelink_cached)
     :return:
     """
     # Load all the files:
@@ -321,6 +322,7 @@ def load_cog_eyetracker(bids_root, subject, session, task, verbose=False, debug=
 
     # Create the files roots:
     et_root = Path(bids_root, "sub-" + subject, "ses-" + session, "eyetrack")
+    cache_dir = Path(bids_root, "derivatives", "asc_cache", "sub-" + subject, "ses-" + session) if use_cache else None
 
     # ===================================================================================
     # Load the eyetracking data and ensure that the log files match:
@@ -335,7 +337,9 @@ def load_cog_eyetracker(bids_root, subject, session, task, verbose=False, debug=
             run_i = int(re.search(r'run-(\d{2})', fl).group(1))
 
             try:
-                raw = mne.io.read_raw_eyelink(Path(et_root, fl), verbose=verbose)
+                raw, calib, screen_dist, screen_size, screen_res = read_eyelink_cached(Path(et_root, fl),
+                                                                                      cache_dir=cache_dir,
+                                                                                      verbose=verbose)
             except ValueError:
                 print("The data in sub-{}, ses-{}, task-{} and run-{} are unreadable".format(subject,
                                                                                              session,
@@ -346,7 +350,6 @@ def load_cog_eyetracker(bids_root, subject, session, task, verbose=False, debug=
             # Add the triggers:
             raw = convert_cog_trig(raw)
             raws.append(raw)
-            calib, screen_dist, screen_size, screen_res = read_calib(Path(et_root, fl))
             calibs.append(calib)
             screen_distances.append(screen_dist)
             screen_sizes.append(screen_size)
@@ -362,8 +365,149 @@ def load_cog_eyetracker(bids_root, subject, session, task, verbose=False, debug=
     return raws, calibs, screen_size, screen_distance, screen_res
 
 
+def encode_identities(*sequences):
+    """
+    This function encodes several sequences of identities (strings, numbers...) as integer arrays sharing the same
+    code book, so that they can be compared with fast array operations.
+    :param sequences: (lists or arrays) sequences of identities to encode
+    :return: (list of 1D int arrays) the encoded sequences, in the same order as the input
+    """
+    lengths = [len(seq) for seq in sequences]
+    codes, _ = pd.factorize(pd.Series(np.concatenate([np.asarray(seq, dtype=object) for seq in sequences])))
+    return np.split(codes.astype(int), np.cumsum(lengths)[:-1])
+
+
+def find_subsequence(pattern, sequence):
+    """
+    This function finds the first position at which pattern occurs as a contiguous block of sequence using the
+    Knuth-Morris-Pratt algorithm, which runs in linear time (O(n + m)) as opposed to comparing the pattern against every
+    slice of the sequence (O(n * m)).
+    :param pattern: (1D array or list) the sequence to look for
+    :param sequence: (1D array or list) the sequence in which to look for pattern
+    :return: (int) index of the first element of the first occurrence of the pattern in the sequence, -1 if not found
+    """
+    pattern = list(pattern)
+    sequence = list(sequence)
+    m = len(pattern)
+    if m == 0:
+        return 0
+    # Failure table: length of the longest proper prefix of pattern[:i + 1] that is also a suffix of it:
+    failure = [0] * m
+    k = 0
+    for i in range(1, m):
+        while k > 0 and pattern[i] != pattern[k]:
+            k = failure[k - 1]
+        if pattern[i] == pattern[k]:
+            k += 1
+        failure[i] = k
+    # Scan the sequence:
+    k = 0
+    for i, val in enumerate(sequence):
+        while k > 0 and val != pattern[k]:
+            k = failure[k - 1]
+        if val == pattern[k]:
+            k += 1
+        if k == m:
+            return i - m + 1
+    return -1
+
+
+def banded_alignment(log_codes, trig_codes):
+    """
+    This function aligns a sequence of triggers to the (longer) sequence of events in the log file, assuming that the
+    triggers are the log events with some of them missing, anywhere in the sequence. Each trigger j is matched to the
+    log event j + d, where the offset d (number of log events skipped so far) can only increase and is bounded by the
+    number of missing triggers. The dynamic programming is therefore restricted to that band of offsets, and finds the
+    monotonic alignment with the fewest mismatching identities in O(n_triggers * n_missing).
+    When identities repeat, several alignments can have the same minimal cost (i.e. log [A, B, A, C] and triggers
+    [A, C] are matched equally well by [0, 3] and [2, 3]). The alignment is therefore backtracked twice, taking the
+    smallest and the largest optimal offsets: if both give the same mapping, the alignment is unique.
+    :param log_codes: (1D int array) encoded identities of the log file events
+    :param trig_codes: (1D int array) encoded identities of the triggers
+    :return:
+    mapping: (1D int array) index of the log event matched to each trigger (smallest optimal offsets)
+    n_mismatch: (int) number of triggers whose identity differs from the matched log event
+    alt_mapping: (1D int array) same as mapping, with the largest optimal offsets. Differs from mapping when the
+    alignment is ambiguous
+    """
+    n_log, n_trig = len(log_codes), len(trig_codes)
+    n_missing = n_log - n_trig
+    if n_missing < 0:
+        raise ValueError("The triggers sequence must not be longer than the log sequence!")
+    if n_trig == 0:
+        return np.array([], dtype=int), 0, np.array([], dtype=int)
+    # Mismatch between each trigger j and the log events j to j + n_missing:
+    mismatch = (np.lib.stride_tricks.sliding_window_view(log_codes, n_missing + 1)[:n_trig]
+                != trig_codes[:, None]).astype(int)
+    # Cumulated cost of the best alignment of triggers 0 to j with trigger j at offset d. Because the offsets can only
+    # increase, the best previous alignment is the running minimum over the smaller offsets:
+    cost = np.empty(mismatch.shape, dtype=int)
+    cost[0] = mismatch[0]
+    for j in range(1, n_trig):
+        cost[j] = np.minimum.accumulate(cost[j - 1]) + mismatch[j]
+    # Backtrack from the best final offset, once taking the first and once the last of the optimal offsets:
+    offsets = np.empty([2, n_trig], dtype=int)
+    offsets[:, -1] = np.argmin(cost[-1]), n_missing - np.argmin(cost[-1, ::-1])
+    for j in range(n_trig - 1, 0, -1):
+        offsets[0, j - 1] = np.argmin(cost[j - 1, :offsets[0, j] + 1])
+        offsets[1, j - 1] = offsets[1, j] - np.argmin(cost[j - 1, offsets[1, j]::-1])
+    return np.arange(n_trig) + offsets[0], int(cost[-1, offsets[0, -1]]), np.arange(n_trig) + offsets[1]
+
+
+def align_log_to_triggers(log_identities, trig_identities, max_mismatch=0, allow_ambiguous=False):
+    """
+    This function aligns the events of the log file with the triggers recorded by the eyetracker, to handle cases in
+    which some triggers weren't received. If the triggers are a contiguous block of the log events (missing triggers
+    at the beginning or end of the run), the offset is found in linear time (find_subsequence). Otherwise, the
+    triggers are aligned to the log with a banded alignment (banded_alignment), which handles missing triggers in the
+    middle of the run. When several banded alignments are equally good, the triggers could be matched to the wrong
+    log events, which raises an exception unless allow_ambiguous is True.
+    :param log_identities: (list or array) identity of each event in the log file
+    :param trig_identities: (list or array) identity of each trigger
+    :param max_mismatch: (int) number of triggers allowed to mismatch the log events they are aligned to
+    :param allow_ambiguous: (bool) whether to accept ambiguous banded alignments, in which case the alignment with the
+    smallest offsets is returned
+    :return:
+    mapping: (1D int array) index of the log event corresponding to each trigger
+    diagnostics: (dict) summary of the alignment: method used, number of events, missing triggers and mismatches
+    """
+    log_codes, trig_codes = encode_identities(log_identities, trig_identities)
+    n_log, n_trig = len(log_codes), len(trig_codes)
+    if n_trig > n_log:
+        raise Exception("More triggers than there were events in the log file!!!")
+    # Find the triggers as a contiguous block of the log:
+    start_index = find_subsequence(trig_codes, log_codes)
+    if start_index >= 0:
+        method = "identical" if n_trig == n_log else "contiguous"
+        mapping = np.arange(start_index, start_index + n_trig)
+        alt_mapping = mapping
+        n_mismatch = 0
+    else:
+        method = "banded"
+        mapping, n_mismatch, alt_mapping = banded_alignment(log_codes, trig_codes)
+    if n_mismatch > max_mismatch:
+        raise Exception("The events in the log file do not match the events in the Eyetracking triggers!!!")
+    ambiguous_triggers = np.where(mapping != alt_mapping)[0]
+    if len(ambiguous_triggers) > 0 and not allow_ambiguous:
+        raise Exception("The alignment of the log file to the Eyetracking triggers is ambiguous: triggers {} can be "
+                        "matched to log events {} or {}!!!".format(ambiguous_triggers, mapping[ambiguous_triggers],
+                                                                   alt_mapping[ambiguous_triggers]))
+    diagnostics = {
+        "method": method,
+        "n_log": n_log,
+        "n_triggers": n_trig,
+        "n_missing": n_log - n_trig,
+        "missing_log_indices": np.setdiff1d(np.arange(n_log), mapping),
+        "n_mismatch": n_mismatch,
+        "mismatch_triggers": np.where(log_codes[mapping] != trig_codes)[0],
+        "ambiguous_triggers": ambiguous_triggers
+    }
+    return mapping, diagnostics
+
+
 def load_raw_eyetracker(bids_root, subject, session, task, beh_file_name,
-                        annotations_col_names, event_of_interest, verbose=False, debug=False):
+                        annotations_col_names, event_of_interest, verbose=False, debug=False, use_cache=True,
+                        allow_ambiguous_alignment=False):
     """
     This functions loads the eyetracking data using mne python function. In addition, it loads the log files from the
     raw root to extract additional information. For a few subjects, some triggers weren't received by the eyetracker
@@ -378,6 +522,9 @@ def load_raw_eyetracker(bids_root, subject, session, task, beh_file_name,
     :param event_of_interest: (string) identifier of the events of interest
     :param verbose: (bool) verbose
     :para debug: (bool) debug mode loads only 2 files
+    :param use_cache: (bool) whether to load the parsed ascii files from the cache (see read_eyelink_cached)
+    :param allow_ambiguous_alignment: (bool) whether to accept log files that can be aligned to the triggers in
+    several equally good ways (see align_log_to_triggers)
     :return:
     """
     # Load all the files:
@@ -391,6 +538,7 @@ def load_raw_eyetracker(bids_root, subject, session, task, beh_file_name,
 
     # Create the files roots:
     et_root = Path(bids_root, "sub-" + subject, "ses-" + session, "eyetrack")
+    cache_dir = Path(bids_root, "derivatives", "asc_cache", "sub-" + subject, "ses-" + session) if use_cache else None
     beh_root = Path(bids_root, "sub-" + subject, "ses-" + session, "beh")
     # ===================================================================================
     # Load the behavioral log files:
@@ -414,7 +562,9 @@ def load_raw_eyetracker(bids_root, subject, session, task, beh_file_name,
                 run_log = log_file[log_file["block"] == run_i].reset_index(drop=True)
 
             try:
-                raw = mne.io.read_raw_eyelink(Path(et_root, fl), verbose=verbose)
+                raw, calib, screen_dist, screen_size, screen_res = read_eyelink_cached(Path(et_root, fl),
+                                                                                      cache_dir=cache_dir,
+                                                                                      verbose=verbose)
             except ValueError:
                 print("The data in sub-{}, ses-{}, task-{} and run-{} are unreadable".format(subject,
                                                                                              session,
@@ -428,32 +578,24 @@ def load_raw_eyetracker(bids_root, subject, session, task, beh_file_name,
             # Convert the annotations to a pandas dataframe:
             annotations_df = pd.DataFrame(evt, columns=annotations_col_names)
 
-            # Compare the log files to the annotations to identify and  address any discrepancies:
-            if run_log.shape[0] == annotations_df.shape[0]:
-                # If the two data frames have the same length, compare the identity column in each respectively.
-                # Identity changes on a trial by trial basis:
-                assert all(annotations_df["identity"] == run_log["identity"]), \
-                    "The events logged in the logs do not match the events in the eyetracker triggers!"
-            elif run_log.shape[0] > annotations_df.shape[0]:
-                n_miss_triggers = run_log.shape[0] - annotations_df.shape[0]
-                start_index = -1
-                identities_log_file = run_log["identity"].to_list()
-                identities_et = annotations_df["identity"].to_list()
-                for i in range(len(identities_log_file) - len(identities_et) + 1):
-                    if identities_log_file[i:i + len(identities_et)] == identities_et:
-                        start_index = i
-                        break
-                if start_index >= 0:
-                    run_log = run_log.iloc[start_index:start_index + len(identities_et)]
-                    print("WARNING: There were {} missing triggers in run-{} of task-{} in ses-{}!".format(
-                        n_miss_triggers, run_i, task, session))
-                else:
-                    raise Exception("The events in the log file do not match the events in the Eyetracking triggers!!!")
-            else:
-                raise Exception("More triggers than there were events in the log file!!!")
+            # Align the log files to the annotations to identify and address any discrepancies. Identity changes on a
+            # trial by trial basis:
+            mapping, diagnostics = align_log_to_triggers(run_log["identity"].to_numpy(),
+                                                         annotations_df["identity"].to_numpy(),
+                                                         allow_ambiguous=allow_ambiguous_alignment)
+            if diagnostics["n_missing"] > 0:
+                print("WARNING: There were {} missing triggers in run-{} of task-{} in ses-{}!".format(
+                    diagnostics["n_missing"], run_i, task, session))
+            # Triggers missing in the middle of the run: always report which log events were dropped:
+            if diagnostics["method"] == "banded" or (verbose and diagnostics["n_missing"] > 0):
+                print("Alignment ({}): missing log events {}".format(diagnostics["method"],
+                                                                    diagnostics["missing_log_indices"]))
+            if len(diagnostics["ambiguous_triggers"]) > 0:
+                print("WARNING: Ambiguous alignment of triggers {} in run-{} of task-{} in ses-{}!".format(
+                    diagnostics["ambiguous_triggers"], run_i, task, session))
+            run_log = run_log.iloc[mapping]
             logs.append(run_log)
             raws.append(raw)
-            calib, screen_dist, screen_size, screen_res = read_calib(Path(et_root, fl))
             calibs.append(calib)
             screen_distances.append(screen_dist)
             screen_sizes.append(screen_size)
@@ -469,40 +611,150 @@ def load_raw_eyetracker(bids_root, subject, session, task, beh_file_name,
     return logs, raws, calibs, screen_size, screen_distance, screen_res
 
 
-def read_calib(fname):
+def file_signature(fname):
     """
-    This functions reads the eyelink calib using the mne function read_eyelink_calibration. What is added is the reading
-    of the screen physical settings directly from the ascii file.
-    :param fname: (string or path object) path to the ascii file that contains the calib
-    :return: (list mne calib object or empty list) eyelink calib. In case no calib is found in the file, return
-    empty list.
+    This function returns a signature of a file from its path, size and modification time. It changes whenever the
+    file is modified or replaced, without having to read its (possibly very large) content.
+    :param fname: (string or path object) path to the file
+    :return: (string) signature of the file
+    """
+    stat = os.stat(fname)
+    return "{}_{}_{}".format(Path(fname).resolve(), stat.st_size, stat.st_mtime_ns)
+
+
+def _to_json(obj):
+    """
+    Converts numpy objects to json serializable python objects (to be passed to json.dump as default).
+    """
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError("Object of type {} is not JSON serializable".format(type(obj).__name__))
+
+
+def read_eyelink_cached(fname, cache_dir=None, verbose=False):
+    """
+    This function reads an eyelink ascii file (mne.io.read_raw_eyelink) along with its calibration and screen settings
+    (read_calib), caching the results. Parsing the ascii files is slow, so the parsed data are saved as a fif file
+    (in double precision, so that loading from the cache gives exactly the parsed data) together with a json sidecar
+    containing the calibrations and the screen geometry. The cache files are named after the hash of the path, size
+    and modification time of the ascii file and of the MNE version, such that any change to the ascii file (or to the
+    parser) leads to a new parsing, without reading the whole file to find out. The cache files are first written under
+    a temporary name and then renamed, such that parallel workers never read partially written files.
+    :param fname: (string or path object) path to the ascii file
+    :param cache_dir: (string or path object or None) directory of the cache. If None, the file is parsed without
+    caching
+    :param verbose: (bool) verbose
+    :return:
+        - raw: (mne raw object) eyetracking data
+        - calib: (list of mne calibration objects) see read_calib
+        - screen_distance: (float) see read_calib
+        - screen_size: (list) see read_calib
+        - screen_res: (list) see read_calib
+    """
+    fname = Path(fname)
+    if cache_dir is None:
+        raw = mne.io.read_raw_eyelink(fname, verbose=verbose)
+        calib, screen_distance, screen_size, screen_res = read_calib(fname)
+        return raw, calib, screen_distance, screen_size, screen_res
+    # Create the cache files names from the signature of the file (and of the precision, to not load the older single
+    # precision caches):
+    key = hashlib.sha1((file_signature(fname) + mne.__version__ + "double").encode()).hexdigest()[:16]
+    cache_stem = fname.name.split(".asc")[0] + "_" + key
+    fif_file = Path(cache_dir, cache_stem + "_raw.fif")
+    sidecar_file = Path(cache_dir, cache_stem + "_calib.json")
+    if fif_file.is_file() and sidecar_file.is_file():
+        if verbose:
+            print("Loading {} from the cache".format(fname.name))
+        raw = mne.io.read_raw_fif(fif_file, preload=True, verbose=verbose)
+        with open(sidecar_file) as fp:
+            sidecar = json.load(fp)
+        calib = [mne.preprocessing.eyetracking.Calibration(**{
+            key: np.array(val) if key in ["positions", "offsets", "gaze"] else val for key, val in cal.items()})
+            for cal in sidecar["calibrations"]]
+        return raw, calib, sidecar["screen_distance"], sidecar["screen_size"], sidecar["screen_res"]
+
+    # Parse the ascii file:
+    raw = mne.io.read_raw_eyelink(fname, verbose=verbose)
+    calib, screen_distance, screen_size, screen_res = read_calib(fname)
+    # Save to the cache:
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    tmp_stem = "{}_tmp-{}".format(cache_stem, os.getpid())
+    raw.save(Path(cache_dir, tmp_stem + "_raw.fif"), fmt="double", overwrite=True, verbose=verbose)
+    with open(Path(cache_dir, tmp_stem + "_calib.json"), "w") as fp:
+        json.dump({
+            "source": fname.name,
+            "calibrations": [dict(cal) for cal in calib],
+            "screen_distance": screen_distance,
+            "screen_size": screen_size,
+            "screen_res": screen_res
+        }, fp, default=_to_json)
+    os.replace(Path(cache_dir, tmp_stem + "_calib.json"), sidecar_file)
+    os.replace(Path(cache_dir, tmp_stem + "_raw.fif"), fif_file)
+    return raw, calib, screen_distance, screen_size, screen_res
+
+
+class ScreenSettings(NamedTuple):
     """
-    # Open file
-    f = open(fname, 'r')
-    fl_txt = f.read().splitlines(True)  # split into lines
-    fl_txt = list(filter(None, fl_txt))  # remove emptys
-    # Extract screen distance:
-    try:
-        screen_distance = [txt.strip("\n") for txt in fl_txt if "Screen_distance_mm" in txt][0].split(":")[-1].split(" ")
-        # Convert to float:
-        screen_distance = np.mean([float(val) for val in screen_distance if val.isdigit()])
-    except IndexError:
+    Screen settings found in the header of an eyelink ascii file (see scan_asc_header).
+    """
+    screen_distance: float
+    screen_size: list
+    screen_res: list
+
+
+def scan_asc_header(fname):
+    """
+    This function scans an eyelink ascii file line by line to extract the physical screen settings (screen distance
+    and size) and the screen resolution (GAZE_COORDS). The file is never loaded as a whole and the scanning stops as soon
+    as all the fields were found, which is typically within the first few lines. As the file is only opened for reading
+    within this function, it can be used by several processes in parallel.
+    :param fname: (string or path object) path to the ascii file
+    :return: (ScreenSettings) screen distance (mm), screen size (mm) and screen resolution (pixels). The default screen
+    distance and size are used if they are not found in the file
+    """
+    screen_distance, screen_size, screen_res = None, None, None
+    with open(fname, "r") as f:
+        for line in f:
+            if screen_distance is None and "Screen_distance_mm" in line:
+                screen_distance = line.strip("\n").split(":")[-1].split(" ")
+                # Convert to float:
+                screen_distance = np.mean([float(val) for val in screen_distance if val.isdigit()])
+            elif screen_size is None and "Screen_size_mm" in line:
+                screen_size = line.strip("\n").split(":")[-1].split(" ")
+                # Convert to float:
+                screen_size = [float(val) * 10 for val in screen_size if val.isdigit()]
+            elif screen_res is None and "GAZE_COORDS" in line:
+                screen_res = line.strip("\n").split("GAZE_COORDS")[-1].split(" ")
+                # Convert to float:
+                screen_res = [float(val) for val in screen_res if val.replace(".", "").isdigit()]
+            if screen_distance is not None and screen_size is not None and screen_res is not None:
+                break
+    if screen_distance is None:
         print("WARNING: No screen distance value found in the headers, using the default instead!")
         print(f"Default: {DFT_SCREEN_DIST_MM}mm")
         screen_distance = DFT_SCREEN_DIST_MM
-    # Extract screen size:
-    try:
-        screen_size = [txt.strip("\n") for txt in fl_txt if "Screen_size_mm" in txt][0].split(":")[-1].split(" ")
-        # Convert to float:
-        screen_size = [float(val) * 10 for val in screen_size if val.isdigit()]
-    except IndexError:
+    if screen_size is None:
         print("WARNING: No screen size value found in the headers, using the default instead!")
         print(f"Default: {DFT_SCREEN_SIZE_MM}mm")
         screen_size = DFT_SCREEN_SIZE_MM
-    # Extract screen res:
-    screen_res = [txt.strip("\n") for txt in fl_txt if "GAZE_COORDS" in txt][0].split("GAZE_COORDS")[-1].split(" ")
-    # Convert to float:
-    screen_res = [float(val) for val in screen_res if val.replace(".", "").isdigit()]
+    if screen_res is None:
+        raise Exception("No GAZE_COORDS found in {}, the screen resolution is unknown!".format(fname))
+    return ScreenSettings(screen_distance, screen_size, screen_res)
+
+
+def read_calib(fname):
+    """
+    This functions reads the eyelink calib using the mne function read_eyelink_calibration. What is added is the reading
+    of the screen physical settings directly from the ascii file.
+    :param fname: (string or path object) path to the ascii file that contains the calib
+    :return: (list mne calib object or empty list) eyelink calib. In case no calib is found in the file, return
+    empty list.
+    """
+    # Extract the screen distance, size and resolution from the file header:
+    screen_distance, screen_size, screen_res = scan_asc_header(fname)
     # Read in the calib:
     calib = mne.preprocessing.eyetracking.read_eyelink_calibration(fname,
                                                                    screen_size=[screen_size[1], screen_size[0]],
@@ -528,13 +780,14 @@ def plot_blinks(raw, blinks_annotations=None):
     return None
 
 
-def hershman_blinks_detection(raw, eyes=None, replace_eyelink_blinks=True):
+def hershman_blinks_detection(raw, eyes=None, replace_eyelink_blinks=True, n_jobs=1):
     """
     This function applies the blink detection algorithm described here: https://osf.io/jyz43/?view_only= to mne raw
     object
     :param raw:
     :param eyes: eye to use for blink detection. If both are used...
     :param replace_eyelink_blinks:
+    :param n_jobs: (int) number of threads to use to process the eyes in parallel
     :return:
     """
     print("=" * 40)
@@ -546,42 +799,172 @@ def hershman_blinks_detection(raw, eyes=None, replace_eyelink_blinks=True):
     # Remove the eyelink blinks:
     if replace_eyelink_blinks:
         new_annotations.delete(np.where(raw.annotations.description == "BAD_blink")[0])
-    # Loop through each eye:
-    for eye in eyes:
-        # Extract the pupil data of this eye:
-        data = np.squeeze(raw.copy().get_data(picks='pupil_' + eye))
-        # Indices from the eyelink:
-        blinks_inds = np.where(raw.annotations.description == "BAD_blink")[0]
-        # Get the blinks time stamps:
-        blink_onsets = raw.annotations.onset[blinks_inds]
-        blink_durations = raw.annotations.duration[blinks_inds]
-        # Set the blinks periods to 0:
-        for i, blink_onset in enumerate(blink_onsets):
-            # Get the start and end indices:
-            start = np.argmin(np.abs(raw.times - blink_onset))
-            end = np.argmin(np.abs(raw.times - (blink_onset + blink_durations[i])))
-            data[start:end] = 0
-        # Replace the nans by 0s:
-        data[np.isnan(data)] = 0
-        # Apply the hershman algorithm:
-        blinks = based_noise_blinks_detection(data, int(raw.info["sfreq"]))
-
-        # Create annotations accordingly:
-        blinks_annotations = mne.Annotations(
-            onset=blinks["blink_onset"] * 1 / 1000,
-            duration=(blinks["blink_offset"] - blinks["blink_onset"]) * 1 / 1000,
-            description=["BAD_blink"] * len(blinks["blink_onset"]),
-            ch_names=[('xpos_' + eye, 'ypos_' + eye, 'pupil_' + eye)] * len(blinks["blink_onset"]),
-            orig_time=raw.annotations.orig_time
-        )
-        # Add the newly detected blinks:
-        new_annotations = new_annotations.__add__(blinks_annotations)
-    # Add the new annotations:
-    raw.set_annotations(new_annotations)
+    # Extract the pupil data of all eyes at once:
+    data = np.atleast_2d(raw.get_data(picks=['pupil_' + eye for eye in eyes]))
+    # Indices from the eyelink:
+    blinks_inds = np.where(raw.annotations.description == "BAD_blink")[0]
+    # Get the blinks start and end indices (i.e. closest samples to the blinks onsets and offsets):
+    blink_onsets = raw.annotations.onset[blinks_inds]
+    starts = nearest_sample(raw.times, blink_onsets)
+    ends = nearest_sample(raw.times, blink_onsets + raw.annotations.duration[blinks_inds])
+    # Set the blinks periods to 0 in all eyes:
+    data[:, intervals_to_mask(starts, ends, data.shape[1])] = 0
+    # Replace the nans by 0s:
+    data[np.isnan(data)] = 0
+    # Apply the hershman algorithm to each eye:
+    if n_jobs > 1:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            eyes_blinks = list(executor.map(lambda eye_data: based_noise_blinks_detection(eye_data,
+                                                                                         int(raw.info["sfreq"])),
+                                            data))
+    else:
+        eyes_blinks = [based_noise_blinks_detection(eye_data, int(raw.info["sfreq"])) for eye_data in data]
+
+    # Create annotations for all eyes at once:
+    n_blinks = [len(blinks["blink_onset"]) for blinks in eyes_blinks]
+    blinks_annotations = mne.Annotations(
+        onset=np.concatenate([np.asarray(blinks["blink_onset"]) for blinks in eyes_blinks]) * 1 / 1000,
+        duration=np.concatenate([np.asarray(blinks["blink_offset"]) - np.asarray(blinks["blink_onset"])
+                                 for blinks in eyes_blinks]) * 1 / 1000,
+        description=["BAD_blink"] * sum(n_blinks),
+        ch_names=[('xpos_' + eye, 'ypos_' + eye, 'pupil_' + eye) for eye, n in zip(eyes, n_blinks) for _ in range(n)],
+        orig_time=raw.annotations.orig_time
+    )
+    # Add the newly detected blinks:
+    raw.set_annotations(new_annotations + blinks_annotations)
 
     return raw
 
 
+def nearest_sample(times, timestamps):
+    """
+    This function returns the index of the sample closest to each time stamp, same as np.argmin(np.abs(times - t)) for
+    each t (in case of a tie, the earlier sample is returned) but with a single binary search.
+    :param times: (np.array) sorted time of each sample
+    :param timestamps: (np.array) time stamps to convert to sample indices
+    :return: (np.array) index of the closest sample to each time stamp
+    """
+    timestamps = np.asarray(timestamps)
+    right = np.clip(np.searchsorted(times, timestamps, side="left"), 1, len(times) - 1)
+    left = right - 1
+    return np.where(np.abs(timestamps - times[left]) <= np.abs(times[right] - timestamps), left, right)
+
+
+def intervals_to_mask(starts, ends, n_samples):
+    """
+    This function converts intervals [start, end[ of sample indices to a boolean mask, same as setting mask[start:end]
+    to True for each interval but in a single pass through the cumulative sum of the interval boundaries.
+    :param starts: (np.array of int) start index of each interval
+    :param ends: (np.array of int) end index of each interval (excluded)
+    :param n_samples: (int) length of the mask
+    :return: (np.array of bool) mask
+    """
+    starts = np.clip(np.asarray(starts, dtype=int), 0, n_samples)
+    ends = np.clip(np.asarray(ends, dtype=int), 0, n_samples)
+    # Empty intervals (end <= start) don't mask anything:
+    valid = ends > starts
+    boundaries = np.zeros(n_samples + 1, dtype=int)
+    np.add.at(boundaries, starts[valid], 1)
+    np.add.at(boundaries, ends[valid], -1)
+    return np.cumsum(boundaries[:-1]) > 0
+
+
+def mask_to_intervals(mask):
+    """
+    This function converts a boolean mask to intervals [start, stop[ of consecutive True samples.
+    :param mask: (np.array of bool) mask
+    :return:
+        - starts: (np.array of int) first index of each interval
+        - stops: (np.array of int) index following the last index of each interval
+    """
+    padded = np.concatenate(([False], np.asarray(mask, dtype=bool), [False]))
+    changes = np.flatnonzero(padded[1:] != padded[:-1])
+    return changes[0::2], changes[1::2]
+
+
+class AnnotationIndex:
+    """
+    This class indexes the annotations of a raw object once, such that the annotations of a given description and eye
+    can be retrieved, converted to sample indices, to masks or summed without looping through all the annotations
+    each time. The annotations are grouped by description and eye (eye being read from the first channel of each
+    annotation, e.g. "left" for ('xpos_left', 'ypos_left', 'pupil_left')), and within each group sorted by onset. The
+    index must be rebuilt if the annotations of the raw object are modified.
+    :param raw: (mne raw object) raw object whose annotations to index
+    """
+
+    def __init__(self, raw):
+        annotations = raw.annotations
+        self.sfreq = raw.info["sfreq"]
+        self.n_times = raw.n_times
+        self.onset = np.asarray(annotations.onset)
+        self.duration = np.asarray(annotations.duration)
+        # (the empty string appended and removed ensures a string array even without annotations)
+        self.description = np.array([str(desc) for desc in annotations.description] + [""])[:-1]
+        self.eye = np.array([ch_names[0].split("_")[-1] if len(ch_names) > 0 else ""
+                             for ch_names in annotations.ch_names] + [""])[:-1]
+        # Sample indices of each annotation:
+        self.start = (self.onset * self.sfreq).astype(int)
+        self.stop = ((self.onset + self.duration) * self.sfreq).astype(int)
+        # Group the annotations by description and eye, sorted by onset:
+        order = np.lexsort((self.onset, self.eye, self.description))
+        keys = list(zip(self.description[order], self.eye[order]))
+        self.groups = {}
+        for ind, key in zip(order, keys):
+            self.groups.setdefault(key, []).append(ind)
+        self.groups = {key: np.array(inds, dtype=int) for key, inds in self.groups.items()}
+
+    def select(self, description, eye=None, contains=False):
+        """
+        This function returns the indices of the annotations matching a description (and eye).
+        :param description: (string) description of the annotations
+        :param eye: (string or None) eye of the annotations. If None, the annotations of all eyes (and of no eye) are
+        returned
+        :param contains: (bool) if True, all descriptions containing the description string are matched, otherwise
+        only the exact description
+        :return: (np.array of int) indices of the matching annotations in the raw annotations
+        """
+        inds = [group_inds for (desc, group_eye), group_inds in self.groups.items()
+                if (description in desc if contains else desc == description) and (eye is None or group_eye == eye)]
+        if len(inds) == 0:
+            return np.array([], dtype=int)
+        return np.sort(np.concatenate(inds))
+
+    def intervals(self, description, eye=None, contains=False):
+        """
+        This function returns the sample indices [start, stop[ of the annotations matching a description (and eye).
+        :return:
+            - start: (np.array of int) first sample of each annotation
+            - stop: (np.array of int) sample following the last sample of each annotation
+        """
+        inds = self.select(description, eye=eye, contains=contains)
+        return self.start[inds], self.stop[inds]
+
+    def mask(self, description, eye=None, contains=False):
+        """
+        This function returns a boolean mask of the samples covered by the annotations matching a description (and
+        eye), in time linear in the number of samples and annotations.
+        :return: (np.array of bool) mask of length n_times
+        """
+        return intervals_to_mask(*self.intervals(description, eye=eye, contains=contains), self.n_times)
+
+    def total_duration(self, description, eye=None, contains=False):
+        """
+        This function returns the summed duration of the annotations matching a description (and eye). Overlapping
+        annotations are counted several times.
+        :return: (float) total duration in seconds
+        """
+        inds = self.select(description, eye=eye, contains=contains)
+        return np.sum(self.duration[inds]) if len(inds) > 0 else 0
+
+    def coverage(self, description, eye=None, contains=False):
+        """
+        This function returns the proportion of samples covered by at least one of the annotations matching a
+        description (and eye).
+        :return: (float) proportion of covered samples
+        """
+        return np.mean(self.mask(description, eye=eye, contains=contains))
+
+
 def pix_to_deg(x_pix, y_pix, screen_size_mm, screen_res, screen_dist_mm):
     """
     This function converts the gaze coordinates to degree of visual angle from center of the screen.
@@ -602,7 +985,63 @@ def pix_to_deg(x_pix, y_pix, screen_size_mm, screen_res, screen_dist_mm):
     return distance_deg
 
 
-def gaze_to_dva(raw, screen_size_mm, screen_res, screen_dist_mm, eyes=None):
+class DerivedChannels:
+    """
+    This class queues channels computed from a raw object (fixation distance, eyelink events regressors...) to add them
+    all to the raw object at once. Adding channels one by one reallocates the whole data buffer of the raw object each
+    time, while flushing the queue does it only once. Boolean channels (events masks) are kept as booleans in the
+    queue, which takes 8 times less memory than the float64 data of the raw object, and are only converted when
+    flushed (typically right before epoching).
+    :param raw: (mne raw object) raw object to which the channels will be added
+    """
+
+    def __init__(self, raw):
+        self.sfreq = raw.info["sfreq"]
+        self.meas_date = raw.info["meas_date"]
+        self.n_times = raw.n_times
+        self.ch_names = []
+        self.ch_types = []
+        self.data = []
+
+    def __len__(self):
+        return len(self.ch_names)
+
+    def add(self, ch_name, data, ch_type="misc"):
+        """
+        This function queues a channel.
+        :param ch_name: (string) name of the channel
+        :param data: (np.array) data of the channel (n_times,). Boolean masks are stored as is
+        :param ch_type: (string) mne channel type
+        :return:
+        """
+        data = np.asarray(data)
+        if data.shape != (self.n_times,):
+            raise ValueError("The channel {} has {} samples, {} expected!".format(ch_name, data.shape, self.n_times))
+        self.ch_names.append(ch_name)
+        self.ch_types.append(ch_type)
+        self.data.append(data)
+
+    def flush(self, raw):
+        """
+        This function adds all the queued channels to the raw object in one go and empties the queue.
+        :param raw: (mne raw object) raw object to which to add the channels
+        :return: raw (mne raw object) with the added channels
+        """
+        if len(self.ch_names) == 0:
+            return raw
+        info = mne.create_info(ch_names=self.ch_names, ch_types=self.ch_types, sfreq=self.sfreq)
+        # Add measurement date:
+        info.set_meas_date(self.meas_date)
+        # Allocate the data of all channels at once:
+        data = np.empty((len(self.data), self.n_times))
+        for ch_i, ch_data in enumerate(self.data):
+            data[ch_i] = ch_data
+        raw.add_channels([mne.io.RawArray(data, info, verbose="WARNING")])
+        self.ch_names, self.ch_types, self.data = [], [], []
+        return raw
+
+
+def gaze_to_dva(raw, screen_size_mm, screen_res, screen_dist_mm, eyes=None, derived=None):
     """
     This function converts the gaze measurements from pixel coordinates to degrees of visual angle (dva) from the
     middle of the screen.
@@ -610,6 +1049,8 @@ def gaze_to_dva(raw, screen_size_mm, screen_res, screen_dist_mm, eyes=None):
     :param screen_size_mm: (list) contains the screen size in cm [width, height]
     :param screen_dist_mm: (float) contains the screen distance in cm
     :param eyes: (list of string or None) eyes for which to apply the conversion
+    :param derived: (DerivedChannels or None) if passed, the fixdist channels are queued in there instead of being
+    added to the raw object right away
     :return:
         - raw: (mne raw object) with the added fixdist_{eye} channel
     """
@@ -618,6 +1059,7 @@ def gaze_to_dva(raw, screen_size_mm, screen_res, screen_dist_mm, eyes=None):
 
     if eyes is None:
         eyes = ["left", "right"]
+    channels = DerivedChannels(raw) if derived is None else derived
     # Loop through each eye:
     for eye in eyes:
         # Extract the gaze data of this eye:
@@ -625,20 +1067,14 @@ def gaze_to_dva(raw, screen_size_mm, screen_res, screen_dist_mm, eyes=None):
                         np.squeeze(raw.get_data(picks=["ypos_{}".format(eye)])))
         # Convert to dva:
         fixation_dist = pix_to_deg(eye_x, eye_y, screen_size_mm, screen_res, screen_dist_mm)
-        # Create a raw object for this channel:
-        info = mne.create_info(ch_names=["_".join(["fixdist", eye])],
-                               ch_types=['eyegaze'],
-                               sfreq=raw.info["sfreq"])
-        # Add measurement date:
-        info.set_meas_date(raw.info['meas_date'])
-        # Combine to a mne raw object:
-        raw_fix = mne.io.RawArray(np.expand_dims(fixation_dist, axis=0), info, verbose="WARNING")
-        # Add channel to the raw object:
-        raw.add_channels([raw_fix])
+        channels.add("_".join(["fixdist", eye]), fixation_dist, ch_type="eyegaze")
+    # Add the channels to the raw object, unless they are queued for later:
+    if derived is None:
+        raw = channels.flush(raw)
     return raw
 
 
-def extract_eyelink_events(raw, description="blink", eyes=None):
+def extract_eyelink_events(raw, description="blink", eyes=None, ann_index=None, derived=None):
     """
     This function extracts the eyelink events from the annotation. In the annotation, we have the onset and duration
     for each of the eyelink parser events. These are converted to continuous regressors, with ones where we have the
@@ -649,39 +1085,25 @@ def extract_eyelink_events(raw, description="blink", eyes=None):
     must match the description found in the raw object annotation
     :param eyes: (list or None) eye to use. By default, set to use both, which will create one channel per eye and per
     event. MONOCULAR NOT IMPLEMENTED
+    :param ann_index: (AnnotationIndex or None) index of the raw annotations. If None, it is built from the raw. Pass
+    it when extracting several events from the same raw to index the annotations only once
+    :param derived: (DerivedChannels or None) if passed, the events channels are queued in there (as boolean masks)
+    instead of being added to the raw object right away
     :return: raw_new (mne raw object) raw object with the added channels encoding the events and their duration
     """
     # Create the new channels, one per eye:
     if eyes is None:
         eyes = ["left", "right"]
+    if ann_index is None:
+        ann_index = AnnotationIndex(raw)
 
-    desc_vectors = []
+    channels = DerivedChannels(raw) if derived is None else derived
+    # Set the regressor to 1 where the event is happening:
     for eye in eyes:
-        # Extract the events
-        evts_ind = np.intersect1d(np.where(raw.annotations.description == description)[0],
-                                  np.array([ind for ind in range(len(raw.annotations.ch_names))
-                                            if len(raw.annotations.ch_names[ind]) > 0
-                                            if eye in raw.annotations.ch_names[ind][0]]))
-        # Extract the onset and duration of the said event:
-        evt_onset = raw.annotations.onset[evts_ind]
-        evt_offset = evt_onset + raw.annotations.duration[evts_ind]
-        # Convert to samples:
-        onset = (evt_onset * raw.info["sfreq"]).astype(int)
-        offset = (evt_offset * raw.info["sfreq"]).astype(int)
-
-        # Set the regressor to 1 where the event is happening:
-        desc_vector = np.zeros(raw.n_times)
-        for i in range(len(onset)):
-            desc_vector[onset[i]:offset[i]] = 1
-        desc_vectors.append(desc_vector)
-
-    # Add these two channels to the raw data:
-    evts_info = mne.create_info(["_".join([description, eye]) for eye in eyes],
-                                ch_types=['misc'] * len(eyes),
-                                sfreq=raw.info["sfreq"])
-    evts_info.set_meas_date(raw.info['meas_date'])
-    raw_evts = mne.io.RawArray(np.array(desc_vectors), evts_info, verbose="WARNING")
-    raw.add_channels([raw_evts])
+        channels.add("_".join([description, eye]), ann_index.mask(description, eye=eye), ch_type="misc")
+    # Add these channels to the raw data, unless they are queued for later:
+    if derived is None:
+        raw = channels.flush(raw)
     return raw
 
 
@@ -710,33 +1132,27 @@ def add_logfiles_info(epochs, log_file, columns):
     return epochs
 
 
-def compute_proportion_bad(raw, desc="BAD_", eyes=None):
+def compute_proportion_bad(raw, desc="BAD_", eyes=None, ann_index=None):
     """
     This function computes the proportion of data that are marked as bad according to the specified description. The
     proportion of data affected by the annotation is returned per eye for binocular recordings.
     :param raw: (mne raw object) contains the eyelink data
     :param desc: (string) string identifier to compute proportion of affected data
     :param eyes: (list) eyes to investigate
+    :param ann_index: (AnnotationIndex or None) index of the raw annotations. If None, it is built from the raw
     :return: (list) proportion of affected data for each eye
     """
     if eyes is None:
         eyes = ["left", "right"]
+    if ann_index is None:
+        ann_index = AnnotationIndex(raw)
     bad_proportions = []
     print("=" * 40)
     print("Proportion of the data marked as {}".format(desc))
     # Loop through each eye
     for eye in eyes:
-        # Extract the indices of this eye matching the description:
-        bad_annot_ind = np.intersect1d([ind for ind, val in enumerate(raw.annotations.description) if desc in val],
-                                       np.array([ind for ind in range(len(raw.annotations.ch_names))
-                                                 if len(raw.annotations.ch_names[ind]) > 0
-                                                 if eye in raw.annotations.ch_names[ind][0]])
-                                       )
-        # Compute the sum of the duration:
-        if len(bad_annot_ind) > 0:
-            bad_dur = np.sum(raw.annotations.duration[bad_annot_ind])
-        else:
-            bad_dur = 0
+        # Compute the sum of the duration of the annotations of this eye matching the description:
+        bad_dur = ann_index.total_duration(desc, eye=eye, contains=True)
 
         # Compute the proportion:
         bad_proportion = bad_dur / (raw.times[-1] - raw.times[0])
@@ -745,6 +1161,48 @@ def compute_proportion_bad(raw, desc="BAD_", eyes=None):
     return bad_proportions
 
 
+class BadProportionTracker:
+    """
+    This class keeps track of the proportion of bad data along the preprocessing steps. The proportion of bad data is
+    only recomputed after the steps that add or modify annotations (see ANNOTATION_STEPS), and is carried over
+    otherwise. The proportion after each step is stored to be reported as a table at the end of the preprocessing.
+    :param desc: (string) string identifier of the bad annotations, see compute_proportion_bad
+    :param eyes: (list) eyes to investigate
+    """
+
+    def __init__(self, desc="BAD_", eyes=None):
+        self.desc = desc
+        self.eyes = ["left", "right"] if eyes is None else eyes
+        self.proportion_bad = None
+        self.steps = []
+
+    def update(self, raw, step, annotations_changed=None):
+        """
+        This function updates the proportion of bad data after a preprocessing step.
+        :param raw: (mne raw object) raw object after the step
+        :param step: (string) name of the step
+        :param annotations_changed: (bool or None) whether the step modified the annotations. If None, determined by
+        whether the step is in ANNOTATION_STEPS
+        :return: (list) proportion of bad data for each eye
+        """
+        if annotations_changed is None:
+            annotations_changed = step in ANNOTATION_STEPS
+        if annotations_changed or self.proportion_bad is None:
+            self.proportion_bad = compute_proportion_bad(raw, desc=self.desc, eyes=self.eyes)
+        self.steps.append({"step": step,
+                           **{"{}_{}".format(self.desc.strip("_"), eye): prop
+                              for eye, prop in zip(self.eyes, self.proportion_bad)},
+                           "recomputed": annotations_changed})
+        return self.proportion_bad
+
+    def summary_table(self):
+        """
+        This function returns the proportion of bad data after each step.
+        :return: (pandas data frame) one row per step
+        """
+        return pd.DataFrame(self.steps)
+
+
 def create_metadata_from_events(epochs, metadata_column):
     """
     This function parses the events found in the epochs descriptions to create the meta data. The column of the meta
@@ -829,3 +1287,104 @@ def epoch_data(raw, events, event_dict, events_of_interest=None, metadata_column
     if metadata_column is not None:
         epochs = create_metadata_from_events(epochs, metadata_column)
     return epochs
+
+
+def downsample_times(data, times, max_times=500):
+    """
+    This function downsamples data along the last (time) dimension by averaging consecutive samples in blocks, such
+    that there are at most max_times samples left. Meant to store compact versions of the data for plotting.
+    :param data: (np.array) data to downsample, time being the last dimension
+    :param times: (1D array) time vector of the data
+    :param max_times: (int) maximal number of samples to keep
+    :return:
+    data_ds: (np.array) downsampled data
+    times_ds: (1D array) time of each downsampled sample (average time of each block)
+    """
+    step = int(np.ceil(len(times) / max_times))
+    if step <= 1:
+        return data, times
+    starts = np.arange(0, len(times), step)
+    counts = np.diff(np.append(starts, len(times)))
+    data_ds = np.add.reduceat(data, starts, axis=-1) / counts
+    times_ds = np.add.reduceat(times, starts) / counts
+    return data_ds, times_ds
+
+
+def compute_qc_summary(epochs, eyes, plot_factors, calibs=None, events=None, screen_res=(1920, 1080),
+                       baseline=(None, -0.05), max_times=500, gaze_bin=8, gaze_sigma=25, view=None):
+    """
+    This function computes everything needed to plot the quality checks of the preprocessing (see
+    helper_plotter.plot_qc_summary) in one go, from a single extraction of the epochs data: downsampled rasters of the
+    eyelink events and pupil size, blink counts, gaze heatmap, baseline distribution and evoked pupil responses per
+    factor. This way, the quality checks plots can be rendered separately from the preprocessing.
+    :param epochs: (mne epochs object) preprocessed epochs
+    :param eyes: (list of strings) recorded eyes
+    :param plot_factors: (list of strings) metadata columns for which to plot the blinks and pupil responses per level
+    :param calibs: (list of mne Calibration objects) calibrations to plot
+    :param events: (list of strings) eyelink events channels (see extract_eyelink_events) to plot as rasters. None if
+    the events were not extracted
+    :param screen_res: (list) screen resolution in pixels [width, height], for the gaze heatmap
+    :param baseline: (tuple) baseline of the percent change pupil size
+    :param max_times: (int) maximal number of time points of the rasters and single trials (see downsample_times)
+    :param gaze_bin: (int) size of the gaze heatmap bins in pixels
+    :param gaze_sigma: (float) standard deviation of the gaussian smoothing of the gaze heatmap, in pixels
+    :param view: (EpochsView or None) view of the epochs data containing the needed channels, extracted from the
+    epochs if None
+    :return: (dict) the quality checks summary, to save with helper_qc_io.save_qc_summary
+    """
+    events = [] if events is None else events
+    # Extract all the needed channels at once:
+    picks = (["pupil_{}".format(eye) for eye in eyes] + ["xpos_{}".format(eye) for eye in eyes] +
+             ["ypos_{}".format(eye) for eye in eyes] +
+             ["{}_{}".format(evt, eye) for evt in events for eye in eyes])
+    view = EpochsView(epochs, picks=picks) if view is None else view.align(epochs)
+    channels = {ch: view.get_data(picks=ch)[:, 0, :] for ch in picks}
+    times = view.times
+    summary = {"times": times, "eyes": list(eyes), "n_trials": len(epochs), "rasters": {}, "factors": {}}
+
+    # Eyelink events rasters:
+    for evt in events:
+        summary["rasters"][evt] = {eye: downsample_times(channels["{}_{}".format(evt, eye)], times,
+                                                         max_times=max_times)[0].astype(np.float32)
+                                   for eye in eyes}
+    # Blink counts per trial (blinks happening in both eyes):
+    if "blink" in events:
+        blinks = np.all([channels["blink_{}".format(eye)] for eye in eyes], axis=0).astype(float)
+        summary["blink_counts"] = np.sum(np.diff(blinks, axis=1) == 1, axis=1)
+
+    # Gaze heatmap, averaged across eyes (see mne.viz.eyetracking.plot_gaze):
+    width, height = screen_res
+    if len(eyes) > 1:
+        gaze_x = np.nanmean([channels["xpos_{}".format(eye)] for eye in eyes], axis=0)
+        gaze_y = np.nanmean([channels["ypos_{}".format(eye)] for eye in eyes], axis=0)
+    else:
+        gaze_x, gaze_y = channels["xpos_{}".format(eyes[0])], channels["ypos_{}".format(eyes[0])]
+    hist, _, _ = np.histogram2d(gaze_y.flatten(), gaze_x.flatten(),
+                                bins=(int(height // gaze_bin), int(width // gaze_bin)),
+                                range=[[0, height], [0, width]])
+    # Convert density from samples to seconds and smooth:
+    hist = gaussian_filter(hist / epochs.info["sfreq"], sigma=gaze_sigma / gaze_bin)
+    summary["gaze"] = {"heatmap": hist.astype(np.float32), "width": width, "height": height}
+
+    # Pupil size, averaged across eyes:
+    pupil = np.mean([channels["pupil_{}".format(eye)] for eye in eyes], axis=0)
+    # Baseline distribution:
+    baseline_avg = np.mean(pupil[:, times <= 0], axis=1)
+    summary["baseline_zscore"] = zscore(baseline_avg, nan_policy='omit')
+    summary["times_ds"] = downsample_times(pupil, times, max_times=max_times)[1]
+    summary["pupil"] = downsample_times(pupil, times, max_times=max_times)[0].astype(np.float32)
+    # Baseline corrected pupil size (percent change, applied to each eye before averaging):
+    pupil_bascorr = np.mean([rescale(channels["pupil_{}".format(eye)], times, baseline, mode="percent", copy=True,
+                                     verbose="WARNING") for eye in eyes], axis=0)
+    summary["pupil_bascorr"] = downsample_times(pupil_bascorr, times, max_times=max_times)[0].astype(np.float32)
+
+    # Trials of each level of each factor and the corresponding evoked pupil responses:
+    for factor in plot_factors:
+        levels = [str(lvl) for lvl in epochs.metadata[factor].unique()]
+        masks = np.array([get_condition_mask(view, lvl) for lvl in levels])
+        summary["factors"][factor] = {"levels": levels, "masks": masks,
+                                      "evoked": np.array([np.mean(pupil_bascorr[mask], axis=0) for mask in masks])}
+
+    # Calibrations:
+    summary["calibrations"] = {str(calib_i): dict(calib) for calib_i, calib in enumerate(calibs or [])}
+    return summary
@@ -0,0 +1,49 @@
+import json
+import numpy as np
+
+
+def save_qc_summary(summary, fname):
+    """
+    This function saves the quality checks summary (see helper_preprocessing.compute_qc_summary) to a compressed numpy
+    file. The arrays are stored as such and the rest of the (nested) summary as json.
+    :param summary: (dict) quality checks summary
+    :param fname: (string or path object) name of the file (.npz)
+    :return:
+    """
+    arrays = {}
+
+    def to_meta(val):
+        if isinstance(val, dict):
+            return {str(key): to_meta(sub_val) for key, sub_val in val.items()}
+        if isinstance(val, np.ndarray):
+            name = "arr_{}".format(len(arrays))
+            arrays[name] = val
+            return {"__array__": name}
+        return val
+
+    def to_json(obj):
+        # numpy objects nested in lists or tuples are stored as json:
+        if isinstance(obj, np.ndarray):
+            return obj.tolist()
+        if isinstance(obj, np.generic):
+            return obj.item()
+        raise TypeError("Object of type {} is not JSON serializable".format(type(obj).__name__))
+
+    meta = json.dumps(to_meta(summary), default=to_json)
+    np.savez_compressed(fname, meta=np.array(meta), **arrays)
+
+
+def load_qc_summary(fname):
+    """
+    This function loads a quality checks summary saved with save_qc_summary.
+    :param fname: (string or path object) name of the file (.npz)
+    :return: (dict) quality checks summary
+    """
+    with np.load(fname) as npz:
+        def from_meta(val):
+            if isinstance(val, dict):
+                if "__array__" in val:
+                    return npz[val["__array__"]]
+                return {key: from_meta(sub_val) for key, sub_val in val.items()}
+            return val
+        return from_meta(json.loads(str(npz["meta"])))
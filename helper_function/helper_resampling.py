@@ -0,0 +1,120 @@
+import numpy as np
+from scipy.stats import t as t_dist
+from helper_function.helper_general import grouped_sum, max_percentage_indices
+
+
+def jackknife_means(data, codes, n_cells):
+    """
+    This function computes the leave-one-trial-out mean of each trial's cell from the sum of each cell: removing trial
+    i from its cell c gives (sum_c - x_i) / (n_c - 1), such that all the jackknife means are obtained without looping
+    over the trials. The NaNs are ignored, as in the bootstrap (see bootstrap_latencies): the sums and counts are those
+    of the non NaN values, such that leaving out a trial with NaNs gives the mean of the other trials at these samples.
+    :param data: (2D array) data of each trial, n_trials x n_times
+    :param codes: (1D array of int) cell of each trial, trials with negative codes are ignored (see condition_codes)
+    :param n_cells: (int) number of cells
+    :return: (2D array) mean of the cell of each trial without this trial, n_trials x n_times. NaN for the trials that
+    are not in a cell and wherever no other trial of the cell has a value (i.e. cells with a single trial)
+    """
+    sums, counts = grouped_sum(data, codes, n_cells, ignore_nan=True)
+    valid = codes >= 0
+    nans = np.isnan(data[valid])
+    means = np.full(data.shape, np.nan)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        remaining = counts[codes[valid]] - ~nans
+        means[valid] = np.where(remaining > 0, (sums[codes[valid]] - np.where(nans, 0, data[valid])) / remaining,
+                                np.nan)
+    return means
+
+
+def jackknife_latencies(data, codes, n_cells, thresh_percent, start=None, times=None):
+    """
+    This function computes the latency of each leave-one-trial-out evoked response (see jackknife_means), with the
+    batched estimator max_percentage_indices.
+    :param data: (2D array) data of each trial, n_trials x n_times
+    :param codes: (1D array of int) cell of each trial (see condition_codes)
+    :param n_cells: (int) number of cells
+    :param thresh_percent: (float or int) percentage of peak value defining the latency
+    :param start: (None, int or 1D array of int) index from which to search the latency in each cell
+    :param times: (1D array) time of each sample. If None, the latencies are in samples
+    :return: (1D array) interpolated latency of the evoked response of each trial's cell without this trial
+    """
+    start = np.broadcast_to(0 if start is None else start, [n_cells])
+    _, latencies, _ = max_percentage_indices(jackknife_means(data, codes, n_cells), thresh_percent,
+                                             start=np.where(codes >= 0, start[codes], 0), times=times)
+    return latencies
+
+
+def jackknife_ci(estimate, latencies, codes, n_cells, ci=0.95):
+    """
+    This function computes the jackknife standard error of the latency of each cell, and the associated t
+    confidence interval around the estimate: se = sqrt((n - 1) / n * sum((latency_i - mean latency)^2)).
+    :param estimate: (1D array) latency of each cell computed on all trials. The cells without estimate (NaN) get NaN
+    standard errors and confidence intervals
+    :param latencies: (1D array) leave-one-trial-out latency of each trial (see jackknife_latencies)
+    :param codes: (1D array of int) cell of each trial (see condition_codes)
+    :param n_cells: (int) number of cells
+    :param ci: (float) confidence level
+    :return:
+    se: (1D array) jackknife standard error of each cell
+    ci_low: (1D array) lower bound of the confidence interval
+    ci_high: (1D array) upper bound of the confidence interval
+    """
+    sums, counts = grouped_sum(latencies, codes, n_cells, ignore_nan=True)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / counts
+        sq_dev = np.where(codes >= 0, (latencies - means[codes]) ** 2, np.nan)
+        ss, _ = grouped_sum(sq_dev, codes, n_cells, ignore_nan=True)
+        se = np.sqrt((counts - 1) / counts * ss)
+        se[(counts < 2) | np.isnan(estimate)] = np.nan
+        t_crit = t_dist.ppf(0.5 + ci / 2, np.maximum(counts - 1, 1))
+    return se, estimate - t_crit * se, estimate + t_crit * se
+
+
+def bootstrap_latencies(data, codes, n_cells, thresh_percent, n_boot=1000, start=None, times=None, seed=None):
+    """
+    This function computes the bootstrap distribution of the latency of each cell. For each cell, the trials drawn in
+    each bootstrap sample are encoded in a matrix of multinomial weights (n_boot x n_trials, how many times each trial
+    is drawn), such that the means of all bootstrap samples are obtained by a single matrix product. The latencies are
+    then computed with the batched estimator max_percentage_indices.
+    :param data: (2D array) data of each trial, n_trials x n_times
+    :param codes: (1D array of int) cell of each trial (see condition_codes)
+    :param n_cells: (int) number of cells
+    :param thresh_percent: (float or int) percentage of peak value defining the latency
+    :param n_boot: (int) number of bootstrap samples
+    :param start: (None, int or 1D array of int) index from which to search the latency in each cell
+    :param times: (1D array) time of each sample. If None, the latencies are in samples
+    :param seed: (int or np.random.Generator) seed of the random draws
+    :return: (2D array) interpolated latency of each bootstrap sample, n_cells x n_boot. NaN for the cells without
+    trials
+    """
+    rng = np.random.default_rng(seed)
+    start = np.broadcast_to(0 if start is None else start, [n_cells])
+    latencies = np.full([n_cells, n_boot], np.nan)
+    for cell in range(n_cells):
+        cell_data = data[codes == cell]
+        n_trials = cell_data.shape[0]
+        if n_trials == 0:
+            continue
+        weights = rng.multinomial(n_trials, np.full(n_trials, 1 / n_trials), size=n_boot).astype(float)
+        # A bootstrap mean is NaN wherever one of the drawn trials is NaN:
+        nans = np.isnan(cell_data)
+        means = weights @ np.where(nans, 0, cell_data) / n_trials
+        means[(weights @ nans) > 0] = np.nan
+        _, latencies[cell], _ = max_percentage_indices(means, thresh_percent, start=start[cell], times=times)
+    return latencies
+
+
+def bootstrap_ci(latencies, ci=0.95):
+    """
+    This function computes the percentile confidence interval of bootstrap distributions.
+    :param latencies: (2D array) bootstrap distribution of each cell, n_cells x n_boot (see bootstrap_latencies)
+    :param ci: (float) confidence level
+    :return:
+    ci_low: (1D array) lower bound of the confidence interval
+    ci_high: (1D array) upper bound of the confidence interval
+    """
+    ci_low, ci_high = np.full(latencies.shape[0], np.nan), np.full(latencies.shape[0], np.nan)
+    valid = ~np.all(np.isnan(latencies), axis=1)
+    if np.any(valid):
+        ci_low[valid], ci_high[valid] = np.nanpercentile(latencies[valid], [50 * (1 - ci), 50 * (1 + ci)], axis=1)
+    return ci_low, ci_high
@@ -0,0 +1,238 @@
+import os
+import json
+import shutil
+import mne
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from helper_function.helper_general import get_condition_mask, time_mask
+
+# Channels exported by default, as prefixes of the channels names (i.e. pupil matches pupil_left and pupil_right):
+DFT_STORE_CHANNELS = ["pupil", "fixdist", "blink", "fixation", "xpos", "ypos"]
+
+
+def trial_store_path(bids_root, subject, session, task, data_type):
+    """
+    This function returns the directory of the trial store of a subject.
+    :param bids_root: (string or Path) root of the bids directory
+    :param subject: (string) subject ID
+    :param session: (string) session
+    :param task: (string) task
+    :param data_type: (string) data type (i.e. eyetrack)
+    :return: (Path) directory of the trial store
+    """
+    return Path(bids_root, "derivatives", "preprocessing", "sub-" + subject, "ses-" + session, data_type,
+                "sub-{}_ses-{}_task-{}_{}_desc-trials".format(subject, session, task, data_type))
+
+
+def save_trial_store(epochs, store_dir, channels=None, dtype="float32"):
+    """
+    This function exports epochs to a trial store: a directory with one numpy file per channel (trials x time, such
+    that each trial is contiguous on disk), a metadata table and a json file describing the epochs. Channels that only
+    contain 0 and 1 (blinks, fixations...) are saved as booleans, the others in dtype. The loader (TrialStore) memory
+    maps the channel files, so that only the channels and trials that are requested are read from disk.
+    :param epochs: (mne epochs object) epochs to export
+    :param store_dir: (string or Path) directory of the store. Overwritten if it already exists
+    :param channels: (list of strings) channels to export, either full channels names or prefixes (i.e. pupil for
+    pupil_left and pupil_right). Default to DFT_STORE_CHANNELS
+    :param dtype: (string or numpy dtype) type in which to save the continuous channels
+    :return:
+    """
+    if channels is None:
+        channels = DFT_STORE_CHANNELS
+    ch_names = [ch for ch in epochs.ch_names if ch in channels or ch.split("_")[0] in channels]
+    if len(ch_names) == 0:
+        raise ValueError("None of the channels {} are found in the epochs!".format(channels))
+    # Write to a temporary directory that replaces the previous store once complete:
+    tmp_dir = str(store_dir) + ".tmp"
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    # Save each channel:
+    ch_dtypes = {}
+    for ch in ch_names:
+        data = epochs.get_data(picks=[ch])[:, 0, :]
+        if np.all(np.isin(data, [0, 1])):
+            data = data.astype(bool)
+        else:
+            data = data.astype(dtype)
+        np.save(Path(tmp_dir, "{}.npy".format(ch)), data)
+        ch_dtypes[ch] = str(data.dtype)
+
+    # Save the metadata, along with the events of each trial:
+    event_desc = {code: name for name, code in epochs.event_id.items()}
+    metadata = pd.DataFrame() if epochs.metadata is None else epochs.metadata.reset_index(drop=True)
+    metadata = metadata.assign(event=[event_desc[code] for code in epochs.events[:, 2]],
+                               event_code=epochs.events[:, 2], sample=epochs.events[:, 0],
+                               selection=epochs.selection)
+    try:
+        metadata.to_parquet(Path(tmp_dir, "metadata.parquet"), index=False)
+    except (ImportError, ValueError, TypeError, NotImplementedError):
+        # No parquet engine installed, or columns that can't be converted (mixed types objects columns...). The pyarrow
+        # conversion errors (ArrowInvalid, ArrowTypeError, ArrowNotImplementedError) derive from these exceptions:
+        if os.path.isfile(Path(tmp_dir, "metadata.parquet")):
+            os.remove(Path(tmp_dir, "metadata.parquet"))
+        metadata.to_pickle(Path(tmp_dir, "metadata.pkl"))
+    info = {
+        "ch_names": ch_names,
+        "ch_types": epochs.get_channel_types(picks=ch_names),
+        "ch_dtypes": ch_dtypes,
+        "sfreq": epochs.info["sfreq"],
+        "tmin": epochs.tmin,
+        "n_times": len(epochs.times),
+        "event_id": epochs.event_id
+    }
+    with open(Path(tmp_dir, "info.json"), "w") as f:
+        json.dump(info, f, indent=2, default=str)
+    if os.path.isdir(store_dir):
+        shutil.rmtree(store_dir)
+    os.replace(tmp_dir, store_dir)
+
+
+class TrialStore:
+    """
+    This class reads a trial store saved with save_trial_store. The metadata are loaded when the store is opened, the
+    channels are memory mapped and only the requested channels, trials and time points are read.
+    :param store_dir: (string or Path) directory of the store
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = Path(store_dir)
+        with open(Path(self.store_dir, "info.json")) as f:
+            info = json.load(f)
+        self.ch_names = info["ch_names"]
+        self.ch_types = info["ch_types"]
+        self.sfreq = info["sfreq"]
+        self.times = info["tmin"] + np.arange(info["n_times"]) / info["sfreq"]
+        self.event_id = info["event_id"]
+        if os.path.isfile(Path(self.store_dir, "metadata.parquet")):
+            self.metadata = pd.read_parquet(Path(self.store_dir, "metadata.parquet"))
+        else:
+            self.metadata = pd.read_pickle(Path(self.store_dir, "metadata.pkl"))
+        self.events = self.metadata[["sample", "event_code"]].to_numpy()
+        self.events = np.column_stack([self.events[:, 0], np.zeros(len(self.events), dtype=int),
+                                       self.events[:, 1]])
+        self._channels = {}
+
+    def __len__(self):
+        return len(self.metadata)
+
+    def channel(self, ch):
+        """
+        This function returns the memory mapped data of a channel.
+        :param ch: (string) name of the channel
+        :return: (np.memmap) trials x time data of the channel
+        """
+        if ch not in self._channels:
+            if ch not in self.ch_names:
+                raise KeyError("The channel {} is not in the trial store!".format(ch))
+            self._channels[ch] = np.load(Path(self.store_dir, "{}.npy".format(ch)), mmap_mode="r")
+        return self._channels[ch]
+
+    def trial_index(self, item=None, query=None):
+        """
+        This function returns the indices of the trials matching a condition and a metadata query.
+        :param item: (None, string, list of strings, int, slice, array of int or booleans) trials to select. Strings
+        follow the MNE conditions logic (i.e. "onset/1.0")
+        :param query: (string) pandas query on the metadata (i.e. "SOA_lock == 'onset' and duration == '1.0'")
+        :return: (1D array of int) indices of the selected trials, in increasing order
+        """
+        mask = np.ones(len(self), dtype=bool)
+        if item is not None:
+            if isinstance(item, str) or (isinstance(item, (list, tuple)) and len(item) > 0 and
+                                         isinstance(item[0], str)):
+                mask &= get_condition_mask(self, item)
+            else:
+                item_mask = np.zeros(len(self), dtype=bool)
+                item_mask[np.arange(len(self))[item]] = True
+                mask &= item_mask
+        if query is not None:
+            mask &= self.metadata.eval(query).to_numpy(dtype=bool)
+        return np.flatnonzero(mask)
+
+    def get_data(self, picks=None, item=None, query=None, tmin=None, tmax=None):
+        """
+        This function reads the data of the selected channels, trials and time points.
+        :param picks: (None, string or list of strings) channels to read. Channels prefixes are accepted (i.e. pupil
+        for pupil_left and pupil_right). If None, all channels are read
+        :param item: see trial_index
+        :param query: see trial_index
+        :param tmin: (float) start of the time window
+        :param tmax: (float) end of the time window (included)
+        :return: (np.array) trials x channels x time data, in float64
+        """
+        picks = self.pick_names(picks)
+        trials = self.trial_index(item=item, query=query)
+        times = np.flatnonzero(time_mask(self.times, tmin, tmax, sfreq=self.sfreq))
+        times = slice(times[0], times[-1] + 1)
+        data = np.empty([len(trials), len(picks), len(self.times[times])])
+        for ch_i, ch in enumerate(picks):
+            data[:, ch_i, :] = self.channel(ch)[trials, times]
+        return data
+
+    def pick_names(self, picks=None):
+        """
+        This function converts channels names or prefixes to the channels names of the store.
+        :param picks: (None, string or list of strings) channels names or prefixes
+        :return: (list of strings) channels names
+        """
+        if picks is None:
+            return list(self.ch_names)
+        if isinstance(picks, str):
+            picks = [picks]
+        names = [ch for ch in self.ch_names if ch in picks or ch.split("_")[0] in picks]
+        if len(names) == 0:
+            raise KeyError("None of the channels {} are in the trial store!".format(picks))
+        return names
+
+    def to_epochs(self, picks=None, item=None, query=None, tmin=None, tmax=None):
+        """
+        This function creates mne epochs from the selected channels, trials and time points.
+        :param picks: see get_data
+        :param item: see trial_index
+        :param query: see trial_index
+        :param tmin: see get_data
+        :param tmax: see get_data
+        :return: (mne epochs object) epochs
+        """
+        picks = self.pick_names(picks)
+        trials = self.trial_index(item=item, query=query)
+        data = self.get_data(picks=picks, item=trials, tmin=tmin, tmax=tmax)
+        times = self.times[time_mask(self.times, tmin, tmax, sfreq=self.sfreq)]
+        info = mne.create_info(picks, self.sfreq,
+                               ch_types=[self.ch_types[self.ch_names.index(ch)] for ch in picks])
+        metadata = self.metadata.iloc[trials].drop(columns=["event", "event_code", "sample", "selection"])
+        return mne.EpochsArray(data, info, events=self.events[trials], tmin=times[0], event_id=self.event_id,
+                               on_missing="ignore", metadata=metadata.reset_index(drop=True),
+                               selection=self.metadata["selection"].to_numpy()[trials], verbose="ERROR")
+
+
+def read_cohort_trials(bids_root, subjects, session, task, data_type, picks=None, item=None, query=None, tmin=None,
+                       tmax=None):
+    """
+    This function reads the same channels, trials and time points from the trial stores of several subjects and
+    concatenates them.
+    :param bids_root: (string or Path) root of the bids directory
+    :param subjects: (list of strings) subjects IDs
+    :param session: (string or list of strings) session(s) to read
+    :param task: (string) task
+    :param data_type: (string) data type (i.e. eyetrack)
+    :param picks: see TrialStore.get_data
+    :param item: see TrialStore.trial_index
+    :param query: see TrialStore.trial_index
+    :param tmin: see TrialStore.get_data
+    :param tmax: see TrialStore.get_data
+    :return:
+    data: (np.array) trials x channels x time data of all subjects
+    metadata: (pandas data frame) metadata of the trials, with the subject and session of each trial
+    """
+    sessions = session if isinstance(session, list) else [session]
+    data, metadata = [], []
+    for sub in subjects:
+        for ses in sessions:
+            store = TrialStore(trial_store_path(bids_root, sub, ses, task, data_type))
+            trials = store.trial_index(item=item, query=query)
+            data.append(store.get_data(picks=picks, item=trials, tmin=tmin, tmax=tmax))
+            metadata.append(store.metadata.iloc[trials].assign(sub=sub, ses=ses))
+    return np.concatenate(data, axis=0), pd.concat(metadata, ignore_index=True)